@@ -0,0 +1,244 @@
+# Copyright 2015-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+
+from multiprocessing.pool import ThreadPool
+
+LOG = logging.getLogger(__name__)
+CHUNK_SIZE = 1024 * 1024
+# Zip can not represent timestamps before 1980
+MIN_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+UNIX_SYSTEM = 3
+REPRODUCIBLE_FILE_MODE = 0o100644
+REPRODUCIBLE_EXEC_MODE = 0o100755
+# Files at least this large are streamed into the archive by the writing
+# thread rather than compressed in memory by a worker
+STREAM_THRESHOLD = 8 * CHUNK_SIZE
+# ZipFile.open can write entries from Python 3.6 on
+_STREAMING = sys.version_info >= (3, 6)
+
+
+class ZipWriter(object):
+    '''
+    Writes files into a deflated zip archive.
+
+    Entries are compressed by a pool of worker threads (zlib releases the GIL
+    while it compresses) and written to the archive in order by the calling
+    thread. Compressed entries are held in memory until they are written, so
+    the window of pending entries is bounded by bytes as well as by count,
+    and files of STREAM_THRESHOLD bytes or more are streamed by the calling
+    thread instead. With a single worker every file is streamed.
+
+    A reproducible writer sorts the entries by name, uses a fixed timestamp
+    and normalizes permissions so identical files give an identical zip.
+
+    Every byte of the archive is also written to tee, if given, as soon as
+    it is written to zip_file. The archive then can not seek back to fill in
+    the local headers of streamed files, so they are deflated into a
+    temporary file first, which keeps the zip identical to the one written
+    without tee.
+    '''
+    def __init__(self, zip_file, workers=1, reproducible=False, tee=None):
+        self._fil = None
+        if tee is not None:
+            self._fil = _TeeFile(open(zip_file, 'wb'), tee)
+            zip_file = self._fil
+        self._zf = zipfile.ZipFile(zip_file, "w", zipfile.ZIP_DEFLATED)
+        self._workers = max(1, workers or 1)
+        self._reproducible = reproducible
+
+    def write_all(self, entries):
+        '''Compresses and writes an iterable of (path, arcname) pairs'''
+        if self._reproducible:
+            entries = sorted(entries, key=lambda entry: entry[1])
+
+        if self._workers == 1:
+            for path, arcname in entries:
+                self._write_streamed(path, arcname)
+            return
+
+        pool = ThreadPool(self._workers)
+        # Keep a bounded window of pending entries so memory use stays
+        # proportional to the worker count rather than the archive size
+        max_pending = self._workers * STREAM_THRESHOLD
+        pending = collections.deque()
+        pending_bytes = [0]
+
+        def write_next():
+            arcname, size, result = pending.popleft()
+            pending_bytes[0] -= size
+            self._write_compressed(arcname, result.get())
+
+        try:
+            for path, arcname in entries:
+                size = os.path.getsize(path)
+                if size >= STREAM_THRESHOLD:
+                    while pending:
+                        write_next()
+                    self._write_streamed(path, arcname)
+                    continue
+                while pending and (len(pending) >= self._workers * 2 or
+                                   pending_bytes[0] + size > max_pending):
+                    write_next()
+                pending.append((arcname, size,
+                                pool.apply_async(_compress, (path,))))
+                pending_bytes[0] += size
+            while pending:
+                write_next()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def close(self):
+        try:
+            self._zf.close()
+        finally:
+            if self._fil is not None:
+                self._fil.close()
+
+    def _write_streamed(self, path, arcname):
+        '''Deflates a file into the archive a chunk at a time'''
+        if self._fil is not None:
+            self._write_spooled(path, arcname)
+            return
+        if not _STREAMING:
+            self._write_compressed(arcname, _compress(path))
+            return
+        LOG.debug('Zipping %s' % arcname)
+        stat = os.stat(path)
+        zinfo = self._zipinfo(arcname, stat)
+        zinfo.file_size = stat.st_size
+        with open(path, 'rb') as src:
+            with self._zf.open(zinfo, 'w') as dest:
+                shutil.copyfileobj(src, dest, CHUNK_SIZE)
+
+    def _zipinfo(self, arcname, stat):
+        if self._reproducible:
+            zinfo = zipfile.ZipInfo(arcname, MIN_DATE_TIME)
+            zinfo.create_system = UNIX_SYSTEM
+            mode = REPRODUCIBLE_FILE_MODE
+            if stat.st_mode & 0o111:
+                mode = REPRODUCIBLE_EXEC_MODE
+            zinfo.external_attr = mode << 16
+        else:
+            date_time = max(time.localtime(stat.st_mtime)[:6], MIN_DATE_TIME)
+            zinfo = zipfile.ZipInfo(arcname, date_time)
+            zinfo.external_attr = (stat.st_mode & 0xFFFF) << 16
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        return zinfo
+
+    def _write_spooled(self, path, arcname):
+        '''
+        Deflates a file into a temporary file and appends it to the archive,
+        so its local header has the CRC and sizes without seeking back
+        '''
+        spool = tempfile.TemporaryFile()
+        try:
+            stat, crc, size = _deflate(path, spool.write)
+            compress_size = spool.tell()
+            spool.seek(0)
+            self._write_compressed(
+                arcname, (stat, crc, size,
+                          iter(lambda: spool.read(CHUNK_SIZE), b'')),
+                compress_size)
+        finally:
+            spool.close()
+
+    def _write_compressed(self, arcname, compressed, compress_size=None):
+        '''
+        Appends an already deflated entry to the archive. The chunks may be
+        any iterable when compress_size is given.
+        '''
+        stat, crc, size, chunks = compressed
+        LOG.debug('Zipping %s' % arcname)
+
+        zinfo = self._zipinfo(arcname, stat)
+        zinfo.CRC = crc
+        zinfo.file_size = size
+        if compress_size is None:
+            compress_size = sum(len(chunk) for chunk in chunks)
+        zinfo.compress_size = compress_size
+
+        zf = self._zf
+        zinfo.header_offset = zf.fp.tell()
+        zf.fp.write(zinfo.FileHeader())
+        for chunk in chunks:
+            zf.fp.write(chunk)
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+        # Keep ZipFile's own bookkeeping in step so close() writes the
+        # central directory after our entries
+        zf.start_dir = zf.fp.tell()
+        zf._didModify = True
+
+
+class _TeeFile(object):
+    '''
+    Copies writes to a second stream. It can not seek, so ZipFile writes the
+    archive strictly in order.
+    '''
+    def __init__(self, fil, tee):
+        self._fil = fil
+        self._tee = tee
+
+    def write(self, data):
+        self._fil.write(data)
+        self._tee.write(data)
+        return len(data)
+
+    def tell(self):
+        return self._fil.tell()
+
+    def flush(self):
+        self._fil.flush()
+
+    def close(self):
+        self._fil.close()
+
+
+def _compress(path):
+    '''Returns the stat, CRC, size and raw deflate chunks of a file'''
+    chunks = []
+    stat, crc, size = _deflate(path, chunks.append)
+    return stat, crc, size, chunks
+
+
+def _deflate(path, write):
+    '''
+    Passes the raw deflate chunks of a file to write, returns its stat, CRC
+    and size
+    '''
+    stat = os.stat(path)
+    crc = 0
+    size = 0
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                  zlib.DEFLATED, -15)
+    with open(path, 'rb') as fil:
+        for data in iter(lambda: fil.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            chunk = compressor.compress(data)
+            if chunk:
+                write(chunk)
+    write(compressor.flush())
+    return stat, crc & 0xffffffff, size
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""lambda-uploader-batch - Build and upload many lambda jobs at once"""
+
+from __future__ import print_function
+
+import glob
+import json
+import logging
+import multiprocessing
+import sys
+import traceback
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from os import path
+from lambda_uploader import package, shell
+from lambda_uploader.report import Report
+
+LOG = logging.getLogger(__name__)
+DEFAULT_UPLOAD_WORKERS = 4
+
+
+class Function(object):
+    '''The state of one function directory in a batch'''
+    def __init__(self, pth):
+        self.path = pth
+        self.name = path.basename(pth)
+        self.cfg = None
+        self.pkg = None
+        self.built = False
+        self.uploaded = False
+        self.error = None
+        self.report = Report()
+
+    def echo(self, txt):
+        shell._print('[%s] %s' % (self.name, txt))
+
+    def fail(self, phase):
+        ex = sys.exc_info()[1]
+        self.error = '%s failed: %s' % (phase, ex)
+        if not isinstance(ex, shell.ColdStartBudgetExceeded):
+            LOG.debug(traceback.format_exc())
+        self.echo(self.error)
+
+
+def function_dirs(patterns):
+    '''Expands the directories and glob patterns given on the command line'''
+    dirs = OrderedDict()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        for pth in matches:
+            if path.isdir(pth):
+                dirs[path.abspath(pth)] = True
+    return list(dirs.keys())
+
+
+def _requirements_key(args, fn):
+    '''Returns the key functions sharing dependency installs are grouped by'''
+    if args.no_build or args.config_only or args.no_virtualenv or \
+       args.virtualenv:
+        return None
+    pkg = package.Package(fn.path, pyexec=fn.cfg.runtime)
+    requirements = fn.cfg.requirements
+    if args.requirements:
+        requirements = path.abspath(args.requirements)
+    pkg.requirements(requirements)
+    key = pkg.requirements_key()
+    if key is not None and pkg.has_local_requirements():
+        # The same text installs a different package for each function
+        key = '%s-%s' % (key, fn.path)
+    return key
+
+
+def _build_group(args, group):
+    '''
+    Builds the functions of a group one at a time until one of them
+    installs the requirements, returning the rest with the virtualenv they
+    share. Build cache hits install nothing, so they do not end the search.
+    '''
+    for index, fn in enumerate(group):
+        _build(args, fn)
+        if fn.built and fn.pkg is not None and fn.pkg.venv_dir:
+            return [(rest, fn.pkg.venv_dir) for rest in group[index + 1:]]
+        if not fn.built or fn.pkg is None or not fn.pkg.cache_hit:
+            break
+    return [(rest, None) for rest in group[index + 1:]]
+
+
+def _build(args, fn, shared_venv=None):
+    try:
+        fn.pkg = shell._build(args, fn.cfg, fn.path, shared_venv=shared_venv,
+                              prnt=fn.echo, report=fn.report)
+        fn.built = True
+    except Exception:
+        fn.fail('Build')
+
+
+def _upload(args, fn):
+    try:
+        shell._upload(args, fn.cfg, fn.pkg, prnt=fn.echo, report=fn.report)
+        fn.uploaded = True
+    except Exception:
+        fn.fail('Upload')
+
+
+def execute(args):
+    '''
+    Builds every function on a pool of build workers, then uploads them on a
+    separate pool of upload workers.
+
+    Functions with identical requirements share one dependency install: the
+    functions of each group are built one at a time until one installs the
+    requirements, rather than hitting the build cache, and the rest of the
+    group reuse its virtualenv.
+    '''
+    functions = [Function(pth) for pth in function_dirs(args.function_dirs)]
+    if not functions:
+        raise Exception('No function directories found')
+
+    groups = OrderedDict()
+    for fn in functions:
+        try:
+            fn.cfg = shell._load_config(args, fn.path,
+                                        path.join(fn.path, args.config))
+        except Exception:
+            fn.fail('Configuration')
+            continue
+        key = _requirements_key(args, fn) or fn.path
+        groups.setdefault(key, []).append(fn)
+
+    pool = ThreadPool(args.build_workers)
+    try:
+        followers = []
+        for rest in pool.map(lambda group: _build_group(args, group),
+                             groups.values()):
+            followers.extend(rest)
+        pool.map(lambda job: _build(args, job[0], job[1]), followers)
+    finally:
+        pool.close()
+        pool.join()
+
+    if not args.no_clean:
+        for fn in functions:
+            if fn.pkg is not None:
+                fn.pkg.clean_workspace()
+
+    if not args.no_upload:
+        built = [fn for fn in functions if fn.built]
+        pool = ThreadPool(args.upload_workers)
+        try:
+            pool.map(lambda fn: _upload(args, fn), built)
+        finally:
+            pool.close()
+            pool.join()
+
+    _print_summary(args, functions)
+    if args.report_json:
+        _write_report(args.report_json, functions)
+    return all(fn.error is None for fn in functions)
+
+
+def _print_summary(args, functions):
+    shell._print('Summary')
+    for fn in functions:
+        if fn.error is not None:
+            status = '%s %s' % (shell.RED_X, fn.error)
+        elif args.no_upload:
+            status = '%s built' % shell.CHECK
+        else:
+            status = '%s uploaded' % shell.CHECK
+        print('  %s: %s' % (fn.name, status))
+
+
+def _write_report(pth, functions):
+    '''Writes the reports of all functions, keyed by directory, as JSON'''
+    reports = OrderedDict()
+    for fn in functions:
+        reports[fn.path] = fn.report.as_dict()
+        reports[fn.path]['error'] = fn.error
+    with open(pth, 'w') as fil:
+        json.dump({'functions': reports}, fil, indent=2)
+
+
+def main(arv=None):
+    """lambda-uploader-batch command line interface."""
+    args = _arg_parser().parse_args(arv)
+
+    logging.basicConfig(level=args.loglevel, format=shell.LOG_FORMAT)
+    try:
+        success = execute(args)
+    except Exception:
+        shell._print_traceback()
+        sys.exit(1)
+
+    if not success:
+        sys.exit(1)
+
+
+def _arg_parser():
+    parser = shell._parser(
+            description='Build and upload many python lambda jobs at once')
+    parser.add_argument('function_dirs', nargs='+',
+                        help='lambda function directories or glob patterns')
+    parser.add_argument('--config', '-c', default='lambda.json',
+                        help='name of the configuration file in each '
+                             'function directory')
+    parser.add_argument('--build-workers', dest='build_workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of functions built at the same time')
+    parser.add_argument('--upload-workers', dest='upload_workers', type=int,
+                        default=DEFAULT_UPLOAD_WORKERS,
+                        help='number of functions uploaded at the same time')
+    return parser
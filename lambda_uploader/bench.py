@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""lambda-uploader-bench - Benchmark the handler of a built lambda job"""
+
+from __future__ import print_function
+
+import base64
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+
+from os import path
+from subprocess import Popen, PIPE
+from lambda_uploader import package, shell
+
+LOG = logging.getLogger(__name__)
+DEFAULT_INVOCATIONS = 100
+DEFAULT_RECORD_SIZE = 256
+DEFAULT_BATCH_SIZE = 100
+STREAM_ARN = 'arn:aws:kinesis:%s:000000000000:stream/bench'
+# Leave out PYTHONPATH and every site-packages directory
+CLEAN_FLAGS = ['-E', '-s', '-S']
+# Provided by the Lambda Python runtimes in /var/runtime, which comes after
+# the package and the layers on sys.path
+RUNTIME_MODULES = ['boto3', 'botocore', 's3transfer', 'jmespath',
+                   'dateutil', 'urllib3', 'six']
+# Imports under this share of the total are left out of the profile tree
+MIN_IMPORT_SHARE = 0.01
+IMPORTS_SHOWN = 10
+PROFILE_MARKER = 'lambda-uploader: importing handler'
+# Prints the marker and imports the handler module with -X importtime
+PROFILER = '''
+import sys
+sys.path[0:1] = sys.argv[2:]
+sys.stderr.write("%s\\n")
+sys.stderr.flush()
+__import__(sys.argv[1])
+''' % PROFILE_MARKER
+
+# Runs in the benchmark subprocess: imports the handler with only the
+# unpacked package (and layer) on sys.path, invokes it once per event read
+# from stdin and writes the timings as JSON to stdout. Kept compatible with
+# every runtime the package may be built for.
+RUNNER = '''
+import json, sys, time
+timer = getattr(time, "perf_counter", time.time)
+sys.path[0:1] = sys.argv[1:]
+out = sys.stdout
+sys.stdout = sys.stderr
+job = json.loads(sys.stdin.read())
+
+
+class Context(object):
+    def __init__(self, number):
+        self.function_name = job["function_name"]
+        self.function_version = "$LATEST"
+        self.invoked_function_arn = job["function_arn"]
+        self.memory_limit_in_mb = job["memory"]
+        self.aws_request_id = "bench-%d" % number
+        self.log_group_name = "/aws/lambda/" + self.function_name
+        self.log_stream_name = "bench"
+        self._deadline = time.time() + job["timeout"]
+
+    def get_remaining_time_in_millis(self):
+        return int(max(0, self._deadline - time.time()) * 1000)
+
+
+start = timer()
+module_name, handler_name = job["handler"].rsplit(".", 1)
+module = __import__(module_name, fromlist=[handler_name])
+handler = getattr(module, handler_name)
+import_seconds = timer() - start
+
+latencies = []
+for number, event in enumerate(job["events"]):
+    start = timer()
+    handler(event, Context(number))
+    latencies.append(timer() - start)
+
+rss = 0
+try:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform != "darwin":
+        rss *= 1024
+except ImportError:
+    pass
+out.write(json.dumps({"import_seconds": import_seconds,
+                      "latencies": latencies, "peak_rss": rss}))
+'''
+
+
+def kinesis_events(count, batch_size, record_size=DEFAULT_RECORD_SIZE,
+                   region='us-east-1'):
+    '''
+    Returns count synthetic Kinesis events of batch_size records, each
+    carrying record_size bytes of base64 encoded data
+    '''
+    data = base64.b64encode(b'x' * record_size).decode('ascii')
+    stream_arn = STREAM_ARN % region
+    events = []
+    for number in range(count):
+        records = []
+        for index in range(batch_size):
+            sequence = '%056d' % (number * batch_size + index)
+            records.append({
+                'kinesis': {
+                    'kinesisSchemaVersion': '1.0',
+                    'partitionKey': str(index),
+                    'sequenceNumber': sequence,
+                    'data': data,
+                    'approximateArrivalTimestamp': 1500000000.0 + number,
+                },
+                'eventSource': 'aws:kinesis',
+                'eventVersion': '1.0',
+                'eventID': 'shardId-000000000000:%s' % sequence,
+                'eventName': 'aws:kinesis:record',
+                'invokeIdentityArn': 'arn:aws:iam::000000000000:role/bench',
+                'awsRegion': region,
+                'eventSourceARN': stream_arn,
+            })
+        events.append({'Records': records})
+    return events
+
+
+def run(zip_file, handler, events, python=None, layer_zip_file=None,
+        function_name='bench', memory=128, timeout=3, warmup=1,
+        runtime_path=None):
+    '''
+    Unpacks zip_file (and the layer) into a temporary directory and invokes
+    handler with each event in a clean python subprocess. runtime_path are
+    the directories of the libraries the runtime provides, by default the
+    RUNTIME_MODULES of this python.
+
+    The first warmup invocations are left out of the latency statistics.
+    returns the records per second, the p50 and p99 latency per invocation
+    in seconds, the handler import time and the peak RSS in bytes
+    '''
+    task_dir = tempfile.mkdtemp(prefix='lambda-uploader-bench-')
+    try:
+        sys_path = _unpack(zip_file, layer_zip_file, task_dir, runtime_path)
+        job = {'handler': handler, 'events': events,
+               'function_name': function_name,
+               'function_arn': 'arn:aws:lambda:us-east-1:000000000000:'
+                               'function:%s' % function_name,
+               'memory': memory, 'timeout': timeout}
+        cmd = [python or sys.executable] + CLEAN_FLAGS + ['-c', RUNNER]
+        LOG.debug('Running %s in %s' % (handler, sys_path[0]))
+        proc = Popen(cmd + sys_path, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                     cwd=sys_path[0])
+        stdout, stderr = proc.communicate(json.dumps(job).encode('utf-8'))
+        LOG.debug('Handler output: %s' % stderr.decode('utf-8', 'replace'))
+        if proc.returncode != 0:
+            raise Exception('Handler %s failed:\n%s'
+                            % (handler, stderr.decode('utf-8', 'replace')))
+        timings = json.loads(stdout.decode('utf-8'))
+    finally:
+        shutil.rmtree(task_dir, ignore_errors=True)
+
+    return _results(events, timings, warmup)
+
+
+class Import(object):
+    '''An imported module with its own and cumulative import time'''
+    def __init__(self, name, self_us, cumulative_us):
+        self.name = name
+        self.self_us = self_us
+        self.cumulative_us = cumulative_us
+        self.children = []
+
+
+def import_profile(zip_file, handler, python=None, layer_zip_file=None,
+                   runtime_path=None):
+    '''
+    Imports the module of handler from the unpacked package in a clean
+    python subprocess under -X importtime (Python 3.7 or later), with the
+    runtime_path libraries after the package as in run().
+
+    returns the top level imports, as a tree of Import, and the total import
+    time in microseconds
+    '''
+    module_name = handler.rsplit('.', 1)[0]
+    task_dir = tempfile.mkdtemp(prefix='lambda-uploader-imports-')
+    try:
+        sys_path = _unpack(zip_file, layer_zip_file, task_dir, runtime_path)
+        cmd = [python or sys.executable] + CLEAN_FLAGS + \
+            ['-X', 'importtime', '-c', PROFILER, module_name]
+        proc = Popen(cmd + sys_path, stdout=PIPE, stderr=PIPE,
+                     cwd=sys_path[0])
+        stdout, stderr = proc.communicate()
+    finally:
+        shutil.rmtree(task_dir, ignore_errors=True)
+
+    stderr = stderr.decode('utf-8', 'replace')
+    if proc.returncode != 0:
+        raise Exception('Importing %s failed:\n%s' % (module_name, stderr))
+    if PROFILE_MARKER not in stderr or 'import time:' not in stderr:
+        raise Exception('%s does not support -X importtime, it needs '
+                        'Python 3.7 or later' % cmd[0])
+    roots = _import_tree(stderr.split(PROFILE_MARKER, 1)[1].splitlines())
+    return roots, sum(root.cumulative_us for root in roots)
+
+
+def _import_tree(lines):
+    '''
+    Builds the tree of -X importtime lines. Modules are printed after their
+    imports, indented two spaces per level.
+    '''
+    pending = {}
+    for line in lines:
+        if not line.startswith('import time:'):
+            continue
+        fields = line.split('|')
+        try:
+            self_us = int(fields[0].split(':')[1])
+            cumulative_us = int(fields[1])
+        except ValueError:
+            # The header line
+            continue
+        name = fields[2].rstrip()[1:]
+        depth = (len(name) - len(name.lstrip(' '))) // 2
+        node = Import(name.strip(), self_us, cumulative_us)
+        node.children = pending.pop(depth + 1, [])
+        pending.setdefault(depth, []).append(node)
+    return pending.get(0, [])
+
+
+def format_import_tree(roots, total_us, shown=IMPORTS_SHOWN,
+                       min_share=MIN_IMPORT_SHARE):
+    '''
+    Returns the lines of the heaviest imports, sorted by cumulative time,
+    with at most shown imports per level
+    '''
+    lines = []
+
+    def add(nodes, depth):
+        nodes = sorted(nodes, key=lambda n: n.cumulative_us, reverse=True)
+        for node in nodes[:shown]:
+            if node.cumulative_us < total_us * min_share:
+                break
+            lines.append('%8.1fms %5.1f%% %s%s'
+                         % (node.cumulative_us / 1000.0,
+                            100.0 * node.cumulative_us / max(total_us, 1),
+                            '  ' * depth, node.name))
+            add(node.children, depth + 1)
+    add(roots, 0)
+    return lines
+
+
+def _unpack(zip_file, layer_zip_file, task_dir, runtime_path=None):
+    '''
+    Unpacks the package, and the layer, the way Lambda lays them out.
+    returns the directories to put on sys.path
+    '''
+    sys_path = [path.join(task_dir, 'task')]
+    with zipfile.ZipFile(zip_file) as zf:
+        zf.extractall(sys_path[0])
+    if layer_zip_file:
+        opt = path.join(task_dir, 'opt')
+        with zipfile.ZipFile(layer_zip_file) as zf:
+            zf.extractall(opt)
+        sys_path.append(path.join(opt, 'python'))
+    if runtime_path is None:
+        runtime_path = [_host_runtime(path.join(task_dir, 'runtime'))]
+    return sys_path + [path.abspath(pth) for pth in runtime_path]
+
+
+def _host_runtime(runtime_dir):
+    '''
+    Links the RUNTIME_MODULES installed for this python into runtime_dir,
+    on their own so the rest of its site packages stay off sys.path
+    '''
+    os.mkdir(runtime_dir)
+    for name in RUNTIME_MODULES:
+        source = _module_path(name)
+        if source is None:
+            LOG.debug('%s is not installed, leaving it out of the runtime'
+                      % name)
+            continue
+        target = path.join(runtime_dir, path.basename(source))
+        try:
+            os.symlink(source, target)
+        except (AttributeError, NotImplementedError, OSError):
+            # No symlinks on this platform
+            if path.isdir(source):
+                shutil.copytree(source, target)
+            else:
+                shutil.copy2(source, target)
+    return runtime_dir
+
+
+def _module_path(name):
+    '''
+    Returns the package directory or module file of name, without
+    importing it
+    '''
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        import imp
+        try:
+            return imp.find_module(name)[1]
+        except ImportError:
+            return None
+    spec = find_spec(name)
+    if spec is None or not spec.origin or not path.isfile(spec.origin):
+        return None
+    if spec.submodule_search_locations:
+        return path.dirname(spec.origin)
+    return spec.origin
+
+
+def _results(events, timings, warmup):
+    latencies = timings['latencies']
+    measured = latencies[warmup:] or latencies
+    counted = events[len(latencies) - len(measured):]
+    records = sum(len(event.get('Records', [event]))
+                  if isinstance(event, dict) else 1 for event in counted)
+    seconds = sum(measured)
+    return {
+        'invocations': len(measured),
+        'records': records,
+        'records_per_second': records / seconds if seconds else 0.0,
+        'p50_seconds': _percentile(measured, 50),
+        'p99_seconds': _percentile(measured, 99),
+        'cold_seconds': latencies[0] if latencies else 0.0,
+        'import_seconds': timings['import_seconds'],
+        'peak_rss': timings['peak_rss'],
+    }
+
+
+def _percentile(values, percent):
+    '''Returns the nearest rank percentile'''
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def _load_events(pth, invocations):
+    '''Reads recorded events, a JSON list or a single event'''
+    with open(pth) as fil:
+        recorded = json.load(fil)
+    if not isinstance(recorded, list):
+        recorded = [recorded]
+    if not recorded:
+        raise Exception('%s has no events' % pth)
+    return [recorded[i % len(recorded)] for i in range(invocations)]
+
+
+def _batch_size(args, cfg):
+    if args.batch_size:
+        return args.batch_size
+    kinesis = cfg.subscription.get('kinesis') or {}
+    for entry in cfg.subscriptions or []:
+        if entry['type'] == 'kinesis':
+            kinesis = entry
+    return kinesis.get('batch_size', DEFAULT_BATCH_SIZE)
+
+
+def execute(args):
+    pth = path.abspath(args.function_dir)
+    # The benchmark only builds, it never deploys
+    args.no_upload = True
+    args.config_only = False
+
+    cfg = shell._load_config(args, pth)
+    pkg = shell._build(args, cfg, pth)
+    try:
+        total = args.invocations + args.warmup
+        if args.events:
+            events = _load_events(args.events, total)
+        else:
+            events = kinesis_events(total, _batch_size(args, cfg),
+                                    args.record_size, cfg.region)
+
+        # With --no-build the package does not know the runtime
+        python = args.python or package.python_executable(cfg.runtime)
+        shell._print('Running %s %d times with %s'
+                     % (cfg.handler, total, python))
+        results = run(pkg.zip_file, cfg.handler, events, python=python,
+                      layer_zip_file=pkg.layer_zip_file,
+                      function_name=cfg.name, memory=cfg.memory,
+                      timeout=cfg.timeout, warmup=args.warmup,
+                      runtime_path=args.runtime_path)
+    finally:
+        if not args.no_clean:
+            pkg.clean_workspace()
+
+    print('  records/sec: %.1f (%d records in %d invocations)'
+          % (results['records_per_second'], results['records'],
+             results['invocations']))
+    print('  latency:     p50 %.2fms p99 %.2fms, cold %.2fms'
+          % (results['p50_seconds'] * 1000, results['p99_seconds'] * 1000,
+             results['cold_seconds'] * 1000))
+    print('  import:      %.2fms' % (results['import_seconds'] * 1000))
+    print('  peak RSS:    %.1fMB of %dMB'
+          % (results['peak_rss'] / 1048576.0, cfg.memory))
+    if args.bench_json:
+        with open(args.bench_json, 'w') as fil:
+            json.dump(results, fil, indent=2, sort_keys=True)
+    return results
+
+
+def main(arv=None):
+    """lambda-uploader-bench command line interface."""
+    args = _arg_parser().parse_args(arv)
+
+    logging.basicConfig(level=args.loglevel, format=shell.LOG_FORMAT)
+    try:
+        execute(args)
+    except shell.ColdStartBudgetExceeded as ex:
+        shell._print_failure(ex)
+        sys.exit(1)
+    except Exception:
+        shell._print_traceback()
+        sys.exit(1)
+
+
+def _arg_parser():
+    parser = shell._parser(
+            description='Benchmark the handler of a python lambda job')
+    parser.add_argument('function_dir', default=os.getcwd(), nargs='?',
+                        help='lambda function directory')
+    parser.add_argument('--config', '-c', help='Overrides lambda.json',
+                        default='lambda.json')
+    parser.add_argument('--events', default=None,
+                        help='JSON file of recorded events, instead of '
+                             'synthetic Kinesis batches')
+    parser.add_argument('--invocations', type=int,
+                        default=DEFAULT_INVOCATIONS,
+                        help='number of measured invocations')
+    parser.add_argument('--warmup', type=int, default=1,
+                        help='invocations left out of the statistics')
+    parser.add_argument('--batch-size', dest='batch_size', type=int,
+                        help='records per synthetic Kinesis event, defaults '
+                             'to the batch_size of the subscription')
+    parser.add_argument('--record-size', dest='record_size', type=int,
+                        default=DEFAULT_RECORD_SIZE,
+                        help='bytes of data in each synthetic record')
+    parser.add_argument('--bench-json', dest='bench_json', default=None,
+                        help='write the results as JSON to this file')
+    return parser
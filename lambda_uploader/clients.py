@@ -0,0 +1,100 @@
+# Copyright 2015-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import boto3
+import json
+import logging
+import threading
+
+from botocore.config import Config
+
+LOG = logging.getLogger(__name__)
+# Enough connections for a multipart upload and a batch of functions
+# sharing a client, botocore only keeps 10 by default
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+
+_LOCK = threading.Lock()
+_SESSIONS = {}
+_CLIENTS = {}
+
+
+def session(profile_name=None):
+    '''Returns the shared boto3 session of a profile'''
+    with _LOCK:
+        return _session(profile_name)
+
+
+def client(service, region, profile_name=None, settings=None, retries=True):
+    '''
+    Returns the shared client of a service for a profile and region.
+
+    settings are the aws_client settings of the configuration: the botocore
+    max_pool_connections, retry_mode, max_attempts, connect_timeout and
+    read_timeout and endpoint_urls, the endpoint of each service that is not
+    talking to AWS itself. Clients are thread safe, so everything deploying
+    to the same profile and region shares one connection pool.
+
+    Without retries botocore makes every call once, for clients wrapped in
+    a retry.RetryingClient, which retries them itself.
+    '''
+    settings = settings or {}
+    key = (service, region, profile_name,
+           json.dumps(settings, sort_keys=True), retries)
+    # Sessions are not thread safe, so clients are created under the lock
+    with _LOCK:
+        if key not in _CLIENTS:
+            LOG.debug('Creating %s client for %s' % (service, region))
+            _CLIENTS[key] = _session(profile_name).client(
+                service, region_name=region,
+                endpoint_url=settings.get('endpoint_urls', {}).get(service),
+                config=client_config(settings, retries))
+        return _CLIENTS[key]
+
+
+def client_config(settings, retries=True):
+    '''
+    Returns the botocore Config for the aws_client settings. Without
+    retries the retry settings are ignored and botocore never retries.
+    '''
+    kwargs = {'max_pool_connections': settings.get(
+        'max_pool_connections', DEFAULT_MAX_POOL_CONNECTIONS)}
+    for key in ('connect_timeout', 'read_timeout'):
+        if settings.get(key) is not None:
+            kwargs[key] = settings[key]
+    if not retries:
+        # standard, since adaptive would also rate limit on its own
+        kwargs['retries'] = {'mode': 'standard', 'max_attempts': 0}
+        return Config(**kwargs)
+    botocore_retries = {}
+    if settings.get('retry_mode'):
+        botocore_retries['mode'] = settings['retry_mode']
+    if settings.get('max_attempts') is not None:
+        botocore_retries['max_attempts'] = settings['max_attempts']
+    if botocore_retries:
+        kwargs['retries'] = botocore_retries
+    return Config(**kwargs)
+
+
+def clear():
+    '''Forgets all sessions and clients'''
+    with _LOCK:
+        _SESSIONS.clear()
+        _CLIENTS.clear()
+
+
+def _session(profile_name):
+    if profile_name not in _SESSIONS:
+        _SESSIONS[profile_name] = boto3.session.Session(
+            profile_name=profile_name)
+    return _SESSIONS[profile_name]
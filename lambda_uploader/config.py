@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
 import json
 from datetime import datetime
 from os import path
@@ -29,13 +30,62 @@ REQUIRED_VPC_PARAMS = {u'subnets': list, u'security_groups': list}
 REQUIRED_KINESIS_SUBSCRIPTION_PARAMS = {u'stream': basestring,
                                         u'batch_size': int,
                                         u'starting_position': basestring}
+REQUIRED_DYNAMODB_SUBSCRIPTION_PARAMS = REQUIRED_KINESIS_SUBSCRIPTION_PARAMS
+REQUIRED_SQS_SUBSCRIPTION_PARAMS = {u'queue': basestring, u'batch_size': int}
+# Event source mapping settings: type, minimum and maximum
+SUBSCRIPTION_SETTINGS = {
+    u'parallelization_factor': (int, 1, 10),
+    u'maximum_batching_window_in_seconds': (int, 0, 300),
+    u'bisect_batch_on_function_error': (bool, None, None),
+    u'maximum_record_age_in_seconds': (int, -1, 604800),
+    u'tumbling_window_in_seconds': (int, 0, 900),
+    u'function_response_types': (list, None, None),
+    u'maximum_concurrency': (int, 2, 1000)}
+STREAM_SUBSCRIPTION_SETTINGS = [u'parallelization_factor',
+                                u'maximum_batching_window_in_seconds',
+                                u'bisect_batch_on_function_error',
+                                u'maximum_record_age_in_seconds',
+                                u'tumbling_window_in_seconds',
+                                u'function_response_types']
+SQS_SUBSCRIPTION_SETTINGS = [u'maximum_batching_window_in_seconds',
+                             u'function_response_types',
+                             u'maximum_concurrency']
+FUNCTION_RESPONSE_TYPES = ['ReportBatchItemFailures']
+# The event source of each type of subscription
+SUBSCRIPTION_SOURCES = {u'kinesis': u'stream', u'dynamodb': u'stream',
+                        u'sqs': u'queue'}
 REQUIRED_TRACING_MODES = ['Active', 'PassThrough']
+# Settings of the S3 transfer, as boto3 TransferConfig takes them
+S3_TRANSFER_PARAMS = {u'multipart_threshold': int,
+                      u'multipart_chunksize': int,
+                      u'max_concurrency': int,
+                      u'max_bandwidth': int}
+# Settings of the boto3 clients, see clients.client
+AWS_CLIENT_PARAMS = {u'max_pool_connections': int,
+                     u'retry_mode': basestring,
+                     u'max_attempts': int,
+                     u'connect_timeout': (int, float),
+                     u'read_timeout': (int, float),
+                     u'endpoint_urls': dict}
+RETRY_MODES = ['legacy', 'standard', 'adaptive']
+# Settings a region in the regions list may override
+REGION_OVERRIDE_PARAMS = {u's3_bucket': basestring, u's3_key': basestring,
+                          u's3_prefix': basestring,
+                          u'vpc': dict, u'role': basestring,
+                          u'variables': dict, u'subscription': dict,
+                          u'subscriptions': list}
 
 DEFAULT_PARAMS = {u'requirements': [], u'publish': False,
                   u'alias': None, u'alias_description': None,
                   u'ignore': [], u'extra_files': [], u'vpc': None,
                   u's3_bucket': None, u's3_key': None, u'runtime': 'python2.7',
-                  u'variables': {}, u'subscription': {}, u'tracing': {}}
+                  u'variables': {}, u'subscription': {}, u'tracing': {},
+                  u'wheelhouse': None, u'reproducible': False,
+                  u'slim': False, u'slim_ignore': [], u'layer': None,
+                  u's3_transfer': {}, u'regions': [], u'aws_client': {},
+                  u's3_content_addressed': False, u's3_prefix': None,
+                  u'retain_versions': None, u'subscriptions': None,
+                  u'cold_start_budget': None}
 
 
 class Config(object):
@@ -48,16 +98,37 @@ class Config(object):
         if variables is not None:
             self._config['variables'] = json.loads(variables)
         self._set_defaults()
+        if self._config['regions']:
+            self._validate_regions()
+            self._config.setdefault('region', self.region_names[0])
         if self._config['vpc']:
             self._validate_vpc()
         if self._config['subscription']:
             self._validate_subscription()
+        if self._config['subscriptions'] is not None:
+            self._validate_subscriptions()
         if self._config['tracing']:
             self._validate_tracing()
+        if self._config['layer'] is not None:
+            self._compare('layer', (bool, basestring), self._config['layer'])
+        if self._config['s3_transfer']:
+            self._validate_s3_transfer()
+        if self._config['aws_client']:
+            self._validate_aws_client()
+        if self._config['retain_versions'] is not None:
+            self.set_retain_versions(self._config['retain_versions'])
+        if self._config['cold_start_budget'] is not None:
+            self.set_cold_start_budget(self._config['cold_start_budget'])
 
         for param, clss in REQUIRED_PARAMS.items():
             self._validate(param, cls=clss)
 
+        # Validate the merged settings of every region now, a bad override
+        # must not fail after other regions have been deployed
+        if self._config['regions']:
+            for region in self.region_names:
+                self.for_region(region)
+
     '''
     Return raw config
     '''
@@ -79,6 +150,58 @@ class Config(object):
         else:
             return self._config['alias_description']
 
+    '''
+    Return the names of all regions the function is deployed to
+    '''
+    @property
+    def region_names(self):
+        if not self._config['regions']:
+            return [self._config['region']]
+        return [_region_name(r) for r in self._config['regions']]
+
+    '''
+    Return a copy of the config for one of the regions, with the overrides
+    of that region applied
+    '''
+    def for_region(self, region):
+        overrides = {}
+        for entry in self._config['regions']:
+            if isinstance(entry, dict) and entry['region'] == region:
+                overrides = dict(entry)
+                del overrides['region']
+
+        cfg = Config.__new__(Config)
+        cfg._path = self._path
+        cfg._config = copy.deepcopy(self._config)
+        cfg._config['region'] = region
+        cfg._config.update(copy.deepcopy(overrides))
+        if cfg._config['vpc']:
+            cfg._validate_vpc()
+        if cfg._config['subscription']:
+            cfg._validate_subscription()
+        if cfg._config['subscriptions'] is not None:
+            cfg._validate_subscriptions()
+        return cfg
+
+    '''
+    Return the name of the layer the dependencies are published to, or None
+    if they are packaged with the function
+    '''
+    @property
+    def layer_name(self):
+        if not self._config['layer']:
+            return None
+        if self._config['layer'] is True:
+            return self._config['name'] + '-dependencies'
+        return self._config['layer']
+
+    '''Publish the dependencies as a layer, optionally naming it'''
+    def set_layer(self, name=None):
+        if name:
+            self._config['layer'] = name
+        elif not self._config['layer']:
+            self._config['layer'] = True
+
     '''
     Public method to set the S3 bucket and keyname
     '''
@@ -87,6 +210,37 @@ class Config(object):
         if key:
             self._config['s3_key'] = key
 
+    '''Override S3 transfer settings, ignoring those that are None'''
+    def set_s3_transfer(self, **settings):
+        s3_transfer = dict(self._config['s3_transfer'])
+        for key, value in settings.items():
+            if value is not None:
+                s3_transfer[key] = value
+        self._config['s3_transfer'] = s3_transfer
+        self._validate_s3_transfer()
+
+    '''Store the package in S3 under the SHA-256 of its content'''
+    def set_s3_content_addressed(self, prefix=None):
+        self._config['s3_content_addressed'] = True
+        if prefix:
+            self._config['s3_prefix'] = prefix
+
+    '''Keep only this many published versions besides the aliased ones'''
+    def set_retain_versions(self, count):
+        self._compare('retain_versions', int, count)
+        if count < 0:
+            raise TypeError("Config value 'retain_versions' can not be"
+                            " negative")
+        self._config['retain_versions'] = count
+
+    '''Fail the build when importing the handler takes longer (in ms)'''
+    def set_cold_start_budget(self, milliseconds):
+        self._compare('cold_start_budget', (int, float), milliseconds)
+        if milliseconds <= 0:
+            raise TypeError("Config value 'cold_start_budget' must be"
+                            " greater than 0")
+        self._config['cold_start_budget'] = milliseconds
+
     '''Set the publish attr to true'''
     def set_publish(self):
         self._config['publish'] = True
@@ -139,11 +293,60 @@ class Config(object):
             raise TypeError("Tracing Config Mode must be one of {}".format(
                 ', '.join(REQUIRED_TRACING_MODES)))
 
+    '''Validate the boto3 client configuration'''
+    def _validate_aws_client(self):
+        for key, value in self._config['aws_client'].items():
+            if key not in AWS_CLIENT_PARAMS:
+                raise TypeError("AWS client Config can only contain %s"
+                                % ', '.join(sorted(AWS_CLIENT_PARAMS)))
+            self._compare(key, AWS_CLIENT_PARAMS[key], value)
+        retry_mode = self._config['aws_client'].get('retry_mode')
+        if retry_mode is not None and retry_mode not in RETRY_MODES:
+            raise TypeError("AWS client Config retry_mode must be one of {}"
+                            .format(', '.join(RETRY_MODES)))
+        endpoint_urls = self._config['aws_client'].get('endpoint_urls', {})
+        for service, url in endpoint_urls.items():
+            if not isinstance(url, basestring):
+                raise TypeError("AWS client Config endpoint_urls must map "
+                                "service names to URLs, %s is %s"
+                                % (service, type(url)))
+
+    '''Validate the regions list and the overrides of each region'''
+    def _validate_regions(self):
+        self._compare('regions', list, self._config['regions'])
+        for entry in self._config['regions']:
+            if isinstance(entry, dict):
+                self._compare('region', basestring, entry.get('region'))
+                for key, value in entry.items():
+                    if key == 'region':
+                        continue
+                    if key not in REGION_OVERRIDE_PARAMS:
+                        raise TypeError("Region Config can only override %s"
+                                        % ', '.join(
+                                            sorted(REGION_OVERRIDE_PARAMS)))
+                    self._compare(key, REGION_OVERRIDE_PARAMS[key], value)
+            else:
+                self._compare('regions', basestring, entry)
+
+    '''Validate the S3 transfer configuration'''
+    def _validate_s3_transfer(self):
+        for key, value in self._config['s3_transfer'].items():
+            if key not in S3_TRANSFER_PARAMS:
+                raise TypeError("S3 transfer Config can only contain %s"
+                                % ', '.join(sorted(S3_TRANSFER_PARAMS)))
+            self._compare(key, S3_TRANSFER_PARAMS[key], value)
+            if value <= 0:
+                raise TypeError("S3 transfer Config '%s' must be greater"
+                                " than 0" % key)
+
     '''Validate the subscription configuration.
     All kinds of subscription will be validated here'''
-    def _validate_subscription(self):
+    def _validate_subscription(self, subscription=None):
+        if subscription is None:
+            subscription = self._config['subscription']
+
         def validate_kinesis():
-            ksub = self._config['subscription']['kinesis']
+            ksub = subscription['kinesis']
             for param, clss in REQUIRED_KINESIS_SUBSCRIPTION_PARAMS.items():
                 self._compare(param, clss, ksub.get(param))
 
@@ -164,9 +367,85 @@ class Config(object):
                         raise TypeError("Starting position timestamp"
                                         " must have format "
                                         " YYYY-mm-ddTHH:MM:SSZ")
-
-        if 'kinesis' in self._config['subscription']:
+            validate_settings('Kinesis', ksub, STREAM_SUBSCRIPTION_SETTINGS)
+
+        def validate_dynamodb():
+            dsub = subscription['dynamodb']
+            for param, clss in REQUIRED_DYNAMODB_SUBSCRIPTION_PARAMS.items():
+                self._compare(param, clss, dsub.get(param))
+            if dsub['batch_size'] <= 0:
+                raise TypeError("Batch size in DynamoDB subscription must"
+                                " be greater than 0")
+            valid_starting_pos = ['TRIM_HORIZON', 'LATEST']
+            if dsub['starting_position'] not in valid_starting_pos:
+                raise TypeError("Starting position in DynamoDB"
+                                " must be one of %s" % valid_starting_pos)
+            validate_settings('DynamoDB', dsub, STREAM_SUBSCRIPTION_SETTINGS)
+
+        def validate_sqs():
+            ssub = subscription['sqs']
+            for param, clss in REQUIRED_SQS_SUBSCRIPTION_PARAMS.items():
+                self._compare(param, clss, ssub.get(param))
+            if ssub['batch_size'] <= 0:
+                raise TypeError("Batch size in SQS subscription must"
+                                " be greater than 0")
+            validate_settings('SQS', ssub, SQS_SUBSCRIPTION_SETTINGS)
+
+        def validate_settings(kind, sub, supported):
+            for param, (clss, low, high) in SUBSCRIPTION_SETTINGS.items():
+                value = sub.get(param)
+                if value is None:
+                    continue
+                if param not in supported:
+                    raise TypeError("'%s' is not supported by %s"
+                                    " subscriptions" % (param, kind))
+                self._compare(param, clss, value)
+                if low is not None and not low <= value <= high:
+                    raise TypeError("'%s' in %s subscription must be"
+                                    " between %d and %d"
+                                    % (param, kind, low, high))
+            # -1 keeps records until they expire from the stream
+            age = sub.get('maximum_record_age_in_seconds')
+            if age is not None and 0 <= age < 60:
+                raise TypeError("'maximum_record_age_in_seconds' in %s"
+                                " subscription must be -1 or at least 60"
+                                % kind)
+            for response_type in sub.get('function_response_types') or []:
+                if response_type not in FUNCTION_RESPONSE_TYPES:
+                    raise TypeError("Function response types in %s"
+                                    " subscription must be in %s"
+                                    % (kind, FUNCTION_RESPONSE_TYPES))
+
+        if 'kinesis' in subscription:
             validate_kinesis()
+        if 'dynamodb' in subscription:
+            validate_dynamodb()
+        if 'sqs' in subscription:
+            validate_sqs()
+
+    '''Validate the declarative list of subscriptions'''
+    def _validate_subscriptions(self):
+        self._compare('subscriptions', list, self._config['subscriptions'])
+        if self._config['subscription']:
+            raise TypeError("Config can not set both 'subscription' and"
+                            " 'subscriptions'")
+        sources = set()
+        for entry in self._config['subscriptions']:
+            self._compare('subscriptions', dict, entry)
+            kind = entry.get('type')
+            if kind not in SUBSCRIPTION_SOURCES:
+                raise TypeError("Subscription type must be one of %s"
+                                % ', '.join(sorted(SUBSCRIPTION_SOURCES)))
+            if entry.get('enabled') is not None:
+                self._compare('enabled', bool, entry['enabled'])
+            settings = dict((k, v) for k, v in entry.items()
+                            if k not in ('type', 'enabled'))
+            self._validate_subscription({kind: settings})
+            source = entry[SUBSCRIPTION_SOURCES[kind]]
+            if source in sources:
+                raise TypeError("Subscription to %s is listed twice"
+                                % source)
+            sources.add(source)
 
     '''Compare if a string is a certain type'''
     def _compare(self, key, cls, value):
@@ -175,6 +454,10 @@ class Config(object):
                 raise TypeError("Config value '%s' should be %s not %s"
                                 % (key, cls, type(value)))
 
+    def s3_content_key(self, sha256):
+        prefix = self._config.get('s3_prefix') or self.name
+        return '%s/%s.zip' % (prefix.rstrip('/'), sha256)
+
     def s3_package_name(self):
         if self._config.get('s3_key'):
             return self.s3_key
@@ -199,3 +482,10 @@ class Config(object):
             return self._config[key]
         else:
             return object.__getattribute__(self, key)
+
+
+def _region_name(entry):
+    '''Return the name of an entry of the regions list'''
+    if isinstance(entry, dict):
+        return entry['region']
+    return entry
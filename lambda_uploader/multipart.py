@@ -0,0 +1,116 @@
+# Copyright 2015-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import logging
+
+from multiprocessing.pool import ThreadPool
+
+LOG = logging.getLogger(__name__)
+# S3 rejects smaller parts, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class MultipartUpload(object):
+    '''
+    A write only stream into an S3 object.
+
+    Written bytes are cut into parts that are uploaded by a pool of worker
+    threads while more bytes are being written, so the object is mostly
+    uploaded by the time the stream is closed. At most workers parts are
+    held in memory. The multipart upload is only started by the first write
+    and is completed by close() or aborted by abort().
+    '''
+    def __init__(self, client, bucket, key, part_size=MIN_PART_SIZE,
+                 workers=1):
+        self.bucket = bucket
+        self.key = key
+        self.size = 0
+        self._client = client
+        self._part_size = max(part_size, MIN_PART_SIZE)
+        self._workers = max(1, workers)
+        self._buffer = []
+        self._buffered = 0
+        self._upload_id = None
+        self._pool = None
+        self._pending = collections.deque()
+        self._parts = []
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.size += len(data)
+        if self._buffered >= self._part_size:
+            self._send_part()
+
+    def close(self):
+        '''Uploads the last part and completes the object'''
+        if self._buffered or self._upload_id is None:
+            self._send_part()
+        try:
+            while self._pending:
+                self._parts.append(self._pending.popleft().get())
+        except Exception:
+            self.abort()
+            raise
+        self._close_pool()
+
+        LOG.debug('Completing multipart upload of s3://%s/%s in %d parts'
+                  % (self.bucket, self.key, len(self._parts)))
+        self._client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            MultipartUpload={'Parts': self._parts})
+
+    def abort(self):
+        '''Discards the parts uploaded so far'''
+        self._close_pool()
+        if self._upload_id is not None:
+            LOG.debug('Aborting multipart upload of s3://%s/%s'
+                      % (self.bucket, self.key))
+            self._client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            self._upload_id = None
+
+    def _send_part(self):
+        if self._upload_id is None:
+            resp = self._client.create_multipart_upload(Bucket=self.bucket,
+                                                        Key=self.key)
+            self._upload_id = resp['UploadId']
+            self._pool = ThreadPool(self._workers)
+
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+
+        # Wait for the oldest part first so memory use stays bounded
+        if len(self._pending) >= self._workers:
+            self._parts.append(self._pending.popleft().get())
+        number = len(self._parts) + len(self._pending) + 1
+        self._pending.append(self._pool.apply_async(self._upload_part,
+                                                    (number, data)))
+
+    def _upload_part(self, number, data):
+        LOG.debug('Uploading part %d of s3://%s/%s (%d bytes)'
+                  % (number, self.bucket, self.key, len(data)))
+        resp = self._client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            PartNumber=number, Body=data)
+        return {'ETag': resp['ETag'], 'PartNumber': number}
+
+    def _close_pool(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        self._pending.clear()
@@ -12,17 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import glob
+import hashlib
 import os
+import platform
 import shutil
-import zipfile
 import logging
 import sys
 import re
+import tempfile
 
 from subprocess import Popen, PIPE
-from lambda_uploader import utils
-from distutils.spawn import find_executable
+from lambda_uploader import archive, utils
+from lambda_uploader.report import Report
 
 # Python 2/3 compatibility
 try:
@@ -30,37 +33,106 @@ try:
 except NameError:
     basestring = str
 
+# distutils is slow to import and gone from newer Pythons
+try:
+    from shutil import which as find_executable
+except ImportError:
+    from distutils.spawn import find_executable
+
 
 LOG = logging.getLogger(__name__)
 TEMP_WORKSPACE_NAME = ".lambda_uploader_temp"
 ZIPFILE_NAME = 'lambda_function.zip'
+LAYER_ZIPFILE_NAME = 'lambda_layer.zip'
+# Lambda adds the python directory of a layer to sys.path
+LAYER_PREFIX = 'python'
+# -r and -c lines that include another requirements or constraints file
+REQUIREMENT_INCLUDE = re.compile(
+    r'^(-r|--requirement|-c|--constraint)(?:\s+|=)?(\S+)$')
+# A requirement pinned to one exact version, with optional extras and marker
+PINNED_REQUIREMENT = re.compile(
+    r'^([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*===?\s*[^\s,;*]+'
+    r'\s*(;.*)?$')
+REQUIREMENT_NAME = re.compile(r'^([A-Za-z0-9][A-Za-z0-9._-]*)')
+# Requirements installed from a local path, -e ./lib, ../pkg or file: URLs
+LOCAL_REQUIREMENT = re.compile(
+    r'^((-e|--editable)(\s+|=))?(\.|/|~|[A-Za-z]:[\\/]|file:)|@\s*file:')
+# Bump when a change to the packaging logic should invalidate cached builds
+BUILD_CACHE_VERSION = '1'
+# Files in site packages that are not needed to run a function on Lambda
+SLIM_IGNORE = [
+    r'(^|/)__pycache__/',
+    r'\.py[co]$',
+    r'^[^/]+\.(dist|egg)-info/',
+    r'^[^/]+/(.*/)?tests?/',
+    r'\.pyi$',
+    r'\.h(pp)?$',
+    # Provided by the Lambda Python runtimes
+    r'^(boto3|botocore)/',
+]
 
 
 def build_package(path, requires, virtualenv=None, ignore=None,
                   extra_files=None, zipfile_name=ZIPFILE_NAME,
-                  pyexec=None):
+                  pyexec=None, cache_dir=None, direct=False,
+                  zip_workers=1, wheel_cache=None, wheelhouse=None,
+                  reproducible=False, slim=False, slim_ignore=None,
+                  layer=False, shared_venv=None, report=None,
+                  zip_stream=None):
     '''Builds the zip file and creates the package with it'''
-    pkg = Package(path, zipfile_name, pyexec)
+    pkg = Package(path, zipfile_name, pyexec, cache_dir=cache_dir,
+                  direct=direct, zip_workers=zip_workers,
+                  wheel_cache=wheel_cache, wheelhouse=wheelhouse,
+                  reproducible=reproducible, slim=slim,
+                  slim_ignore=slim_ignore, layer=layer, report=report,
+                  zip_stream=zip_stream)
 
     if extra_files:
         for fil in extra_files:
             pkg.extra_file(fil)
     if virtualenv is not None:
         pkg.virtualenv(virtualenv)
+    if shared_venv is not None:
+        pkg.shared_virtualenv(shared_venv)
     pkg.requirements(requires)
     pkg.build(ignore)
 
     return pkg
 
 
-def create_package(path, zipfile_name=ZIPFILE_NAME):
+def create_package(path, zipfile_name=ZIPFILE_NAME, layer=False):
     '''Creates the package with already existing zip file'''
-    pkg = Package(path, zipfile_name)
+    pkg = Package(path, zipfile_name, layer=layer)
     return pkg
 
 
+def python_executable(pyexec=None):
+    '''
+    Returns the path of the pyexec executable, the runtime (python3.12) of
+    the function, or of python2 or python when there is none
+    '''
+    if pyexec is not None:
+        python_exe = find_executable(pyexec)
+        if not python_exe:
+            raise Exception('Unable to locate {} executable'
+                            .format(pyexec))
+    else:
+        python_exe = find_executable('python2')
+        if not python_exe:
+            python_exe = find_executable('python')
+
+        if not python_exe:
+            raise Exception('Unable to locate python executable')
+
+    return python_exe
+
+
 class Package(object):
-    def __init__(self, path, zipfile_name=ZIPFILE_NAME, pyexec=None):
+    def __init__(self, path, zipfile_name=ZIPFILE_NAME, pyexec=None,
+                 cache_dir=None, direct=False, zip_workers=1,
+                 wheel_cache=None, wheelhouse=None, reproducible=False,
+                 slim=False, slim_ignore=None, layer=False, report=None,
+                 zip_stream=None):
         self._path = path
         self._temp_workspace = os.path.join(path,
                                             TEMP_WORKSPACE_NAME)
@@ -72,13 +144,250 @@ class Package(object):
         self._pyexec = pyexec
         self._requirements_file = os.path.join(self._path, "requirements.txt")
         self._extra_files = []
+        self._cache_dir = cache_dir
+        self._direct = direct
+        self._zip_workers = zip_workers
+        self._wheel_cache = wheel_cache
+        self._wheelhouse = wheelhouse
+        self._reproducible = reproducible
+        self._slim = slim
+        self._slim_ignore = slim_ignore or []
+        self._layer = layer
+        self._shared_venv = None
+        self._report = report or Report()
+        self._zip_stream = zip_stream
+        self.s3_object = None
+        self.cache_hit = False
+        self.slim_report = None
+        self.layer_zip_file = None
+        self.layer_hash = None
+        if layer:
+            self.layer_zip_file = os.path.join(path, LAYER_ZIPFILE_NAME)
 
     def build(self, ignore=None):
         '''Calls all necessary methods to build the Lambda Package'''
-        self._prepare_workspace()
-        self.install_dependencies()
+        # Compile the ignore patterns once for the whole build
+        ignore = utils.IgnoreMatcher(ignore)
+        cache_file = None
+        if self._cache_dir is not None:
+            with self._report.phase('build key'):
+                cache_file = self._cache_file(ignore)
+        cached = cache_file is not None and os.path.isfile(cache_file)
+
+        layer_cached = False
+        if self._layer:
+            self.layer_hash = self._cache_requirements_key()
+            layer_cached = self._use_cached_layer()
+
+        if cached and (layer_cached or not self._layer):
+            LOG.info('Build cache hit, using %s' % cache_file)
+            shutil.copy(cache_file, self.zip_file)
+            self.cache_hit = True
+            return
+
+        with self._report.phase('prepare workspace'):
+            self._prepare_workspace()
+        if not layer_cached:
+            self.install_dependencies()
+        if self._layer and not layer_cached:
+            with self._report.phase('layer zip'):
+                self._create_layer_zip()
+
+        if cached:
+            LOG.info('Build cache hit, using %s' % cache_file)
+            shutil.copy(cache_file, self.zip_file)
+            self.cache_hit = True
+            return
+
         self.package(ignore)
 
+        if cache_file is not None:
+            with self._report.phase('store cache'):
+                self._store_cache(cache_file)
+
+    def requirements_key(self):
+        '''
+        Returns a digest of everything that goes into the site packages: the
+        runtime, the requirements (including the files they include with -r
+        and -c) and the slim settings. Returns None if an existing
+        virtualenv is used.
+        '''
+        if self._virtualenv is not None:
+            return None
+
+        sha = hashlib.sha256()
+        header = '\0'.join([BUILD_CACHE_VERSION, str(self._pyexec),
+                            str(self._skip_virtualenv), str(self._slim)]
+                           + list(self._slim_ignore))
+        sha.update(header.encode('utf-8'))
+        if not self._skip_virtualenv:
+            if self._requirements:
+                sha.update('\n'.join(self._requirements).encode('utf-8'))
+            for pth in self._parse_requirements()[2]:
+                utils.hash_file(sha, pth, os.path.basename(pth))
+        return sha.hexdigest()
+
+    def _cache_requirements_key(self):
+        '''
+        Returns requirements_key when every requirement is pinned to one
+        version. Unpinned requirements resolve to whatever is newest when
+        they are installed, so a cached build could go stale without its key
+        changing; they return None and the cache is not used.
+        '''
+        requirements, constraints, _ = self._parse_requirements()
+        unpinned = _unpinned(requirements, constraints)
+        if unpinned:
+            LOG.info('Build cache is not used, these requirements are not '
+                     'pinned with ==: %s' % ', '.join(unpinned))
+            return None
+        return self.requirements_key()
+
+    def has_local_requirements(self):
+        '''
+        Returns whether a requirement is installed from a local path, which
+        resolves differently for every function directory
+        '''
+        requirements, constraints, _ = self._parse_requirements()
+        return any(LOCAL_REQUIREMENT.search(line)
+                   for line in requirements + constraints)
+
+    def _parse_requirements(self):
+        '''
+        Returns the requirement lines, the constraint lines and the
+        requirements files read, following -r and -c includes
+        '''
+        parsed = ([], [], [])
+        if self._skip_virtualenv or self._virtualenv is not None:
+            return parsed
+        if self._requirements:
+            _parse_requirement_lines(self._requirements, self._path, parsed)
+        elif _isfile(self._requirements_file):
+            _parse_requirements_file(self._requirements_file, parsed)
+        return parsed
+
+    def build_key(self, ignore=None):
+        '''
+        Returns a digest of everything that goes into the package: the
+        runtime, the requirements, the source tree after the ignore rules are
+        applied and the extra files. Returns None if the package can not be
+        keyed, which is the case when an existing virtualenv is used or a
+        requirement is not pinned to one version.
+        '''
+        if self._virtualenv is not None:
+            return None
+
+        ignore = utils.ignore_matcher(ignore).copy()
+        self._ignore_outputs(ignore)
+
+        sha = hashlib.sha256()
+        requirements_key = self._cache_requirements_key()
+        if requirements_key is None:
+            return None
+        header = '\0'.join([requirements_key, str(self._reproducible),
+                            str(self._layer)])
+        sha.update(header.encode('utf-8'))
+        sha.update(b'\0')
+
+        utils.hash_tree(sha, self._path, ignore)
+
+        for p in self._extra_files:
+            sha.update(b'extra\0')
+            if os.path.isdir(p):
+                extra_ignore = ignore.copy()
+                extra_ignore.add(re.escape(p))
+                utils.hash_tree(sha, p, extra_ignore)
+            else:
+                utils.hash_file(sha, p)
+
+        return sha.hexdigest()
+
+    def _cache_file(self, ignore):
+        '''Returns the path of the cached zip for this build, if any'''
+        key = self.build_key(ignore)
+        if key is None:
+            if self._virtualenv is not None:
+                LOG.info('Build cache is not used with an existing '
+                         'virtualenv')
+            return None
+        return os.path.join(self._cache_dir, '%s.zip' % key)
+
+    def _store_cache(self, cache_file, zip_file=None):
+        '''Copies the freshly built zip into the build cache'''
+        if not os.path.isdir(self._cache_dir):
+            os.makedirs(self._cache_dir)
+        # Copy then rename so concurrent builds never see a partial zip.
+        # Batch builds are threads of one process, each needs its own file.
+        fd, tmp_file = tempfile.mkstemp(suffix='.tmp', dir=self._cache_dir)
+        os.close(fd)
+        shutil.copy(zip_file or self.zip_file, tmp_file)
+        os.rename(tmp_file, cache_file)
+        LOG.info('Stored package in build cache as %s' % cache_file)
+
+    def _layer_cache_file(self):
+        if self._cache_dir is None or self.layer_hash is None:
+            return None
+        return os.path.join(self._cache_dir, 'layer-%s.zip' % self.layer_hash)
+
+    def _use_cached_layer(self):
+        '''Copies the cached layer zip into place if there is one'''
+        cache_file = self._layer_cache_file()
+        if cache_file is None or not os.path.isfile(cache_file):
+            return False
+        LOG.info('Layer cache hit, using %s' % cache_file)
+        shutil.copy(cache_file, self.layer_zip_file)
+        return True
+
+    def _create_layer_zip(self):
+        '''
+        Zips the site packages under the python/ prefix Lambda layers use
+        and stores the result in the build cache when the requirements are
+        pinned. The layer is always written reproducibly so identical
+        dependencies give an identical layer.
+        Without site packages there is no layer and layer_zip_file is None.
+        '''
+        LOG.info('Creating layer zipfile')
+        entries = []
+        slim = self._slim_matcher()
+        for site_packages in self._site_packages():
+            if slim is not None:
+                files = self._slim_site_packages(
+                    site_packages, slim, self._stripped_copy)
+            else:
+                files = collections.OrderedDict(
+                    (relpath, path) for path, relpath
+                    in utils.walk_tree(site_packages))
+            for relpath, path in files.items():
+                entries.append((path, os.path.join(LAYER_PREFIX, relpath)))
+
+        if not entries:
+            # Nothing to publish, the function keeps its current layers
+            LOG.info('No site packages, not creating a layer')
+            if os.path.isfile(self.layer_zip_file):
+                os.remove(self.layer_zip_file)
+            self.layer_zip_file = None
+            return
+
+        zw = archive.ZipWriter(self.layer_zip_file, self._zip_workers,
+                               reproducible=True)
+        try:
+            zw.write_all(entries)
+        finally:
+            zw.close()
+        self._report.add(len(entries), os.path.getsize(self.layer_zip_file))
+
+        if self.layer_hash is None:
+            # Without a requirements key the content identifies the layer.
+            # The cache is looked up by requirements key, so it is not
+            # stored.
+            sha = hashlib.sha256()
+            utils.hash_file(sha, self.layer_zip_file, LAYER_ZIPFILE_NAME)
+            self.layer_hash = sha.hexdigest()
+            return
+
+        cache_file = self._layer_cache_file()
+        if cache_file is not None:
+            self._store_cache(cache_file, self.layer_zip_file)
+
     def clean_workspace(self):
         '''Clean up the temporary workspace if one exists'''
         if os.path.isdir(self._temp_workspace):
@@ -86,8 +395,9 @@ class Package(object):
 
     def clean_zipfile(self):
         '''remove existing zipfile'''
-        if os.path.isfile(self.zip_file):
-            os.remove(self.zip_file)
+        for zip_file in [self.zip_file, self.layer_zip_file]:
+            if zip_file is not None and os.path.isfile(zip_file):
+                os.remove(zip_file)
 
     def requirements(self, requires):
         '''
@@ -132,6 +442,19 @@ class Package(object):
             self._pkg_venv = self._virtualenv
             self._skip_virtualenv = True
 
+    @property
+    def venv_dir(self):
+        '''The virtualenv the package was built from, if any'''
+        return getattr(self, '_pkg_venv', None) or None
+
+    def shared_virtualenv(self, venv):
+        '''
+        Uses a virtualenv that another package built from the same
+        requirements instead of installing them again. Unlike an existing
+        virtualenv this does not change the build cache key.
+        '''
+        self._shared_venv = venv
+
     def extra_file(self, element):
         '''
         Sets an additional file or path that we copy into the resulting package
@@ -145,11 +468,18 @@ class Package(object):
             LOG.info('Skip Virtualenv set ... nothing to do')
             return
 
+        if self._shared_venv is not None:
+            LOG.info('Using shared virtualenv at %s' % self._shared_venv)
+            self._pkg_venv = self._shared_venv
+            return
+
         has_reqs = _isfile(self._requirements_file) or self._requirements
         if self._virtualenv is None and has_reqs:
             LOG.info('Building new virtualenv and installing requirements')
-            self._build_new_virtualenv()
-            self._install_requirements()
+            with self._report.phase('virtualenv'):
+                self._build_new_virtualenv()
+            with self._report.phase('install requirements'):
+                self._install_requirements()
         elif self._virtualenv is None and not has_reqs:
             LOG.info('No requirements found, so no virtualenv will be made')
             self._pkg_venv = False
@@ -189,20 +519,7 @@ class Package(object):
             raise Exception('cannot build a new virtualenv when asked to omit')
 
     def _python_executable(self):
-        if self._pyexec is not None:
-            python_exe = find_executable(self._pyexec)
-            if not python_exe:
-                raise Exception('Unable to locate {} executable'
-                                .format(self._pyexec))
-        else:
-            python_exe = find_executable('python2')
-            if not python_exe:
-                python_exe = find_executable('python')
-
-            if not python_exe:
-                raise Exception('Unable to locate python executable')
-
-        return python_exe
+        return python_executable(self._pyexec)
 
     def _install_requirements(self):
         '''
@@ -213,28 +530,62 @@ class Package(object):
             err = 'Must call build_new_virtualenv before install_requirements'
             raise Exception(err)
 
-        cmd = None
+        req_args = None
         if self._requirements:
             LOG.debug("Installing requirements found %s in config"
                       % self._requirements)
-            cmd = [os.path.join(self._pkg_venv, self._venv_pip),
-                   'install'] + self._requirements
+            req_args = self._requirements
 
         elif _isfile(self._requirements_file):
             # Pip install
             LOG.debug("Installing requirements from requirements.txt file")
-            cmd = [os.path.join(self._pkg_venv, self._venv_pip),
-                   "install", "-r",
-                   self._requirements_file]
+            req_args = ["-r", self._requirements_file]
+
+        if req_args is None:
+            return
 
-        if cmd is not None:
-            prc = Popen(cmd, stdout=PIPE, stderr=PIPE)
-            stdout, stderr = prc.communicate()
-            LOG.debug("Pip stdout: %s" % stdout)
-            LOG.debug("Pip stderr: %s" % stderr)
+        pip = os.path.join(self._pkg_venv, self._venv_pip)
+        if self._wheelhouse:
+            LOG.info('Installing requirements from wheelhouse %s'
+                     % self._wheelhouse)
+            self._run_pip([pip, 'install', '--no-index',
+                           '--find-links', self._wheelhouse] + req_args)
+        elif self._wheel_cache:
+            wheel_dir = self._wheel_cache_dir()
+            offline = [pip, 'install', '--no-index',
+                       '--find-links', wheel_dir] + req_args
+            if self._run_pip(offline, check=False) != 0:
+                LOG.info('Wheel cache miss, building wheels into %s'
+                         % wheel_dir)
+                self._run_pip([pip, 'wheel', '--wheel-dir', wheel_dir,
+                               '--find-links', wheel_dir] + req_args)
+                self._run_pip(offline)
+        else:
+            self._run_pip([pip, 'install'] + req_args)
 
-            if prc.returncode is not 0:
-                raise Exception('pip returned unsuccessfully')
+    def _wheel_cache_dir(self):
+        '''
+        Returns the wheel cache directory for this runtime and platform,
+        creating it if necessary
+        '''
+        key = '%s-%s-%s' % (self._pyexec or 'python', sys.platform,
+                            platform.machine() or 'unknown')
+        wheel_dir = os.path.join(self._wheel_cache, key)
+        if not os.path.isdir(wheel_dir):
+            os.makedirs(wheel_dir)
+        return wheel_dir
+
+    def _run_pip(self, cmd, check=True):
+        '''Runs a pip command, raising if it fails and check is set'''
+        LOG.debug("Running %s" % ' '.join(cmd))
+        prc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = prc.communicate()
+        LOG.debug("Pip stdout: %s" % stdout)
+        LOG.debug("Pip stderr: %s" % stderr)
+
+        if check and prc.returncode != 0:
+            raise Exception('pip returned unsuccessfully')
+        return prc.returncode
 
     def package(self, ignore=None):
         """
@@ -243,14 +594,52 @@ class Package(object):
         :param list ignore: a list of regular expression strings to match paths
             of files in the source of the lambda script against and ignore
             those files when creating the zip file. The paths to be matched are
-            local to the source root.
+            local to the source root. An IgnoreMatcher may be passed instead.
         """
-        ignore = ignore or []
+        ignore = utils.ignore_matcher(ignore).copy()
+        report = self._report
+        if self._direct:
+            with report.phase('manifest'):
+                manifest = self._manifest(ignore)
+                report.add(files=len(manifest))
+            self._create_zip_from_manifest(manifest)
+            return
+
         package = os.path.join(self._temp_workspace, 'lambda_package')
 
         # Copy site packages into package base
         LOG.info('Copying site packages')
+        slim = self._slim_matcher()
+        with report.phase('copy site packages'):
+            for site_packages in self._function_site_packages():
+                report.add(*utils.copy_tree(site_packages, package, slim))
+                if slim is not None:
+                    # Strip the copies, never the files in the virtualenv
+                    self._slim_site_packages(
+                        site_packages, slim,
+                        lambda path, relpath: os.path.join(package, relpath))
+
+        with report.phase('copy source'):
+            # Append the temp workspace and our zips to the ignore list:
+            self._ignore_outputs(ignore)
+            report.add(*utils.copy_tree(self._path, package, ignore))
+
+            # Add extra files
+            for p in self._extra_files:
+                LOG.info('Copying extra %s into package' % p)
+                ignore.add(re.escape(p))
+                if os.path.isdir(p):
+                    report.add(*utils.copy_tree(p, package, ignore=ignore,
+                                                include_parent=True))
+                else:
+                    shutil.copy(p, package)
+                    report.add(1, os.path.getsize(p))
 
+        self._create_zip(package)
+
+    def _site_packages(self):
+        '''Returns the site packages directories of the package virtualenv'''
+        site_packages = []
         if hasattr(self, '_pkg_venv') and self._pkg_venv:
             lib_dir = 'lib/python*/site-packages'
             lib64_dir = 'lib64/python*/site-packages'
@@ -263,7 +652,7 @@ class Package(object):
             lib_site_list = glob.glob(os.path.join(
                 self._pkg_venv, lib_dir))
             if lib_site_list:
-                utils.copy_tree(lib_site_list[0], package)
+                site_packages.append(lib_site_list[0])
             else:
                 LOG.debug("no lib site packages found")
 
@@ -272,40 +661,231 @@ class Package(object):
             if lib64_site_list:
                 lib64_site_packages = lib64_site_list[0]
                 if not os.path.islink(lib64_site_packages):
-                    LOG.info('Copying lib64 site packages')
-                    utils.copy_tree(lib64_site_packages, package)
-                lib64_site_packages = lib64_site_list[0]
+                    LOG.info('Found lib64 site packages')
+                    site_packages.append(lib64_site_packages)
             else:
                 LOG.debug("no lib64 site packages found")
 
-        # Append the temp workspace to the ignore list:
-        ignore.append(r"^%s/.*" % re.escape(TEMP_WORKSPACE_NAME))
-        utils.copy_tree(self._path, package, ignore)
+        return site_packages
+
+    def _function_site_packages(self):
+        '''In layer mode the site packages go into the layer zip'''
+        if self._layer:
+            return []
+        return self._site_packages()
+
+    def _ignore_outputs(self, ignore):
+        '''
+        Adds the workspace, the zips we write and the build cache, wheel
+        cache and wheelhouse, when they are inside the function directory,
+        to an IgnoreMatcher
+        '''
+        ignore.add(r"^%s/.*" % re.escape(TEMP_WORKSPACE_NAME))
+        for zip_file in [self.zip_file, self.layer_zip_file]:
+            if zip_file is not None:
+                ignore.add(r"^%s$" % re.escape(
+                    os.path.relpath(zip_file, self._path)))
+        for directory in [self._cache_dir, self._wheel_cache,
+                          self._wheelhouse]:
+            if directory is not None:
+                self._ignore_dir(ignore, directory)
+
+    def _ignore_dir(self, ignore, directory):
+        '''Adds directory to an IgnoreMatcher if it is under the package'''
+        relpath = os.path.relpath(os.path.abspath(directory),
+                                  os.path.abspath(self._path))
+        if relpath == os.curdir or relpath == os.pardir or \
+           relpath.startswith(os.pardir + os.sep):
+            return
+        ignore.add(r"^%s/.*" % re.escape(relpath))
+
+    def _manifest(self, ignore):
+        '''
+        Returns an ordered mapping of archive name to source path for every
+        file that goes into the package. Later entries replace earlier ones
+        with the same name, as the copies into lambda_package would.
+        '''
+        manifest = collections.OrderedDict()
+
+        slim = self._slim_matcher()
+        for site_packages in self._function_site_packages():
+            if slim is not None:
+                manifest.update(self._slim_site_packages(
+                    site_packages, slim, self._stripped_copy))
+            else:
+                for path, relpath in utils.walk_tree(site_packages):
+                    manifest[relpath] = path
+
+        # The zips are written into the function directory while we read it
+        self._ignore_outputs(ignore)
+        for path, relpath in utils.walk_tree(self._path, ignore):
+            manifest[relpath] = path
 
-        # Add extra files
         for p in self._extra_files:
-            LOG.info('Copying extra %s into package' % p)
-            ignore.append(re.escape(p))
+            ignore.add(re.escape(p))
             if os.path.isdir(p):
-                utils.copy_tree(p, package, ignore=ignore, include_parent=True)
+                parent = os.path.basename(p)
+                for path, relpath in utils.walk_tree(p, ignore):
+                    manifest[os.path.join(parent, relpath)] = path
             else:
-                shutil.copy(p, package)
+                manifest[os.path.basename(p)] = p
 
-        self._create_zip(package)
+        return manifest
+
+    def _slim_matcher(self):
+        '''Returns the matcher for files slim mode drops, if enabled'''
+        if not self._slim:
+            return None
+        return utils.IgnoreMatcher(SLIM_IGNORE + list(self._slim_ignore))
+
+    def _slim_site_packages(self, site_packages, slim, target):
+        '''
+        Returns an ordered mapping of archive name to path for the files of
+        site_packages that slim mode keeps. Native extensions are stripped of
+        debug symbols at the path target(path, relpath) returns. The sizes
+        before and after are added to slim_report.
+        '''
+        if self.slim_report is None:
+            self.slim_report = {'before': 0, 'after': 0, 'removed': 0}
+        strip = find_executable('strip')
+
+        kept = collections.OrderedDict()
+        for path, relpath in utils.walk_tree(site_packages, slim):
+            if strip and relpath.endswith('.so') and \
+               not os.path.islink(path):
+                stripped = target(path, relpath)
+                self._strip(strip, stripped)
+                kept[relpath] = stripped
+            else:
+                kept[relpath] = path
+
+        for path, relpath in utils.walk_tree(site_packages):
+            if not os.path.exists(path):
+                continue
+            self.slim_report['before'] += os.path.getsize(path)
+            if relpath in kept:
+                self.slim_report['after'] += os.path.getsize(kept[relpath])
+            else:
+                self.slim_report['removed'] += 1
+
+        return kept
+
+    def _stripped_copy(self, path, relpath):
+        '''Copies path into the workspace so it can be stripped'''
+        dest = os.path.join(self._temp_workspace, 'slim', relpath)
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        shutil.copy(path, dest)
+        return dest
+
+    def _strip(self, strip, path):
+        '''Removes debug symbols from a native extension'''
+        prc = Popen([strip, '--strip-unneeded', path],
+                    stdout=PIPE, stderr=PIPE)
+        stdout, stderr = prc.communicate()
+        if prc.returncode != 0:
+            LOG.debug("Unable to strip %s: %s" % (path, stderr))
 
     def _create_zip(self, src):
         LOG.info('Creating zipfile')
-        zf = zipfile.ZipFile(self.zip_file, "w", zipfile.ZIP_DEFLATED)
         abs_src = os.path.abspath(src)
+        entries = []
         for root, _, files in os.walk(src):
             for filename in files:
                 absname = os.path.abspath(os.path.join(root, filename))
                 arcname = absname[len(abs_src) + 1:]
-                LOG.debug('Zipping %s as %s'
-                          % (os.path.join(root, filename), arcname))
-
-                zf.write(absname, arcname)
-        zf.close()
+                entries.append((absname, arcname))
+        self._write_zip(entries)
+
+    def _create_zip_from_manifest(self, manifest):
+        LOG.info('Creating zipfile from %d files' % len(manifest))
+        entries = []
+        for arcname, path in manifest.items():
+            if not os.path.exists(path):
+                LOG.warning('Skipping dangling symlink %s' % path)
+                continue
+            entries.append((path, arcname))
+        self._write_zip(entries)
+
+    def _write_zip(self, entries):
+        '''
+        Writes the function zip. With a zip stream the zip is uploaded while
+        it is written, and s3_object is set to its bucket and key once the
+        upload is complete.
+        '''
+        with self._report.phase('zip'):
+            stream = self._zip_stream
+            zw = archive.ZipWriter(self.zip_file, self._zip_workers,
+                                   reproducible=self._reproducible,
+                                   tee=stream)
+            try:
+                try:
+                    zw.write_all(entries)
+                finally:
+                    zw.close()
+                if stream is not None:
+                    LOG.info('Completing upload of the zipfile to S3')
+                    stream.close()
+                    self.s3_object = (stream.bucket, stream.key)
+            except Exception:
+                if stream is not None:
+                    stream.abort()
+                raise
+            self._report.add(len(entries), os.path.getsize(self.zip_file))
+
+
+def _parse_requirements_file(pth, parsed, constraint=False):
+    pth = os.path.abspath(pth)
+    if pth in parsed[2]:
+        return
+    parsed[2].append(pth)
+    with open(pth) as fil:
+        lines = fil.read().splitlines()
+    _parse_requirement_lines(lines, os.path.dirname(pth), parsed, constraint)
+
+
+def _parse_requirement_lines(lines, base_dir, parsed, constraint=False):
+    for line in lines:
+        line = re.sub(r'(^|\s)#.*$', '', line).strip()
+        if not line:
+            continue
+        include = REQUIREMENT_INCLUDE.match(line)
+        if include:
+            _parse_requirements_file(
+                os.path.join(base_dir, include.group(2)), parsed,
+                include.group(1) in ('-c', '--constraint'))
+        elif line.startswith('-') and \
+                not line.startswith(('-e', '--editable')):
+            # Options such as --index-url are not requirements
+            continue
+        else:
+            # Hashes do not change what is installed
+            line = re.sub(r'\s--hash[=\s]\S+', '', line).strip()
+            parsed[1 if constraint else 0].append(line)
+
+
+def _unpinned(requirements, constraints):
+    '''
+    Returns the requirements that are neither pinned with == themselves nor
+    by a constraint
+    '''
+    pinned = set()
+    for line in constraints:
+        match = PINNED_REQUIREMENT.match(line)
+        if match:
+            pinned.add(_canonical_name(match.group(1)))
+    unpinned = []
+    for line in requirements:
+        if PINNED_REQUIREMENT.match(line):
+            continue
+        name = REQUIREMENT_NAME.match(line)
+        if name is None or _canonical_name(name.group(1)) not in pinned:
+            unpinned.append(line)
+    return unpinned
+
+
+def _canonical_name(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
 
 
 def _isfile(path):
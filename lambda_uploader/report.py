@@ -0,0 +1,138 @@
+# Copyright 2015-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import json
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+LOG = logging.getLogger(__name__)
+# The reports with a phase running in each thread
+_LOCAL = threading.local()
+# The report that last watched each client, for calls from other threads
+_WATCHED = {}
+_WATCH_LOCK = threading.Lock()
+
+
+class Report(object):
+    '''
+    Records the wall time, bytes processed, file counts and AWS API calls of
+    each phase of a build and deploy.
+
+    Phases nest; counters and API calls are attributed to the innermost phase
+    that is running. A report belongs to one function, so phases are tracked
+    across threads (the S3 transfer threads count towards the upload phase).
+    Work that runs concurrently, such as the upload to each region, is
+    recorded in child reports.
+
+    Clients are shared between reports, so an API call is counted by the
+    report with a phase running in the calling thread. Calls from threads
+    outside any phase, like those of the S3 transfer, are counted by the
+    report that last watched the client.
+    '''
+    def __init__(self):
+        self.phases = []
+        self.api_calls = {}
+        self.children = {}
+        self._active = []
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        '''Times the enclosed block as a phase called name'''
+        entry = {'name': name, 'seconds': 0.0, 'bytes': 0, 'files': 0,
+                 'api_calls': 0}
+        with self._lock:
+            self.phases.append(entry)
+            self._active.append(entry)
+        reports = _local_reports()
+        reports.append(self)
+        start = time.time()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] = round(time.time() - start, 6)
+            reports.pop()
+            with self._lock:
+                self._active.remove(entry)
+            LOG.debug('%s took %.3fs (%d files, %d bytes, %d API calls)'
+                      % (name, entry['seconds'], entry['files'],
+                         entry['bytes'], entry['api_calls']))
+
+    def child(self, name):
+        '''Returns the child report called name, creating it if needed'''
+        with self._lock:
+            if name not in self.children:
+                self.children[name] = Report()
+            return self.children[name]
+
+    def add(self, files=0, bytes=0):
+        '''Adds to the counters of the current phase'''
+        with self._lock:
+            if self._active:
+                self._active[-1]['files'] += files
+                self._active[-1]['bytes'] += bytes
+
+    def watch(self, client):
+        '''Counts the API calls the boto3 client makes for this report'''
+        with _WATCH_LOCK:
+            if id(client) not in _WATCHED:
+                client.meta.events.register(
+                    'before-call', functools.partial(_api_call, id(client)),
+                    unique_id='lambda-uploader-report-%d' % id(client))
+            _WATCHED[id(client)] = self
+        return client
+
+    def _api_call(self, model=None, **kwargs):
+        name = getattr(model, 'name', 'unknown')
+        with self._lock:
+            self.api_calls[name] = self.api_calls.get(name, 0) + 1
+            if self._active:
+                self._active[-1]['api_calls'] += 1
+
+    def as_dict(self):
+        with self._lock:
+            report = {
+                'seconds': round(time.time() - self._start, 6),
+                'phases': [dict(entry) for entry in self.phases],
+                'api_calls': dict(self.api_calls),
+            }
+            children = dict(self.children)
+        if children:
+            report['children'] = dict((name, child.as_dict())
+                                      for name, child in children.items())
+        return report
+
+    def write(self, pth):
+        '''Writes the report as JSON'''
+        with open(pth, 'w') as fil:
+            json.dump(self.as_dict(), fil, indent=2, sort_keys=True)
+
+
+def _local_reports():
+    if not hasattr(_LOCAL, 'reports'):
+        _LOCAL.reports = []
+    return _LOCAL.reports
+
+
+def _api_call(client_id, model=None, **kwargs):
+    '''Counts an API call for the report it is made for'''
+    reports = _local_reports()
+    report = reports[-1] if reports else _WATCHED.get(client_id)
+    if report is not None:
+        report._api_call(model=model)
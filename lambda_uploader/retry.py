@@ -0,0 +1,207 @@
+# Copyright 2015-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import logging
+import random
+import threading
+import time
+
+from botocore import xform_name
+from botocore.waiter import NormalizedOperationMethod
+from contextlib import contextmanager
+
+LOG = logging.getLogger(__name__)
+DEFAULT_ATTEMPTS = 8
+BASE_DELAY = 0.5
+MAX_DELAY = 20.0
+# Lambda control plane calls running at once per account and region
+DEFAULT_MAX_CONCURRENCY = 10
+# The account is over its request rate, back off and lower the concurrency
+THROTTLING_CODES = ('TooManyRequestsException', 'ThrottlingException',
+                    'Throttling', 'RequestLimitExceeded')
+# Transient failures of the service itself
+TRANSIENT_CODES = ('ServiceException', 'ServiceUnavailable',
+                   'InternalFailure', 'EC2ThrottledException')
+# A conflict on these is an update still in progress, it passes once the
+# function is updated. On create_* it means the resource already exists.
+CONFLICT_RETRY_PREFIXES = ('update_', 'publish_', 'put_', 'delete_',
+                           'add_', 'remove_')
+# Client methods that are not API calls
+PASSTHROUGH = ('meta', 'exceptions', 'can_paginate')
+
+_LOCK = threading.Lock()
+_LIMITERS = {}
+
+
+class Limiter(object):
+    '''
+    An adaptive limit on the number of calls running at once.
+
+    The limit grows by one for every limit calls that succeed and is halved
+    when a call is throttled (additive increase, multiplicative decrease),
+    so everything sharing the limiter slows down together when the account
+    runs into its rate limit and speeds back up when it no longer does.
+    '''
+    def __init__(self, maximum=DEFAULT_MAX_CONCURRENCY, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self.active = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        '''Waits until the call in the enclosed block may run'''
+        with self._cond:
+            while self.active >= int(self.limit):
+                self._cond.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.active -= 1
+                self._cond.notify()
+
+    def success(self):
+        with self._cond:
+            before = int(self.limit)
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            if int(self.limit) > before:
+                self._cond.notify_all()
+
+    def throttled(self):
+        with self._cond:
+            self.limit = max(self.minimum, self.limit / 2)
+            LOG.debug('Throttled, limiting to %d concurrent calls'
+                      % int(self.limit))
+
+
+class RetryingClient(object):
+    '''
+    Wraps a boto3 client so its API calls are made through call(), sharing
+    limiter. The pages of its paginators and the polls of its waiters are
+    made through call() as well. The client should be created with
+    botocore's own retries turned off (see clients.client), or every
+    attempt here is retried again by botocore.
+    '''
+    def __init__(self, client, limiter=None, attempts=DEFAULT_ATTEMPTS):
+        self.client = client
+        self._limiter = limiter
+        self._attempts = attempts
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if name in PASSTHROUGH or name.startswith('_') or \
+           not callable(method):
+            return method
+        return self._wrap(method, name)
+
+    def get_paginator(self, operation_name):
+        paginator = self.client.get_paginator(operation_name)
+        # botocore fetches every page with the method it was created with
+        paginator._method = self._wrap(paginator._method, operation_name)
+        return paginator
+
+    def get_waiter(self, waiter_name):
+        waiter = self.client.get_waiter(waiter_name)
+        operation = xform_name(waiter.config.operation)
+        # Errors the waiter has no acceptor for fail the wait, so throttled
+        # polls are retried before the waiter sees them
+        waiter._operation_method = NormalizedOperationMethod(
+            self._wrap(getattr(self.client, operation), operation))
+        return waiter
+
+    def _wrap(self, method, operation):
+        return functools.partial(call, method, operation=operation,
+                                 limiter=self._limiter,
+                                 attempts=self._attempts)
+
+
+def call(method, *args, **kwargs):
+    '''
+    Calls method, retrying throttled and transient failures with jittered
+    exponential backoff. Accepts the keyword arguments operation (the client
+    method name, used to tell which conflicts are retryable), limiter and
+    attempts; the rest are passed on to method.
+    '''
+    operation = kwargs.pop('operation', getattr(method, '__name__', ''))
+    limiter = kwargs.pop('limiter', None)
+    attempts = kwargs.pop('attempts', DEFAULT_ATTEMPTS)
+
+    for attempt in range(attempts):
+        try:
+            if limiter is None:
+                result = method(*args, **kwargs)
+            else:
+                with limiter.slot():
+                    result = method(*args, **kwargs)
+        except Exception as ex:
+            kind = classify(ex, operation)
+            if kind is None or attempt == attempts - 1:
+                raise
+            if kind == 'throttled' and limiter is not None:
+                limiter.throttled()
+            delay = backoff(attempt)
+            LOG.debug('%s failed with %s, retrying in %.2fs'
+                      % (operation, _code(ex), delay))
+            time.sleep(delay)
+        else:
+            if limiter is not None:
+                limiter.success()
+            return result
+
+
+def classify(ex, operation=''):
+    '''
+    Returns 'throttled' or 'transient' for errors worth retrying and None for
+    the ones that will fail again
+    '''
+    code = _code(ex)
+    if code in THROTTLING_CODES:
+        return 'throttled'
+    if code in TRANSIENT_CODES:
+        return 'transient'
+    if code == 'ResourceConflictException' and \
+       operation.startswith(CONFLICT_RETRY_PREFIXES):
+        return 'transient'
+    return None
+
+
+def backoff(attempt, base=BASE_DELAY, cap=MAX_DELAY):
+    '''Returns the delay before retry attempt, with full jitter'''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def limiter(region, profile_name=None):
+    '''Returns the limiter shared by all calls to a region of a profile'''
+    with _LOCK:
+        key = (region, profile_name)
+        if key not in _LIMITERS:
+            _LIMITERS[key] = Limiter()
+        return _LIMITERS[key]
+
+
+def clear():
+    '''Forgets all limiters'''
+    with _LOCK:
+        _LIMITERS.clear()
+
+
+def _code(ex):
+    response = getattr(ex, 'response', None)
+    if not isinstance(response, dict):
+        return None
+    return response.get('Error', {}).get('Code')
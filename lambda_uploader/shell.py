@@ -19,13 +19,17 @@ from __future__ import print_function
 
 import sys
 import logging
+import threading
 import traceback
 import lambda_uploader
 
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from os import getcwd, path, getenv
-from lambda_uploader import package, config, uploader, subscribers
-from boto3 import __version__ as boto3_version
-from botocore import __version__ as botocore_version
+# uploader and subscribers import boto3, which takes long enough to slow
+# down build only runs, so they are imported when they are used
+from lambda_uploader import package, config
+from lambda_uploader.report import Report
 
 LOG = logging.getLogger(__name__)
 
@@ -34,6 +38,9 @@ CHECK = '✅'
 INTERROBANG = '‽'
 RED_X = '❌'
 LAMBDA = 'λ'
+LOG_FORMAT = '%(asctime)s %(levelname)s:%(name)s:%(message)s'
+# Regions and batch functions print from several threads
+_PRINT_LOCK = threading.Lock()
 TRACEBACK_MESSAGE = """%s Unexpected error. Please report this traceback.
 Uploader: %s
 Botocore: %s
@@ -41,25 +48,79 @@ Boto3: %s
 """
 
 
+class ColdStartBudgetExceeded(Exception):
+    '''Importing the handler took longer than the cold start budget'''
+
+
 # Used for stdout for shell
 def _print(txt):
     # Windows Powershell doesn't support Unicode
-    if sys.platform == 'win32' or sys.platform == 'cygwin':
-        print(txt)
-    else:
+    if sys.platform != 'win32' and sys.platform != 'cygwin':
         # Add the lambda symbol
-        print("%s %s" % (LAMBDA, txt))
+        txt = "%s %s" % (LAMBDA, txt)
+    # print writes the text and the newline separately, so lines from
+    # different threads could run together
+    with _PRINT_LOCK:
+        print(txt)
 
 
 def _execute(args):
     pth = path.abspath(args.function_dir)
+    report = Report()
+
+    try:
+        cfg = _load_config(args, pth)
+        pkg = _build(args, cfg, pth, report=report)
+
+        if pkg is not None and not args.no_clean:
+            pkg.clean_workspace()
+
+        if not args.no_upload:
+            _upload(args, cfg, pkg, report=report)
+    finally:
+        # Also written for failed runs, they are the ones worth looking at
+        if args.report_json:
+            report.write(args.report_json)
+
+    _print('Fin')
+
 
-    cfg = config.Config(pth, args.config, role=args.role,
+def _load_config(args, pth, config_file=None):
+    '''Loads the function configuration and applies the CLI overrides'''
+    cfg = config.Config(pth, config_file or args.config, role=args.role,
                         variables=args.variables)
 
     if args.s3_bucket:
         cfg.set_s3(args.s3_bucket, args.s3_key)
 
+    if args.s3_content_addressed:
+        cfg.set_s3_content_addressed(args.s3_prefix)
+
+    if args.retain_versions is not None:
+        cfg.set_retain_versions(args.retain_versions)
+
+    if args.cold_start_budget is not None:
+        cfg.set_cold_start_budget(args.cold_start_budget)
+
+    cfg.set_s3_transfer(multipart_threshold=args.s3_multipart_threshold,
+                        multipart_chunksize=args.s3_multipart_chunksize,
+                        max_concurrency=args.s3_max_concurrency,
+                        max_bandwidth=args.s3_max_bandwidth)
+
+    if args.layer:
+        cfg.set_layer()
+
+    return cfg
+
+
+def _build(args, cfg, pth, shared_venv=None, prnt=_print, report=None):
+    '''
+    Builds the package, or loads an existing one with --no-build. Returns
+    None for a configuration only deploy.
+    '''
+    if args.config_only:
+        return None
+
     if args.no_virtualenv:
         # specified flag to omit entirely
         venv = False
@@ -71,47 +132,193 @@ def _execute(args):
         venv = None
 
     if args.no_build:
-        pkg = package.create_package(pth)
-    else:
-        _print('Building Package')
-        requirements = cfg.requirements
-        if args.requirements:
-            requirements = path.abspath(args.requirements)
-        extra_files = cfg.extra_files
-        if args.extra_files:
-            extra_files = args.extra_files
-        pkg = package.build_package(pth, requirements,
-                                    venv, cfg.ignore, extra_files,
-                                    pyexec=cfg.runtime)
-
-    if not args.no_clean:
-        pkg.clean_workspace()
-
-    if not args.no_upload:
-        # Set publish if flagged to do so
-        if args.publish:
-            cfg.set_publish()
-
-        create_alias = False
-        # Set alias if the arg is passed
-        if args.alias is not None:
-            cfg.set_alias(args.alias, args.alias_description)
-            create_alias = True
-
-        _print('Uploading Package')
-        upldr = uploader.PackageUploader(cfg, args.profile)
-        upldr.upload(pkg)
-        # If the alias was set create it
-        if create_alias:
-            upldr.alias()
+        return package.create_package(pth, layer=bool(cfg.layer_name))
+
+    prnt('Building Package')
+    requirements = cfg.requirements
+    if args.requirements:
+        requirements = path.abspath(args.requirements)
+    extra_files = cfg.extra_files
+    if args.extra_files:
+        extra_files = args.extra_files
+    zip_stream = None
+    if args.pipeline and not args.no_upload:
+        if not cfg.s3_bucket:
+            raise Exception('--pipeline requires an S3 bucket')
+        if cfg.s3_content_addressed:
+            raise Exception('--pipeline can not be used with content '
+                            'addressed S3 keys, the key is only known '
+                            'once the zipfile is written')
+        from lambda_uploader import uploader
+        zip_stream = uploader.PackageUploader(
+            cfg, args.profile, report=report).s3_stream()
+    wheelhouse = None
+    if args.wheelhouse:
+        wheelhouse = path.abspath(args.wheelhouse)
+    elif cfg.wheelhouse:
+        wheelhouse = path.join(pth, cfg.wheelhouse)
+    pkg = package.build_package(pth, requirements,
+                                venv, cfg.ignore, extra_files,
+                                pyexec=cfg.runtime,
+                                cache_dir=args.cache_dir,
+                                direct=args.direct,
+                                zip_workers=args.zip_workers,
+                                wheel_cache=args.wheel_cache,
+                                wheelhouse=wheelhouse,
+                                reproducible=(args.reproducible or
+                                              cfg.reproducible),
+                                slim=args.slim or cfg.slim,
+                                slim_ignore=cfg.slim_ignore,
+                                layer=bool(cfg.layer_name),
+                                shared_venv=shared_venv,
+                                report=report,
+                                zip_stream=zip_stream)
+    if pkg.cache_hit:
+        prnt('Using cached package')
+    if pkg.slim_report:
+        prnt('Slimmed site packages from %.1fMB to %.1fMB '
+             '(%d files removed)'
+             % (pkg.slim_report['before'] / 1000000.0,
+                pkg.slim_report['after'] / 1000000.0,
+                pkg.slim_report['removed']))
+    if args.import_profile or cfg.cold_start_budget is not None:
+        _profile_imports(args, cfg, pkg, prnt, report or Report())
+    return pkg
 
-        if cfg.subscription:
-            _print('Creating subscription')
-            subscribers.create_subscriptions(cfg, args.profile)
 
+def _profile_imports(args, cfg, pkg, prnt, report):
+    '''
+    Prints the heaviest imports of the handler and fails when they take
+    longer than the cold start budget
+    '''
+    from lambda_uploader import bench
+
+    with report.phase('import profile'):
+        roots, total_us = bench.import_profile(
+            pkg.zip_file, cfg.handler,
+            python=args.python or package.python_executable(cfg.runtime),
+            layer_zip_file=pkg.layer_zip_file,
+            runtime_path=args.runtime_path)
+    prnt('Handler imports took %.1fms' % (total_us / 1000.0))
+    if args.import_profile:
+        for line in bench.format_import_tree(roots, total_us):
+            print('  %s' % line)
+    budget = cfg.cold_start_budget
+    if budget is not None and total_us / 1000.0 > budget:
+        raise ColdStartBudgetExceeded(
+            'Handler imports took %.1fms, over the cold start budget of %sms'
+            % (total_us / 1000.0, budget))
+
+
+def _upload(args, cfg, pkg, prnt=_print, report=None):
+    '''Uploads the package and applies the alias and subscriptions'''
+    report = report or Report()
+    # Set publish if flagged to do so
+    if args.publish:
+        cfg.set_publish()
+
+    create_alias = False
+    # Set alias if the arg is passed
+    if args.alias is not None:
+        cfg.set_alias(args.alias, args.alias_description)
+        create_alias = True
+
+    regions = cfg.region_names
+    if len(regions) == 1:
+        _upload_region(args, cfg.for_region(regions[0]), pkg, create_alias,
+                       prnt, report)
+    else:
+        _upload_regions(args, cfg, pkg, create_alias, prnt, report)
+
+    if pkg is not None:
         pkg.clean_zipfile()
 
-    _print('Fin')
+
+def _upload_regions(args, cfg, pkg, create_alias, prnt, report):
+    '''
+    Uploads the package to every region of the config at the same time.
+    Raises once all uploads are done if any of them failed.
+    '''
+    regions = cfg.region_names
+    prnt('Uploading to %d regions' % len(regions))
+    errors = {}
+
+    def upload(region):
+        def region_prnt(txt):
+            prnt('[%s] %s' % (region, txt))
+        try:
+            _upload_region(args, cfg.for_region(region), pkg, create_alias,
+                           region_prnt, report.child(region))
+        except Exception:
+            LOG.debug(traceback.format_exc())
+            errors[region] = sys.exc_info()[1]
+            region_prnt('%s Upload failed: %s' % (RED_X, errors[region]))
+
+    pool = ThreadPool(len(regions))
+    try:
+        pool.map(upload, regions)
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = OrderedDict((r, errors[r]) for r in regions if r in errors)
+    if failed:
+        raise Exception('Upload failed in %d of %d regions: %s'
+                        % (len(failed), len(regions),
+                           '; '.join('%s: %s' % item
+                                     for item in failed.items())))
+
+
+def _upload_region(args, cfg, pkg, create_alias, prnt, report):
+    '''Uploads the package to the region of cfg'''
+    from lambda_uploader import subscribers, uploader
+
+    upldr = uploader.PackageUploader(cfg, args.profile, report=report)
+    if pkg is None:
+        prnt('Updating Configuration')
+        upldr.upload_configuration()
+    else:
+        prnt('Uploading Package')
+        upldr.upload(pkg)
+    if upldr.layer_published:
+        prnt('Published new dependencies layer version')
+    if not upldr.code_updated:
+        prnt('Code unchanged, skipped code upload')
+    if not upldr.config_updated:
+        prnt('Configuration unchanged, skipped configuration update')
+    for key in upldr.s3_reused:
+        prnt('Reused %s already in S3, skipped upload' % key)
+    for key, size, seconds in upldr.s3_uploads:
+        prnt('Uploaded %s (%.1fMB) to S3 at %.1fMB/s'
+             % (key, size / 1000000.0,
+                size / 1000000.0 / max(seconds, 0.001)))
+    # If the alias was set create it
+    if create_alias:
+        upldr.alias()
+
+    if cfg.retain_versions is not None:
+        pruned = upldr.prune_versions(cfg.retain_versions,
+                                      dry_run=args.prune_dry_run)
+        if args.prune_dry_run:
+            prnt('Would delete %d old versions: %s'
+                 % (len(pruned), ', '.join(pruned) or '-'))
+        elif pruned:
+            prnt('Deleted %d old versions' % len(pruned))
+
+    if cfg.subscription:
+        prnt('Creating subscription')
+        with report.phase('subscriptions'):
+            subscribers.create_subscriptions(cfg, args.profile,
+                                             report=report)
+    elif cfg.subscriptions is not None:
+        with report.phase('subscriptions'):
+            changes = subscribers.reconcile_subscriptions(cfg, args.profile,
+                                                          report=report)
+        prnt('Subscriptions: %d created, %d updated, %d deleted,'
+             ' %d unchanged' % (len(changes['created']),
+                                len(changes['updated']),
+                                len(changes['deleted']),
+                                len(changes['unchanged'])))
 
 
 def main(arv=None):
@@ -120,10 +327,57 @@ def main(arv=None):
     if sys.version_info[0] < 3 and not sys.version_info[1] == 7:
         raise RuntimeError('lambda-uploader requires Python 2.7 or later')
 
-    import argparse
+    args = _arg_parser().parse_args(arv)
+
+    logging.basicConfig(level=args.loglevel, format=LOG_FORMAT)
+    try:
+        _execute(args)
+    except ColdStartBudgetExceeded as ex:
+        # A failed check rather than a bug, no traceback
+        _print_failure(ex)
+        sys.exit(1)
+    except Exception:
+        _print_traceback()
+        sys.exit(1)
+
 
-    parser = argparse.ArgumentParser(
+def _arg_parser():
+    parser = _parser(
             description='Simple way to create and upload python lambda jobs')
+    parser.add_argument('function_dir', default=getcwd(), nargs='?',
+                        help='lambda function directory')
+    parser.add_argument('--config', '-c', help='Overrides lambda.json',
+                        default='lambda.json')
+    return parser
+
+
+def _print_failure(ex):
+    _print('%s %s' % (RED_X, ex))
+
+
+def _print_traceback():
+    print(TRACEBACK_MESSAGE
+          % (INTERROBANG, lambda_uploader.__version__,
+             _module_version('botocore'), _module_version('boto3')),
+          file=sys.stderr)
+
+    traceback.print_exc()
+    sys.stderr.flush()
+
+
+def _module_version(name):
+    '''Returns the version of a module, importing it only now'''
+    try:
+        return __import__(name).__version__
+    except ImportError:
+        return 'not installed'
+
+
+def _parser(description):
+    '''Returns a parser with the options shared by all commands'''
+    import argparse
+
+    parser = argparse.ArgumentParser(description=description)
 
     parser.add_argument('--version', '-v', action='version',
                         version=lambda_uploader.__version__)
@@ -164,19 +418,110 @@ def main(arv=None):
                         default=None, help=alias_help)
     parser.add_argument('--alias-description', '-m', dest='alias_description',
                         default=None, help='alias description')
+    parser.add_argument('--import-profile', dest='import_profile',
+                        action='store_const', const=True,
+                        help=('print the heaviest imports of the handler '
+                              'after the build'))
+    parser.add_argument('--cold-start-budget', dest='cold_start_budget',
+                        type=float,
+                        help=('fail the build when importing the handler '
+                              'takes longer than this many milliseconds'))
+    parser.add_argument('--python', default=None,
+                        help=('python executable to run the handler with, '
+                              'defaults to the one of the runtime'))
+    parser.add_argument('--runtime-path', dest='runtime_path',
+                        action='append', default=None,
+                        help=('directory of the libraries the Lambda runtime '
+                              'provides, put on sys.path after the package '
+                              'when running the handler; defaults to the '
+                              'boto3 and botocore of this python'))
+    parser.add_argument('--retain-versions', dest='retain_versions',
+                        type=int,
+                        help=('delete all but this many published versions, '
+                              'keeping those aliases point to'))
+    parser.add_argument('--prune-dry-run', dest='prune_dry_run',
+                        action='store_const',
+                        help='list the versions that would be deleted',
+                        const=True)
     parser.add_argument('--s3-bucket', '-s', dest='s3_bucket',
                         help='S3 bucket to store the lambda function in',
                         default=None)
     parser.add_argument('--s3-key', '-k', dest='s3_key',
                         help='Key name of the lambda function s3 object',
                         default=None)
-    parser.add_argument('--config', '-c', help='Overrides lambda.json',
-                        default='lambda.json')
-    parser.add_argument('function_dir', default=getcwd(), nargs='?',
-                        help='lambda function directory')
+    parser.add_argument('--s3-content-addressed',
+                        dest='s3_content_addressed', action='store_const',
+                        help=('store the package in S3 as <prefix>/<sha256>'
+                              '.zip and skip the upload if it exists'),
+                        const=True)
+    parser.add_argument('--s3-prefix', dest='s3_prefix',
+                        help=('prefix of content addressed S3 keys, the '
+                              'function name by default'))
+    parser.add_argument('--s3-multipart-threshold',
+                        dest='s3_multipart_threshold', type=int,
+                        help='size in bytes from which S3 uploads are '
+                             'multipart')
+    parser.add_argument('--s3-multipart-chunksize',
+                        dest='s3_multipart_chunksize', type=int,
+                        help='size in bytes of each part of an S3 upload')
+    parser.add_argument('--s3-max-concurrency', dest='s3_max_concurrency',
+                        type=int,
+                        help='number of parts uploaded to S3 at the same time')
+    parser.add_argument('--s3-max-bandwidth', dest='s3_max_bandwidth',
+                        type=int,
+                        help='limit S3 uploads to this many bytes per second')
     parser.add_argument('--no-build', dest='no_build',
                         action='store_const', help='dont build the sourcecode',
                         const=True)
+    parser.add_argument('--config-only', dest='config_only',
+                        action='store_const',
+                        help=('only update the configuration of an existing '
+                              'function, without building or uploading code'),
+                        const=True)
+    parser.add_argument('--direct', dest='direct',
+                        action='store_const',
+                        help=('zip files from where they are instead of '
+                              'staging a copy in the temporary workspace'),
+                        const=True)
+    parser.add_argument('--wheel-cache', dest='wheel_cache',
+                        default=getenv('LAMBDA_UPLOADER_WHEEL_CACHE'),
+                        help=('install requirements from a persistent wheel '
+                              'cache, can be set with '
+                              '$LAMBDA_UPLOADER_WHEEL_CACHE'))
+    parser.add_argument('--wheelhouse', dest='wheelhouse',
+                        help=('install requirements only from this directory '
+                              'of wheels, without a package index'))
+    parser.add_argument('--layer', dest='layer',
+                        action='store_const',
+                        help=('publish the dependencies as a separate Lambda '
+                              'layer'),
+                        const=True)
+    parser.add_argument('--slim', dest='slim',
+                        action='store_const',
+                        help=('leave caches, metadata, tests, stubs, headers '
+                              'and boto3 out of the site packages'),
+                        const=True)
+    parser.add_argument('--reproducible', dest='reproducible',
+                        action='store_const',
+                        help=('build the same zipfile from the same sources '
+                              'so unchanged code is not uploaded again'),
+                        const=True)
+    parser.add_argument('--pipeline', dest='pipeline',
+                        action='store_const',
+                        help=('upload the zipfile to S3 while it is being '
+                              'compressed'),
+                        const=True)
+    parser.add_argument('--zip-workers', dest='zip_workers', type=int,
+                        default=1,
+                        help='number of threads compressing the zipfile')
+    parser.add_argument('--cache-dir', dest='cache_dir',
+                        default=getenv('LAMBDA_UPLOADER_CACHE_DIR'),
+                        help=('reuse packages built from identical sources, '
+                              'can be set with $LAMBDA_UPLOADER_CACHE_DIR'))
+    parser.add_argument('--report-json', dest='report_json',
+                        help=('write the duration, bytes, files and AWS API '
+                              'calls of every build and deploy phase to this '
+                              'JSON file'))
 
     verbose = parser.add_mutually_exclusive_group()
     verbose.add_argument('-V', dest='loglevel', action='store_const',
@@ -187,17 +532,4 @@ def main(arv=None):
                          help="Set log-level to DEBUG.")
     parser.set_defaults(loglevel=logging.WARNING)
 
-    args = parser.parse_args()
-
-    logging.basicConfig(level=args.loglevel)
-    try:
-        _execute(args)
-    except Exception:
-        print(TRACEBACK_MESSAGE
-              % (INTERROBANG, lambda_uploader.__version__,
-                 boto3_version, botocore_version),
-              file=sys.stderr)
-
-        traceback.print_exc()
-        sys.stderr.flush()
-        sys.exit(1)
+    return parser
@@ -12,47 +12,53 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import boto3
 import botocore
 import logging
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from lambda_uploader import clients, retry
 
 LOG = logging.getLogger(__name__)
+# Event source mapping calls made at once while reconciling
+RECONCILE_WORKERS = 8
+# Services of the event sources a subscriptions list manages. Mappings of
+# other sources (Kafka, Amazon MQ, DocumentDB) are left alone.
+RECONCILED_SERVICES = ('kinesis', 'dynamodb', 'sqs')
+# Mapping states that still invoke the function
+ENABLED_STATES = ('Creating', 'Enabling', 'Enabled', 'Updating')
+# Subscription settings and the event source mapping parameter they set
+EVENT_SOURCE_SETTINGS = {
+    'parallelization_factor': 'ParallelizationFactor',
+    'maximum_batching_window_in_seconds': 'MaximumBatchingWindowInSeconds',
+    'bisect_batch_on_function_error': 'BisectBatchOnFunctionError',
+    'maximum_record_age_in_seconds': 'MaximumRecordAgeInSeconds',
+    'tumbling_window_in_seconds': 'TumblingWindowInSeconds',
+    'function_response_types': 'FunctionResponseTypes',
+}
 
 
-class KinesisSubscriber(object):
-    ''' Invokes the lambda function on events from the Kinesis streams '''
-    def __init__(self, config, profile_name,
-                 function_name, stream_name, batch_size,
-                 starting_position, starting_position_ts=None):
-        self._aws_session = boto3.session.Session(region_name=config.region,
-                                                  profile_name=profile_name)
-        self._lambda_client = self._aws_session.client('lambda')
+class EventSourceSubscriber(object):
+    '''
+    Invokes the lambda function on events from an event source. The event
+    source mapping is created, or updated when it already exists.
+    settings are extra event source mapping parameters, set on both.
+    '''
+    kind = 'event source'
+
+    def __init__(self, config, profile_name, function_name, source_arn,
+                 batch_size, settings=None, report=None):
+        self._lambda_client = _lambda_client(config, profile_name, report)
         self.function_name = function_name
-        self.stream_name = stream_name
+        self.source_arn = source_arn
         self.batch_size = batch_size
-        self.starting_position = starting_position
-        self.starting_position_ts = starting_position_ts
+        self.settings = settings or {}
 
     def subscribe(self):
-        ''' Subscribes the lambda to the Kinesis stream '''
+        ''' Subscribes the lambda to the event source '''
         try:
-            LOG.debug('Creating Kinesis subscription')
-            if self.starting_position_ts:
-                self._lambda_client \
-                    .create_event_source_mapping(
-                        EventSourceArn=self.stream_name,
-                        FunctionName=self.function_name,
-                        BatchSize=self.batch_size,
-                        StartingPosition=self.starting_position,
-                        StartingPositionTimestamp=self.starting_position_ts)
-            else:
-                self._lambda_client \
-                    .create_event_source_mapping(
-                        EventSourceArn=self.stream_name,
-                        FunctionName=self.function_name,
-                        BatchSize=self.batch_size,
-                        StartingPosition=self.starting_position)
+            LOG.debug('Creating %s subscription' % self.kind)
+            self._lambda_client.create_event_source_mapping(
+                **self._create_params())
             LOG.debug('Subscription created')
         except botocore.exceptions.ClientError as ex:
             response_code = ex.response['Error']['Code']
@@ -61,33 +67,196 @@ class KinesisSubscriber(object):
                 resp = self._lambda_client\
                            .list_event_source_mappings(
                                 FunctionName=self.function_name,
-                                EventSourceArn=self.stream_name)
+                                EventSourceArn=self.source_arn)
                 uuid = resp['EventSourceMappings'][0]['UUID']
-                self._lambda_client \
-                    .update_event_source_mapping(
-                        UUID=uuid,
-                        FunctionName=self.function_name,
-                        Enabled=True,
-                        BatchSize=self.batch_size)
+                self._lambda_client.update_event_source_mapping(
+                    UUID=uuid, **self._update_params())
             else:
                 LOG.error('Subscription failed, error=%s' % str(ex))
                 raise ex
 
+    def _create_params(self):
+        return dict(self.settings, EventSourceArn=self.source_arn,
+                    FunctionName=self.function_name,
+                    BatchSize=self.batch_size)
+
+    def _update_params(self):
+        return dict(self.settings, FunctionName=self.function_name,
+                    Enabled=True, BatchSize=self.batch_size)
+
+
+class KinesisSubscriber(EventSourceSubscriber):
+    ''' Invokes the lambda function on events from the Kinesis streams '''
+    kind = 'Kinesis'
+
+    def __init__(self, config, profile_name,
+                 function_name, stream_name, batch_size,
+                 starting_position, starting_position_ts=None, settings=None,
+                 report=None):
+        EventSourceSubscriber.__init__(self, config, profile_name,
+                                       function_name, stream_name, batch_size,
+                                       settings=settings, report=report)
+        self.stream_name = stream_name
+        self.starting_position = starting_position
+        self.starting_position_ts = starting_position_ts
+
+    def _create_params(self):
+        params = EventSourceSubscriber._create_params(self)
+        params['StartingPosition'] = self.starting_position
+        if self.starting_position_ts:
+            params['StartingPositionTimestamp'] = self.starting_position_ts
+        return params
+
+
+class DynamoDBSubscriber(KinesisSubscriber):
+    ''' Invokes the lambda function on changes from a DynamoDB stream '''
+    kind = 'DynamoDB'
+
+
+class SQSSubscriber(EventSourceSubscriber):
+    ''' Invokes the lambda function on messages from an SQS queue '''
+    kind = 'SQS'
 
-def create_subscriptions(config, profile_name):
+
+def create_subscriptions(config, profile_name, report=None):
     ''' Adds supported subscriptions '''
-    if 'kinesis' in config.subscription.keys():
-        data = config.subscription['kinesis']
-        function_name = config.name
-        stream_name = data['stream']
-        batch_size = data['batch_size']
+    for s in subscribers(config, profile_name, report=report):
+        s.subscribe()
+
+
+def subscribers(config, profile_name, report=None):
+    ''' Returns a subscriber for each subscription in the config '''
+    subs = []
+    for kind in ('kinesis', 'dynamodb', 'sqs'):
+        if kind in config.subscription.keys():
+            subs.append(_subscriber(config, profile_name, kind,
+                                    config.subscription[kind], report))
+    return subs
+
+
+def reconcile_subscriptions(config, profile_name, report=None,
+                            workers=RECONCILE_WORKERS):
+    '''
+    Makes the event source mappings of the function match the subscriptions
+    list of the config. All mappings of the function are read once; missing
+    ones are created, changed ones updated (or disabled when the
+    subscription sets enabled to false) and mappings of sources no longer
+    listed are deleted, all concurrently. Mappings that already match are
+    not touched, and neither are mappings of sources other than Kinesis,
+    DynamoDB and SQS.
+
+    returns a dict of the event source ARNs created, updated, deleted and
+    unchanged
+    '''
+    subs = [(_subscriber(config, profile_name, entry['type'], entry, report),
+             entry.get('enabled', True))
+            for entry in config.subscriptions]
+    client = _lambda_client(config, profile_name, report)
+
+    existing = {}
+    function_arn = ':function:%s' % config.name
+    paginator = client.get_paginator('list_event_source_mappings')
+    for page in paginator.paginate(FunctionName=config.name):
+        for mapping in page.get('EventSourceMappings', []):
+            # Mappings of aliases and versions are managed elsewhere
+            if mapping['FunctionArn'].endswith(function_arn) and \
+               _reconciled(mapping.get('EventSourceArn')):
+                existing[mapping['EventSourceArn']] = mapping
+
+    changes = {'created': [], 'updated': [], 'deleted': [], 'unchanged': []}
+    calls = []
+    for sub, enabled in subs:
+        mapping = existing.pop(sub.source_arn, None)
+        if mapping is None:
+            params = sub._create_params()
+            if not enabled:
+                params['Enabled'] = False
+            changes['created'].append(sub.source_arn)
+            calls.append((client.create_event_source_mapping, params))
+            continue
+        params = dict(sub._update_params(), Enabled=enabled)
+        if _mapping_matches(mapping, params):
+            changes['unchanged'].append(sub.source_arn)
+        else:
+            changes['updated'].append(sub.source_arn)
+            calls.append((client.update_event_source_mapping,
+                          dict(params, UUID=mapping['UUID'])))
+    for arn, mapping in existing.items():
+        changes['deleted'].append(arn)
+        calls.append((client.delete_event_source_mapping,
+                      {'UUID': mapping['UUID']}))
+
+    LOG.debug('Reconciling subscriptions: %s' % dict(
+        (k, len(v)) for k, v in changes.items()))
+    if calls:
+        pool = ThreadPool(min(workers, len(calls)))
+        try:
+            pool.map(lambda call: call[0](**call[1]), calls)
+        finally:
+            pool.close()
+            pool.join()
+    return changes
+
+
+def _reconciled(arn):
+    '''Returns whether the mapping of an event source ARN is managed here'''
+    parts = (arn or '').split(':')
+    return len(parts) > 2 and parts[2] in RECONCILED_SERVICES
+
+
+def _subscriber(config, profile_name, kind, data, report):
+    function_name = config.name
+    if kind == 'kinesis':
         starting_position = data['starting_position']
         starting_position_ts = None
         if starting_position == 'AT_TIMESTAMP':
             ts = data.get('starting_position_timestamp')
             starting_position_ts = datetime.strptime(ts, '%Y-%m-%dT%H:%M:%SZ')
-        s = KinesisSubscriber(config, profile_name,
-                              function_name, stream_name, batch_size,
-                              starting_position,
-                              starting_position_ts=starting_position_ts)
-        s.subscribe()
+        return KinesisSubscriber(
+            config, profile_name, function_name, data['stream'],
+            data['batch_size'], starting_position,
+            starting_position_ts=starting_position_ts,
+            settings=_settings(data), report=report)
+    if kind == 'dynamodb':
+        return DynamoDBSubscriber(
+            config, profile_name, function_name, data['stream'],
+            data['batch_size'], data['starting_position'],
+            settings=_settings(data), report=report)
+    return SQSSubscriber(
+        config, profile_name, function_name, data['queue'],
+        data['batch_size'], settings=_settings(data), report=report)
+
+
+def _lambda_client(config, profile_name, report):
+    # Retried by the RetryingClient, not by botocore
+    client = clients.client('lambda', config.region, profile_name,
+                            config.aws_client, retries=False)
+    if report is not None:
+        report.watch(client)
+    return retry.RetryingClient(client,
+                                retry.limiter(config.region, profile_name))
+
+
+def _mapping_matches(mapping, params):
+    '''Compares update_event_source_mapping params with a mapping'''
+    for key, value in params.items():
+        if key == 'FunctionName':
+            continue
+        if key == 'Enabled':
+            if (mapping.get('State') in ENABLED_STATES) != value:
+                return False
+        elif mapping.get(key) != value:
+            return False
+    return True
+
+
+def _settings(data):
+    '''Returns the event source mapping parameters of a subscription'''
+    settings = {}
+    for key, param in EVENT_SOURCE_SETTINGS.items():
+        if data.get(key) is not None:
+            settings[param] = data[key]
+    if data.get('maximum_concurrency') is not None:
+        settings['ScalingConfig'] = {
+            'MaximumConcurrency': data['maximum_concurrency']}
+    return settings
@@ -12,92 +12,143 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
 import boto3
+import hashlib
 import logging
+import time
 
+from botocore.exceptions import ClientError
+from multiprocessing.pool import ThreadPool
 from os import path
+from lambda_uploader import clients, multipart, retry, utils
+from lambda_uploader.report import Report
 
 LOG = logging.getLogger(__name__)
 MAX_PACKAGE_SIZE = 50000000
+LAYER_DESCRIPTION = 'lambda-uploader requirements %s'
+DELETE_WORKERS = 8
+# Error codes head_object reports for a missing object
+MISSING_OBJECT_CODES = ('404', 'NoSuchKey', 'NotFound')
+MB = 1024 * 1024
+# get_function_configuration leaves these out when they are not set
+OPTIONAL_CONFIGURATION = ('VpcConfig', 'Environment', 'TracingConfig',
+                          'Layers')
+# Parts of 16MB keep 50-250MB packages at 4-16 parts uploaded in parallel
+DEFAULT_S3_TRANSFER = {'multipart_threshold': 16 * MB,
+                       'multipart_chunksize': 16 * MB,
+                       'max_concurrency': 10}
 
 
 class PackageUploader(object):
     '''TODO: Should we decouple the config from the Object Init'''
-    def __init__(self, config, profile_name):
+    def __init__(self, config, profile_name, report=None):
         self._config = config
         self._vpc_config = self._format_vpc_config()
-        self._aws_session = boto3.session.Session(region_name=config.region,
-                                                  profile_name=profile_name)
-        self._lambda_client = self._aws_session.client('lambda')
+        self._report = report or Report()
+        self._profile_name = profile_name
+        # Shares the concurrency limit of every deploy to the region
+        self._lambda_client = retry.RetryingClient(
+            self._report.watch(self._client('lambda', retries=False)),
+            retry.limiter(config.region, profile_name))
         self.version = None
+        self.code_updated = True
+        self.config_updated = True
+        self.layer_published = False
+        self.s3_uploads = []
+        self.s3_reused = []
+        self._layers = None
+        self._s3_transfer = None
+        self._s3_client = None
 
     '''
     Calls the AWS methods to upload an existing package and update
-    the function configuration
+    the function configuration. current is the get_function_configuration
+    response of the deployed function; code and configuration that match it
+    are not sent again. Without a package only the configuration is updated.
 
     returns the package version
     '''
-    def upload_existing(self, pkg):
-        environment = {'Variables': self._config.variables}
+    def upload_existing(self, pkg, current=None):
+        current = current or {}
+        current_sha256 = current.get('CodeSha256')
+        if pkg is None:
+            self.code_updated = False
+        elif current_sha256 and current_sha256 == _code_sha256(pkg.zip_file):
+            LOG.info('CodeSha256 matches the deployed code, '
+                     'skipping update_function_code')
+            self.code_updated = False
+        else:
+            self._update_code(pkg)
+
+        changes = self._configuration_changes(current)
+        version = current.get('Version')
+        if changes:
+            LOG.debug('running update_function_configuration for %s'
+                      % ', '.join(sorted(changes)))
+            with self._report.phase('update function configuration'):
+                response = self._lambda_client.update_function_configuration(
+                    FunctionName=self._config.name, **changes)
+            LOG.debug("AWS update_function_configuration response: %s"
+                      % response)
+            version = response.get('Version')
+        else:
+            LOG.info('Configuration matches the deployed function, '
+                     'skipping update_function_configuration')
+            self.config_updated = False
+
+        # Publish the version after upload and config update if needed
+        if self._config.publish:
+
+            # The code update has been waited for already
+            if self.config_updated:
+                self._wait_updated()
+
+            with self._report.phase('publish version'):
+                resp = self._lambda_client.publish_version(
+                        FunctionName=self._config.name,
+                        )
+            LOG.debug("AWS publish_version response: %s" % resp)
+            version = resp.get('Version')
+
+        return version
+
+    '''Uploads the package code of an existing function'''
+    def _update_code(self, pkg):
         self._validate_package_size(pkg.zip_file)
-        with open(pkg.zip_file, "rb") as fil:
-            zip_file = fil.read()
 
         LOG.debug('running update_function_code')
         conf_update_resp = None
         if self._config.s3_bucket:
-            self._upload_s3(pkg.zip_file)
-            conf_update_resp = self._lambda_client.update_function_code(
-                FunctionName=self._config.name,
-                S3Bucket=self._config.s3_bucket,
-                S3Key=self._config.s3_package_name(),
-                Publish=False,
-            )
+            key = self._upload_package_s3(pkg)
+            with self._report.phase('update function code'):
+                conf_update_resp = self._lambda_client.update_function_code(
+                    FunctionName=self._config.name,
+                    S3Bucket=self._config.s3_bucket,
+                    S3Key=key,
+                    Publish=False,
+                )
         else:
-            conf_update_resp = self._lambda_client.update_function_code(
-                FunctionName=self._config.name,
-                ZipFile=zip_file,
-                Publish=False,
-            )
+            with self._report.phase('update function code'):
+                self._report.add(bytes=path.getsize(pkg.zip_file))
+                # The bytes are only referenced for the duration of the call
+                conf_update_resp = self._lambda_client.update_function_code(
+                    FunctionName=self._config.name,
+                    ZipFile=_read_file(pkg.zip_file),
+                    Publish=False,
+                )
         LOG.debug("AWS update_function_code response: %s"
                   % conf_update_resp)
 
-        waiter = self._lambda_client.get_waiter('function_updated')
-        LOG.debug("Waiting for lambda function to be updated")
-        waiter.wait(FunctionName=self._config.name)
-
-        LOG.debug('running update_function_configuration')
-        response = self._lambda_client.update_function_configuration(
-            FunctionName=self._config.name,
-            Handler=self._config.handler,
-            Role=self._config.role,
-            Description=self._config.description,
-            Timeout=self._config.timeout,
-            MemorySize=self._config.memory,
-            VpcConfig=self._vpc_config,
-            Environment=environment,
-            TracingConfig=self._config.tracing,
-            Runtime=self._config.runtime,
-        )
-        LOG.debug("AWS update_function_configuration response: %s"
-                  % response)
-
-        version = response.get('Version')
-        # Publish the version after upload and config update if needed
-        if self._config.publish:
+        self._wait_updated()
 
+    '''Waits until an update of the function has finished'''
+    def _wait_updated(self):
+        with self._report.phase('wait function updated'):
             waiter = self._lambda_client.get_waiter('function_updated')
             LOG.debug("Waiting for lambda function to be updated")
             waiter.wait(FunctionName=self._config.name)
 
-            resp = self._lambda_client.publish_version(
-                    FunctionName=self._config.name,
-                    )
-            LOG.debug("AWS publish_version response: %s" % resp)
-            version = resp.get('Version')
-
-        return version
-
     '''
     Creates and uploads a new lambda function
 
@@ -108,29 +159,29 @@ class PackageUploader(object):
         code = {}
         if self._config.s3_bucket:
             code = {'S3Bucket': self._config.s3_bucket,
-                    'S3Key': self._config.s3_package_name()}
-            self._upload_s3(pkg.zip_file)
+                    'S3Key': self._upload_package_s3(pkg)}
         else:
             self._validate_package_size(pkg.zip_file)
-            with open(pkg.zip_file, "rb") as fil:
-                zip_file = fil.read()
-            code = {'ZipFile': zip_file}
+            code = {'ZipFile': _read_file(pkg.zip_file)}
 
         LOG.debug('running create_function_code')
-        response = self._lambda_client.create_function(
-            FunctionName=self._config.name,
-            Runtime=self._config.runtime,
-            Handler=self._config.handler,
-            Role=self._config.role,
-            Code=code,
-            Description=self._config.description,
-            Timeout=self._config.timeout,
-            MemorySize=self._config.memory,
-            Publish=self._config.publish,
-            VpcConfig=self._vpc_config,
-            Environment=environment,
-            TracingConfig=self._config.tracing,
-        )
+        with self._report.phase('create function'):
+            self._report.add(bytes=len(code.get('ZipFile', b'')))
+            response = self._lambda_client.create_function(
+                FunctionName=self._config.name,
+                Runtime=self._config.runtime,
+                Handler=self._config.handler,
+                Role=self._config.role,
+                Code=code,
+                Description=self._config.description,
+                Timeout=self._config.timeout,
+                MemorySize=self._config.memory,
+                Publish=self._config.publish,
+                VpcConfig=self._vpc_config,
+                Environment=environment,
+                TracingConfig=self._config.tracing,
+                **self._layers_param()
+            )
         LOG.debug("AWS create_function response: %s" % response)
 
         return response.get('Version')
@@ -140,20 +191,113 @@ class PackageUploader(object):
     the appropriate method (upload_existing or upload_new).
     '''
     def upload(self, pkg):
+        if self._config.layer_name and pkg.layer_zip_file and \
+           path.isfile(pkg.layer_zip_file):
+            with self._report.phase('publish layer'):
+                self._layers = [self.publish_layer(pkg)]
+
         existing_function = True
+        get_resp = {}
         try:
-            get_resp = self._lambda_client.get_function_configuration(
-                    FunctionName=self._config.name)
+            with self._report.phase('get function configuration'):
+                get_resp = self._lambda_client.get_function_configuration(
+                        FunctionName=self._config.name)
             LOG.debug("AWS get_function_configuration response: %s" % get_resp)
-        except:  # noqa: E722
+        except ClientError as ex:
+            if ex.response['Error']['Code'] != 'ResourceNotFoundException':
+                raise
             existing_function = False
             LOG.debug("function not found creating new function")
 
         if existing_function:
-            self.version = self.upload_existing(pkg)
+            self.version = self.upload_existing(pkg, get_resp)
         else:
             self.version = self.upload_new(pkg)
 
+    '''
+    Updates only the configuration of an existing function, leaving its
+    code as it is.
+    '''
+    def upload_configuration(self):
+        with self._report.phase('get function configuration'):
+            get_resp = self._lambda_client.get_function_configuration(
+                    FunctionName=self._config.name)
+        LOG.debug("AWS get_function_configuration response: %s" % get_resp)
+        self.version = self.upload_existing(None, get_resp)
+
+    '''Returns the configuration update_function_configuration is sent'''
+    def _function_configuration(self):
+        configuration = {
+            'Handler': self._config.handler,
+            'Role': self._config.role,
+            'Description': self._config.description,
+            'Timeout': self._config.timeout,
+            'MemorySize': self._config.memory,
+            'VpcConfig': self._vpc_config,
+            'Environment': {'Variables': self._config.variables},
+            'TracingConfig': self._config.tracing,
+            'Runtime': self._config.runtime,
+        }
+        configuration.update(self._layers_param())
+        return configuration
+
+    '''
+    Returns the fields of the function configuration that differ from the
+    current configuration of the deployed function
+    '''
+    def _configuration_changes(self, current):
+        changes = {}
+        for key, value in self._function_configuration().items():
+            if not _same_configuration(key, value, current):
+                changes[key] = value
+        return changes
+
+    '''
+    Publishes the dependencies layer of the package unless a version built
+    from the same requirements exists already.
+
+    returns the layer version ARN
+    '''
+    def publish_layer(self, pkg):
+        name = self._config.layer_name
+        layer_hash = pkg.layer_hash
+        if layer_hash is None:
+            layer_hash = _file_sha256(pkg.layer_zip_file).hexdigest()
+        description = LAYER_DESCRIPTION % layer_hash
+
+        paginator = self._lambda_client.get_paginator('list_layer_versions')
+        for page in paginator.paginate(LayerName=name):
+            for layer_version in page.get('LayerVersions', []):
+                if layer_version.get('Description') == description:
+                    LOG.info('Layer %s is up to date' % name)
+                    return layer_version['LayerVersionArn']
+
+        if self._config.s3_bucket:
+            key = '%s-%s.zip' % (name, layer_hash)
+            # The key is named after the requirements
+            self._upload_s3(pkg.layer_zip_file, key, reuse=True)
+            content = {'S3Bucket': self._config.s3_bucket, 'S3Key': key}
+        else:
+            self._validate_package_size(pkg.layer_zip_file)
+            content = {'ZipFile': _read_file(pkg.layer_zip_file)}
+
+        LOG.debug('running publish_layer_version')
+        resp = self._lambda_client.publish_layer_version(
+                LayerName=name,
+                Description=description,
+                Content=content,
+                CompatibleRuntimes=[self._config.runtime],
+                )
+        LOG.debug("AWS publish_layer_version response: %s" % resp)
+        self.layer_published = True
+        return resp['LayerVersionArn']
+
+    def _layers_param(self):
+        '''Only manage the function layers in layer mode'''
+        if self._layers is None:
+            return {}
+        return {'Layers': self._layers}
+
     '''
     Create/update an alias to point to the package. Raises an
     exception if the package has not been uploaded.
@@ -163,24 +307,75 @@ class PackageUploader(object):
         if self.version is None:
             raise Exception('Must upload package before applying alias')
 
-        if self._alias_exists():
-            self._update_alias()
-        else:
-            self._create_alias()
+        with self._report.phase('alias'):
+            if self._alias_exists():
+                self._update_alias()
+            else:
+                self._create_alias()
 
     '''
     Pulls down the current list of aliases and checks to see if
     an alias exists.
     '''
     def _alias_exists(self):
-        resp = self._lambda_client.list_aliases(
-                FunctionName=self._config.name)
-
-        for alias in resp.get('Aliases'):
+        for alias in self._list_aliases():
             if alias.get('Name') == self._config.alias:
                 return True
         return False
 
+    '''Returns every alias of the function'''
+    def _list_aliases(self):
+        paginator = self._lambda_client.get_paginator('list_aliases')
+        aliases = []
+        for page in paginator.paginate(FunctionName=self._config.name):
+            aliases.extend(page.get('Aliases', []))
+        return aliases
+
+    '''
+    Deletes all published versions except the keep most recent ones, the
+    versions aliases point to and the version just uploaded. With dry_run
+    nothing is deleted.
+
+    returns the versions that are, or would be, deleted
+    '''
+    def prune_versions(self, keep, dry_run=False):
+        with self._report.phase('prune versions'):
+            versions = []
+            paginator = self._lambda_client.get_paginator(
+                'list_versions_by_function')
+            for page in paginator.paginate(FunctionName=self._config.name):
+                for version in page.get('Versions', []):
+                    if version['Version'] != '$LATEST':
+                        versions.append(version['Version'])
+            versions.sort(key=int, reverse=True)
+
+            retained = set(versions[:keep])
+            if self.version is not None:
+                retained.add(self.version)
+            for alias in self._list_aliases():
+                retained.add(alias['FunctionVersion'])
+                weights = (alias.get('RoutingConfig') or {}).get(
+                    'AdditionalVersionWeights') or {}
+                retained.update(weights.keys())
+
+            prune = [v for v in versions if v not in retained]
+            LOG.info('Pruning %d of %d versions%s'
+                     % (len(prune), len(versions),
+                        dry_run and ' (dry run)' or ''))
+            if prune and not dry_run:
+                pool = ThreadPool(min(DELETE_WORKERS, len(prune)))
+                try:
+                    pool.map(self._delete_version, prune)
+                finally:
+                    pool.close()
+                    pool.join()
+        return prune
+
+    def _delete_version(self, version):
+        LOG.debug('Deleting version %s' % version)
+        self._lambda_client.delete_function(FunctionName=self._config.name,
+                                            Qualifier=version)
+
     '''Creates alias'''
     def _create_alias(self):
         LOG.debug("Creating new alias %s" % self._config.alias)
@@ -226,11 +421,137 @@ class PackageUploader(object):
                 'SecurityGroupIds': [],
             }
 
-    def _upload_s3(self, zip_file):
+    def s3_stream(self):
+        '''
+        Returns a stream that uploads the package zip to s3 while it is
+        written, see Package._write_zip
+        '''
+        settings = dict(DEFAULT_S3_TRANSFER)
+        settings.update(self._config.s3_transfer)
+        return multipart.MultipartUpload(
+            self._client_s3(), self._config.s3_bucket,
+            self._config.s3_package_name(),
+            part_size=settings['multipart_chunksize'],
+            workers=settings['max_concurrency'])
+
+    def _upload_package_s3(self, pkg):
+        '''
+        Uploads the package zip unless it was streamed to s3 already, or is
+        there already under its content addressed key. Returns the key.
+        '''
+        if self._config.s3_content_addressed:
+            key = self._config.s3_content_key(
+                _file_sha256(pkg.zip_file).hexdigest())
+            self._upload_s3(pkg.zip_file, key, reuse=True)
+            return key
+
+        key = self._config.s3_package_name()
+        if pkg.s3_object == (self._config.s3_bucket, key):
+            LOG.info('Package was uploaded to s3 while it was built')
+        else:
+            self._upload_s3(pkg.zip_file, key)
+        return key
+
+    def _upload_s3(self, zip_file, key=None, reuse=False):
+        '''
+        Uploads the lambda package to s3. With reuse set the key identifies
+        the content, so an existing object is not uploaded again.
+        '''
+        key = key or self._config.s3_package_name()
+        if reuse and self._s3_object_exists(key):
+            LOG.info('s3://%s/%s exists already, skipping upload'
+                     % (self._config.s3_bucket, key))
+            self.s3_reused.append(key)
+            return
+
+        size = path.getsize(zip_file)
+        transfer = self._transfer()
+        with self._report.phase('s3 upload'):
+            self._report.add(1, size)
+            start = time.time()
+            transfer.upload_file(zip_file, self._config.s3_bucket, key)
+            seconds = time.time() - start
+        LOG.info('Uploaded %d bytes to s3://%s/%s in %.1fs'
+                 % (size, self._config.s3_bucket, key, seconds))
+        self.s3_uploads.append((key, size, seconds))
+
+    def _s3_object_exists(self, key):
+        with self._report.phase('s3 head object'):
+            try:
+                self._client_s3().head_object(Bucket=self._config.s3_bucket,
+                                              Key=key)
+            except ClientError as ex:
+                if ex.response['Error']['Code'] in MISSING_OBJECT_CODES:
+                    return False
+                raise
+        return True
+
+    def _transfer(self):
         '''
-        Uploads the lambda package to s3
+        Returns the S3 transfer of this uploader, configured from the
+        s3_transfer settings on top of DEFAULT_S3_TRANSFER
         '''
-        s3_client = self._aws_session.client('s3')
-        transfer = boto3.s3.transfer.S3Transfer(s3_client)
-        transfer.upload_file(zip_file, self._config.s3_bucket,
-                             self._config.s3_package_name())
+        if self._s3_transfer is None:
+            settings = dict(DEFAULT_S3_TRANSFER)
+            settings.update(self._config.s3_transfer)
+            self._s3_transfer = boto3.s3.transfer.S3Transfer(
+                self._client_s3(),
+                boto3.s3.transfer.TransferConfig(**settings))
+        return self._s3_transfer
+
+    def _client_s3(self):
+        if self._s3_client is None:
+            self._s3_client = self._report.watch(self._client('s3'))
+        return self._s3_client
+
+    def _client(self, service, retries=True):
+        return clients.client(service, self._config.region,
+                              self._profile_name, self._config.aws_client,
+                              retries=retries)
+
+
+def _same_configuration(key, value, current):
+    '''
+    Compares a field of update_function_configuration with the
+    get_function_configuration response, which reports some fields in a
+    different shape than they are sent
+    '''
+    if key not in current and key not in OPTIONAL_CONFIGURATION:
+        return False
+    live = current.get(key)
+    if key == 'VpcConfig':
+        live = live or {}
+        return all(sorted(value.get(k) or []) == sorted(live.get(k) or [])
+                   for k in ('SubnetIds', 'SecurityGroupIds'))
+    if key == 'Environment':
+        return (value.get('Variables') or {}) == \
+            ((live or {}).get('Variables') or {})
+    if key == 'TracingConfig':
+        # Nothing configured leaves the tracing mode alone
+        return not value or \
+            value.get('Mode') == (live or {}).get('Mode', 'PassThrough')
+    if key == 'Layers':
+        return value == [layer.get('Arn') for layer in live or []]
+    return value == live
+
+
+def _read_file(zip_file):
+    '''
+    Reads a zip into memory for a direct upload. S3 uploads stream from disk
+    instead, so only call this on the direct upload path.
+    '''
+    with open(zip_file, 'rb') as fil:
+        return fil.read()
+
+
+def _code_sha256(zip_file):
+    '''Returns the base64 encoded SHA-256 of a file, as Lambda reports it'''
+    return base64.b64encode(_file_sha256(zip_file).digest()).decode('ascii')
+
+
+def _file_sha256(zip_file):
+    sha = hashlib.sha256()
+    with open(zip_file, 'rb') as fil:
+        for chunk in iter(lambda: fil.read(utils.HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha
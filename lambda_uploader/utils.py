@@ -19,9 +19,11 @@ import re
 
 
 LOG = logging.getLogger(__name__)
+HASH_CHUNK_SIZE = 1024 * 1024
 
 
 def copy_tree(src, dest, ignore=None, include_parent=False):
+    '''Copies src into dest and returns the number of files and bytes copied'''
     ignore = ignore or []
     if os.path.isfile(src):
         raise Exception('Cannot use copy_tree with a file as the src')
@@ -36,27 +38,134 @@ def copy_tree(src, dest, ignore=None, include_parent=False):
     else:
         nested_dest = dest
 
+    files = 0
+    size = 0
     # Re-create directory structure
-    for root, _, files in os.walk(src):
+    for path, relpath in walk_tree(src, ignore):
+        pkg_path = os.path.join(nested_dest, os.path.dirname(relpath))
+        if not os.path.isdir(pkg_path):
+            os.makedirs(pkg_path)
+
+        LOG.debug("Copying %s to %s" % (path, pkg_path))
+        if os.path.islink(path):
+            linkto = os.readlink(path)
+            os.symlink(linkto.replace(src, dest, 1),
+                       os.path.join(pkg_path, os.path.basename(path)))
+        else:
+            shutil.copy(path, pkg_path)
+            size += os.path.getsize(path)
+        files += 1
+
+    return files, size
+
+
+def walk_tree(src, ignore=None, sort=False):
+    '''
+    Yields (path, relative path) for every file under src whose path relative
+    to src is not matched by the ignore list or IgnoreMatcher. Directories
+    that are ignored as a whole are not walked at all.
+    '''
+    matcher = ignore_matcher(ignore)
+    for root, dirs, files in os.walk(src):
+        reldir = os.path.relpath(root, src)
+        if reldir == os.curdir:
+            reldir = ''
+        dirs[:] = [d for d in dirs
+                   if not matcher.match_dir(os.path.join(reldir, d))]
+        if sort:
+            dirs.sort()
+            files = sorted(files)
         for filename in files:
             path = os.path.join(root, filename)
-            path_relative_to_the_source_dir = os.path.relpath(path, src)
-            if _ignore_file(path_relative_to_the_source_dir, ignore):
+            relpath = os.path.join(reldir, filename)
+            if matcher.match(relpath):
                 continue
+            yield path, relpath
+
+
+def hash_tree(hasher, src, ignore=None):
+    '''
+    Feeds the relative path and contents of every file under src that is not
+    ignored into hasher. The walk is sorted so the digest is stable.
+    '''
+    for path, relpath in walk_tree(src, ignore, sort=True):
+        hash_file(hasher, path, relpath)
+
+
+def hash_file(hasher, path, name=None):
+    '''Feeds a file name and its contents into hasher'''
+    hasher.update((name or os.path.basename(path)).encode('utf-8'))
+    hasher.update(b'\0')
+    if not os.path.exists(path):
+        # Dangling symlink, all we can go on is where it points
+        hasher.update(os.readlink(path).encode('utf-8'))
+    else:
+        with open(path, 'rb') as fil:
+            for chunk in iter(lambda: fil.read(HASH_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+    hasher.update(b'\0')
+
+
+class IgnoreMatcher(object):
+    '''
+    Matches relative paths against a list of ignore regular expressions that
+    are compiled once.
+
+    A directory is ignored as a whole when a pattern matches its path with a
+    trailing separator and the pattern can not stop matching once more of the
+    path follows, i.e. it has no end anchors, word boundaries or lookaheads.
+    Every file below such a directory would be ignored anyway.
+    '''
+    def __init__(self, patterns=None):
+        self._patterns = []
+        self._dir_patterns = []
+        self.extend(patterns or [])
+
+    def add(self, pattern):
+        '''Compiles and adds a single pattern'''
+        regex = re.compile(pattern)
+        self._patterns.append(regex)
+        if not _PREFIX_UNSTABLE.search(pattern):
+            self._dir_patterns.append(regex)
+
+    def extend(self, patterns):
+        for pattern in patterns:
+            self.add(pattern)
+
+    def copy(self):
+        '''Returns a new matcher sharing the compiled patterns'''
+        matcher = IgnoreMatcher()
+        matcher._patterns = list(self._patterns)
+        matcher._dir_patterns = list(self._dir_patterns)
+        return matcher
+
+    def match(self, path):
+        '''Returns True if the relative file path should be ignored'''
+        for regex in self._patterns:
+            if regex.search(path):
+                return True
+        return False
+
+    def match_dir(self, path):
+        '''Returns True if everything under the relative directory path
+        should be ignored'''
+        path = path + os.sep
+        for regex in self._dir_patterns:
+            if regex.search(path):
+                return True
+        return False
+
+
+# Patterns containing any of these may match a directory prefix without
+# matching the files below it, so they are never used to prune directories
+_PREFIX_UNSTABLE = re.compile(r'\$|\\[ZbB]|\(\?[=!]')
 
-            sub_dirs = os.path.dirname(os.path.relpath(path,
-                                                       start=src))
-            pkg_path = os.path.join(nested_dest, sub_dirs)
-            if not os.path.isdir(pkg_path):
-                os.makedirs(pkg_path)
 
-            LOG.debug("Copying %s to %s" % (path, pkg_path))
-            if os.path.islink(path):
-                linkto = os.readlink(path)
-                os.symlink(linkto.replace(src, dest, 1),
-                           os.path.join(pkg_path, filename))
-            else:
-                shutil.copy(path, pkg_path)
+def ignore_matcher(ignore=None):
+    '''Returns ignore as an IgnoreMatcher, compiling a list of patterns'''
+    if isinstance(ignore, IgnoreMatcher):
+        return ignore
+    return IgnoreMatcher(ignore)
 
 
 # Iterate through every item in ignore
@@ -65,7 +174,4 @@ def _ignore_file(path, ignore=None):
     ignore = ignore or []
     if not ignore:
         return False
-    for ign in ignore:
-        if re.search(ign, path):
-            return True
-    return False
+    return ignore_matcher(ignore).match(path)
@@ -4,9 +4,11 @@ import ast
 import re
 from setuptools import setup, find_packages
 
+# ScalingConfig of SQS event source mappings is the newest API used, retry
+# modes and max_pool_connections need much older releases
 INSTALL_REQUIRES = [
-    'boto3>=1.4.2',
-    'botocore>=1.4.85',
+    'boto3>=1.26.50',
+    'botocore>=1.29.50',
     'virtualenv',
 ]
 
@@ -70,10 +72,9 @@ setup(
     packages=find_packages(exclude=['tests']),
     test_suite='tests',
     classifiers=[
-        "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.4",
-        "Programming Language :: Python :: 3.5",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.11",
     ],
     license=_lu_meta['license'],
     author="Rackers",
@@ -81,7 +82,9 @@ setup(
     url=_lu_meta['url'],
     entry_points={
         'console_scripts': [
-            'lambda-uploader=lambda_uploader.shell:main'
+            'lambda-uploader=lambda_uploader.shell:main',
+            'lambda-uploader-batch=lambda_uploader.batch:main',
+            'lambda-uploader-bench=lambda_uploader.bench:main',
         ]
     },
 )
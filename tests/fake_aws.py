@@ -0,0 +1,423 @@
+'''
+An in-process stand-in for the parts of Lambda and S3 lambda-uploader uses.
+
+FakeAWS answers API calls from botocore's before-call event, so requests
+never leave the process and no credentials are needed. It keeps functions,
+versions, aliases, event source mappings, layers and S3 objects in memory,
+counts every call and can add a fixed latency to each one.
+
+    with FakeAWS(latency=0.01) as aws:
+        shell._execute(args)
+    aws.calls  # {'GetFunctionConfiguration': 1, 'CreateFunction': 1}
+'''
+import base64
+import hashlib
+import threading
+import time
+import uuid
+
+from lambda_uploader import clients
+
+ACCOUNT = '000000000000'
+PARAMS_KEY = 'fake_aws_params'
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = b''
+        self.raw = None
+
+
+class FakeError(Exception):
+    def __init__(self, code, status_code=400, message=''):
+        Exception.__init__(self, code)
+        self.code = code
+        self.status_code = status_code
+        self.message = message or code
+
+
+class FakeAWS(object):
+    def __init__(self, latency=0.0, region='us-east-1'):
+        self.latency = latency
+        self.region = region
+        self.calls = {}
+        self.functions = {}
+        self.mappings = {}
+        self.layers = {}
+        self.objects = {}
+        self.bytes_received = 0
+        # How many more times each operation is throttled
+        self.throttles = {}
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def install(self):
+        '''Answers the calls of every client created from now on'''
+        clients.clear()
+        events = clients.session().events
+        events.register('before-parameter-build', self._capture_params,
+                        unique_id='fake-aws-params')
+        # Last, so the handlers that count calls still see them
+        events.register_last('before-call', self._call,
+                             unique_id='fake-aws-call')
+
+    def uninstall(self):
+        clients.clear()
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def _capture_params(self, params, context, **kwargs):
+        context[PARAMS_KEY] = dict(params)
+
+    def _call(self, model, context, **kwargs):
+        params = context.get(PARAMS_KEY, {})
+        with self._lock:
+            self.calls[model.name] = self.calls.get(model.name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        handler = getattr(self, '_%s' % _snake_case(model.name), None)
+        try:
+            if handler is None:
+                raise FakeError('NotImplemented', 501,
+                                '%s is not emulated' % model.name)
+            with self._lock:
+                if self.throttles.get(model.name):
+                    self.throttles[model.name] -= 1
+                    raise FakeError('TooManyRequestsException', 429,
+                                    'Rate exceeded')
+                parsed = handler(params) or {}
+            response = FakeResponse(200)
+        except FakeError as ex:
+            parsed = {'Error': {'Code': ex.code, 'Message': ex.message}}
+            response = FakeResponse(ex.status_code)
+        parsed.setdefault('ResponseMetadata', {
+            'HTTPStatusCode': response.status_code, 'HTTPHeaders': {},
+            'RequestId': str(uuid.uuid4())})
+        return response, parsed
+
+    # Lambda functions
+
+    def _function(self, name):
+        name = name.split(':')[-1]
+        if name not in self.functions:
+            raise FakeError('ResourceNotFoundException', 404,
+                            'Function not found: %s' % name)
+        return self.functions[name]
+
+    def _configuration(self, function, qualifier=None):
+        if qualifier and qualifier != '$LATEST':
+            if qualifier in function['aliases']:
+                qualifier = function['aliases'][qualifier]['FunctionVersion']
+            for version in function['versions']:
+                if version['Version'] == qualifier:
+                    return dict(version)
+            raise FakeError('ResourceNotFoundException', 404)
+        return dict(function['latest'])
+
+    def _get_function_configuration(self, params):
+        function = self._function(params['FunctionName'])
+        return self._configuration(function, params.get('Qualifier'))
+
+    def _get_function(self, params):
+        return {'Configuration': self._get_function_configuration(params)}
+
+    def _create_function(self, params):
+        name = params['FunctionName']
+        if name in self.functions:
+            raise FakeError('ResourceConflictException', 409)
+        latest = {
+            'FunctionName': name,
+            'FunctionArn': self._arn(name),
+            'Version': '$LATEST',
+            'State': 'Active',
+            'LastUpdateStatus': 'Successful',
+        }
+        self.functions[name] = {'latest': latest, 'versions': [],
+                                'aliases': {}}
+        self._set_code(latest, params['Code'])
+        self._set_configuration(latest, params)
+        if params.get('Publish'):
+            return self._publish(self.functions[name])
+        return dict(latest)
+
+    def _update_function_code(self, params):
+        function = self._function(params['FunctionName'])
+        self._set_code(function['latest'], params)
+        if params.get('Publish'):
+            return self._publish(function)
+        return dict(function['latest'])
+
+    def _update_function_configuration(self, params):
+        function = self._function(params['FunctionName'])
+        self._set_configuration(function['latest'], params)
+        return dict(function['latest'])
+
+    def _publish_version(self, params):
+        return self._publish(self._function(params['FunctionName']))
+
+    def _list_versions_by_function(self, params):
+        function = self._function(params['FunctionName'])
+        versions = [dict(function['latest'])] + \
+            [dict(v) for v in function['versions']]
+        return _page(versions, 'Versions', params)
+
+    def _delete_function(self, params):
+        function = self._function(params['FunctionName'])
+        qualifier = params.get('Qualifier')
+        if not qualifier:
+            del self.functions[function['latest']['FunctionName']]
+            return
+        for alias in function['aliases'].values():
+            if alias['FunctionVersion'] == qualifier:
+                raise FakeError('ResourceConflictException', 409,
+                                'Version is referenced by an alias')
+        self._configuration(function, qualifier)
+        function['versions'] = [v for v in function['versions']
+                                if v['Version'] != qualifier]
+
+    def _list_aliases(self, params):
+        function = self._function(params['FunctionName'])
+        aliases = [dict(a) for a in function['aliases'].values()]
+        return _page(aliases, 'Aliases', params)
+
+    def _create_alias(self, params):
+        function = self._function(params['FunctionName'])
+        if params['Name'] in function['aliases']:
+            raise FakeError('ResourceConflictException', 409)
+        return self._set_alias(function, params)
+
+    def _update_alias(self, params):
+        function = self._function(params['FunctionName'])
+        if params['Name'] not in function['aliases']:
+            raise FakeError('ResourceNotFoundException', 404)
+        return self._set_alias(function, params)
+
+    def _set_alias(self, function, params):
+        self._configuration(function, params['FunctionVersion'])
+        alias = {
+            'Name': params['Name'],
+            'AliasArn': '%s:%s' % (function['latest']['FunctionArn'],
+                                   params['Name']),
+            'FunctionVersion': params['FunctionVersion'],
+            'Description': params.get('Description', ''),
+        }
+        if params.get('RoutingConfig'):
+            alias['RoutingConfig'] = params['RoutingConfig']
+        function['aliases'][params['Name']] = alias
+        return dict(alias)
+
+    def _set_code(self, configuration, code):
+        if 'ZipFile' in code:
+            data = code['ZipFile']
+            if not isinstance(data, bytes):
+                data = base64.b64decode(data)
+            self.bytes_received += len(data)
+        else:
+            data = self._object(code['S3Bucket'], code['S3Key'])
+        configuration['CodeSha256'] = base64.b64encode(
+            hashlib.sha256(data).digest()).decode('ascii')
+        configuration['CodeSize'] = len(data)
+
+    def _set_configuration(self, configuration, params):
+        for key in ('Handler', 'Role', 'Description', 'Timeout', 'MemorySize',
+                    'Runtime', 'Environment', 'TracingConfig'):
+            if key in params:
+                configuration[key] = params[key]
+        if 'VpcConfig' in params:
+            vpc = dict(params['VpcConfig'])
+            if vpc.get('SubnetIds'):
+                vpc['VpcId'] = 'vpc-00000000'
+            configuration['VpcConfig'] = vpc
+        if 'Layers' in params:
+            configuration['Layers'] = [{'Arn': arn} for arn in
+                                       params['Layers']]
+
+    def _publish(self, function):
+        latest = function['latest']
+        if function['versions'] and \
+           function['versions'][-1]['CodeSha256'] == latest['CodeSha256'] \
+           and _same_fields(function['versions'][-1], latest):
+            # Lambda does not publish a version without changes
+            return dict(function['versions'][-1])
+        number = str(len(function['versions']) and
+                     int(function['versions'][-1]['Version']) + 1 or 1)
+        version = dict(latest)
+        version['Version'] = number
+        version['FunctionArn'] = '%s:%s' % (latest['FunctionArn'], number)
+        function['versions'].append(version)
+        return dict(version)
+
+    def _arn(self, name):
+        return 'arn:aws:lambda:%s:%s:function:%s' % (self.region, ACCOUNT,
+                                                      name)
+
+    # Event source mappings
+
+    def _create_event_source_mapping(self, params):
+        function = self._function(params['FunctionName'])
+        for mapping in self.mappings.values():
+            if mapping.get('EventSourceArn') == params['EventSourceArn'] and \
+               mapping['FunctionArn'] == function['latest']['FunctionArn']:
+                raise FakeError('ResourceConflictException', 409)
+        mapping = {
+            'UUID': str(uuid.uuid4()),
+            'EventSourceArn': params['EventSourceArn'],
+            'FunctionArn': function['latest']['FunctionArn'],
+            'State': 'Enabled',
+        }
+        self.mappings[mapping['UUID']] = mapping
+        self._set_mapping(mapping, params)
+        return dict(mapping)
+
+    def _list_event_source_mappings(self, params):
+        mappings = []
+        for mapping in self.mappings.values():
+            if 'FunctionName' in params and \
+               mapping['FunctionArn'].split(':')[-1] != \
+               params['FunctionName'].split(':')[-1]:
+                continue
+            if 'EventSourceArn' in params and \
+               mapping.get('EventSourceArn') != params['EventSourceArn']:
+                continue
+            mappings.append(dict(mapping))
+        return _page(mappings, 'EventSourceMappings', params)
+
+    def _update_event_source_mapping(self, params):
+        mapping = self._mapping(params['UUID'])
+        self._set_mapping(mapping, params)
+        return dict(mapping)
+
+    def _delete_event_source_mapping(self, params):
+        mapping = self._mapping(params['UUID'])
+        del self.mappings[mapping['UUID']]
+        return dict(mapping, State='Deleting')
+
+    def _mapping(self, mapping_uuid):
+        if mapping_uuid not in self.mappings:
+            raise FakeError('ResourceNotFoundException', 404)
+        return self.mappings[mapping_uuid]
+
+    def _set_mapping(self, mapping, params):
+        for key, value in params.items():
+            if key not in ('UUID', 'FunctionName', 'Enabled'):
+                mapping[key] = value
+        if 'Enabled' in params:
+            mapping['State'] = params['Enabled'] and 'Enabled' or 'Disabled'
+
+    # Layers
+
+    def _list_layer_versions(self, params):
+        versions = [dict(v) for v in
+                    reversed(self.layers.get(params['LayerName'], []))]
+        return _page(versions, 'LayerVersions', params)
+
+    def _publish_layer_version(self, params):
+        name = params['LayerName']
+        versions = self.layers.setdefault(name, [])
+        number = len(versions) + 1
+        content = params['Content']
+        if 'ZipFile' in content:
+            self.bytes_received += len(content['ZipFile'])
+        else:
+            self._object(content['S3Bucket'], content['S3Key'])
+        version = {
+            'LayerVersionArn': 'arn:aws:lambda:%s:%s:layer:%s:%d'
+                               % (self.region, ACCOUNT, name, number),
+            'Version': number,
+            'Description': params.get('Description', ''),
+        }
+        versions.append(version)
+        return dict(version)
+
+    # S3
+
+    def _object(self, bucket, key):
+        if (bucket, key) not in self.objects:
+            raise FakeError('NoSuchKey', 404)
+        return self.objects[(bucket, key)]
+
+    def _put_object(self, params):
+        data = _read(params['Body'])
+        self.bytes_received += len(data)
+        self.objects[(params['Bucket'], params['Key'])] = data
+        return {'ETag': '"%s"' % hashlib.md5(data).hexdigest()}
+
+    def _head_object(self, params):
+        try:
+            data = self._object(params['Bucket'], params['Key'])
+        except FakeError:
+            # HEAD responses have no body, so S3 only reports the status
+            raise FakeError('404', 404)
+        return {'ContentLength': len(data)}
+
+    def _create_multipart_upload(self, params):
+        upload_id = str(uuid.uuid4())
+        self._uploads[upload_id] = {}
+        return {'Bucket': params['Bucket'], 'Key': params['Key'],
+                'UploadId': upload_id}
+
+    def _upload_part(self, params):
+        data = _read(params['Body'])
+        self.bytes_received += len(data)
+        self._upload(params)[params['PartNumber']] = data
+        return {'ETag': '"%s"' % hashlib.md5(data).hexdigest()}
+
+    def _complete_multipart_upload(self, params):
+        parts = self._upload(params)
+        numbers = [p['PartNumber'] for p in
+                   params['MultipartUpload']['Parts']]
+        self.objects[(params['Bucket'], params['Key'])] = \
+            b''.join(parts[n] for n in numbers)
+        del self._uploads[params['UploadId']]
+        return {'Bucket': params['Bucket'], 'Key': params['Key']}
+
+    def _abort_multipart_upload(self, params):
+        self._upload(params)
+        del self._uploads[params['UploadId']]
+
+    def _upload(self, params):
+        if params['UploadId'] not in self._uploads:
+            raise FakeError('NoSuchUpload', 404)
+        return self._uploads[params['UploadId']]
+
+
+def _same_fields(version, latest):
+    return all(version.get(k) == latest.get(k) for k in latest
+               if k not in ('Version', 'FunctionArn'))
+
+
+def _page(items, key, params):
+    '''Pages a list the way the Lambda List* calls do'''
+    start = int(params.get('Marker') or 0)
+    size = params.get('MaxItems') or 50
+    response = {key: items[start:start + size]}
+    if start + size < len(items):
+        response['NextMarker'] = str(start + size)
+    return response
+
+
+def _read(body):
+    if hasattr(body, 'read'):
+        return body.read()
+    return body
+
+
+def _snake_case(name):
+    chars = []
+    for i, char in enumerate(name):
+        if char.isupper() and i:
+            chars.append('_')
+        chars.append(char.lower())
+    return ''.join(chars)
@@ -0,0 +1,148 @@
+import io
+import os
+import zipfile
+
+from os import path
+from mock import patch
+from shutil import rmtree
+from lambda_uploader import archive
+
+TESTING_TEMP_DIR = '.testing_temp'
+ZIP_FILE = path.join(TESTING_TEMP_DIR, 'test.zip')
+
+
+def setup_module(module):
+    os.mkdir(TESTING_TEMP_DIR)
+
+
+def teardown_module(module):
+    rmtree(TESTING_TEMP_DIR)
+
+
+def _entries():
+    entries = []
+    for i in range(50):
+        fil = path.join(TESTING_TEMP_DIR, 'file%d.py' % i)
+        with open(fil, 'w') as tfile:
+            tfile.write('print(%d)\n' % i * (i + 1))
+        entries.append((fil, 'pkg/file%d.py' % i))
+    open(path.join(TESTING_TEMP_DIR, 'empty'), 'w').close()
+    entries.append((path.join(TESTING_TEMP_DIR, 'empty'), 'empty'))
+    return entries
+
+
+def test_zip_writer():
+    entries = _entries()
+    zw = archive.ZipWriter(ZIP_FILE)
+    zw.write_all(entries)
+    zw.close()
+
+    zf = zipfile.ZipFile(ZIP_FILE)
+    assert zf.testzip() is None
+    assert zf.namelist() == [arcname for _, arcname in entries]
+    with open(entries[3][0], 'rb') as fil:
+        assert zf.read('pkg/file3.py') == fil.read()
+
+
+def test_zip_writer_parallel():
+    entries = _entries()
+    zw = archive.ZipWriter(ZIP_FILE, workers=4)
+    zw.write_all(entries)
+    zw.close()
+
+    zf = zipfile.ZipFile(ZIP_FILE)
+    assert zf.testzip() is None
+    # Entries are written in order regardless of which worker finished first
+    assert zf.namelist() == [arcname for _, arcname in entries]
+    for fil, arcname in entries:
+        with open(fil, 'rb') as tfile:
+            assert zf.read(arcname) == tfile.read()
+
+
+def test_zip_writer_reproducible():
+    entries = _entries()
+    zw = archive.ZipWriter(ZIP_FILE, reproducible=True)
+    zw.write_all(entries)
+    zw.close()
+    with open(ZIP_FILE, 'rb') as fil:
+        first = fil.read()
+
+    os.utime(entries[0][0], (0, 0))
+    os.chmod(entries[1][0], 0o600)
+    zw = archive.ZipWriter(ZIP_FILE, workers=2, reproducible=True)
+    zw.write_all(reversed(entries))
+    zw.close()
+    with open(ZIP_FILE, 'rb') as fil:
+        assert fil.read() == first
+
+    zf = zipfile.ZipFile(ZIP_FILE)
+    assert zf.namelist() == sorted(arcname for _, arcname in entries)
+    assert zf.getinfo('empty').date_time == archive.MIN_DATE_TIME
+
+
+def test_zip_writer_tee():
+    entries = _entries()
+    tee = io.BytesIO()
+    zw = archive.ZipWriter(ZIP_FILE, tee=tee)
+    zw.write_all(entries)
+    zw.close()
+
+    with open(ZIP_FILE, 'rb') as fil:
+        assert fil.read() == tee.getvalue()
+    zf = zipfile.ZipFile(tee)
+    assert zf.testzip() is None
+    assert zf.namelist() == [arcname for _, arcname in entries]
+
+
+def test_zip_writer_tee_reproducible():
+    entries = _entries()
+    big = path.join(TESTING_TEMP_DIR, 'big.so')
+    with open(big, 'wb') as fil:
+        fil.write(os.urandom(archive.STREAM_THRESHOLD + 10))
+    entries.insert(10, (big, 'big.so'))
+
+    zips = []
+    for workers in (1, 4):
+        for tee in (None, io.BytesIO()):
+            zw = archive.ZipWriter(ZIP_FILE, workers=workers,
+                                   reproducible=True, tee=tee)
+            zw.write_all(entries)
+            zw.close()
+            with open(ZIP_FILE, 'rb') as fil:
+                zips.append(fil.read())
+            if tee is not None:
+                assert tee.getvalue() == zips[-1]
+    # Streaming to S3 and the number of workers do not change the zip
+    assert len(set(zips)) == 1
+    zf = zipfile.ZipFile(io.BytesIO(zips[0]))
+    assert zf.testzip() is None
+    assert not [info for info in zf.infolist() if info.flag_bits & 0x08]
+
+
+def test_zip_writer_streams_large_files():
+    entries = _entries()
+    big = path.join(TESTING_TEMP_DIR, 'big.so')
+    with open(big, 'wb') as fil:
+        fil.write(os.urandom(archive.STREAM_THRESHOLD + 10))
+    entries.insert(10, (big, 'big.so'))
+
+    with patch('lambda_uploader.archive._compress',
+               side_effect=archive._compress) as compress:
+        zw = archive.ZipWriter(ZIP_FILE, workers=4)
+        zw.write_all(entries)
+        zw.close()
+        # The single worker path streams every file
+        zw = archive.ZipWriter(ZIP_FILE + '.1')
+        zw.write_all(entries)
+        zw.close()
+    compressed = [c[0][0] for c in compress.call_args_list]
+
+    # Large files never go through the in memory workers
+    assert big not in compressed
+    assert len(compressed) == len(entries) - 1
+    for zip_file in (ZIP_FILE, ZIP_FILE + '.1'):
+        zf = zipfile.ZipFile(zip_file)
+        assert zf.testzip() is None
+        assert zf.namelist() == [arcname for _, arcname in entries]
+        with open(big, 'rb') as fil:
+            assert zf.read('big.so') == fil.read()
@@ -0,0 +1,122 @@
+import json
+import os
+
+from os import path
+from shutil import rmtree
+from mock import Mock, patch
+from lambda_uploader import batch, shell
+
+TESTING_TEMP_DIR = '.testing_temp'
+EX_CONFIG = path.normpath(path.join(path.dirname(__file__),
+                          '../tests/configs'))
+
+
+def setup_module(module):
+    os.makedirs(path.join(TESTING_TEMP_DIR, 'venv'))
+    with open(path.join(EX_CONFIG, 'lambda.json')) as fil:
+        cfg = json.load(fil)
+    for name, requirements in [('func1', ['Jinja2']), ('func2', ['Jinja2']),
+                               ('func3', ['mock'])]:
+        os.mkdir(path.join(TESTING_TEMP_DIR, name))
+        cfg['requirements'] = requirements
+        with open(path.join(TESTING_TEMP_DIR, name, 'lambda.json'),
+                  'w') as fil:
+            json.dump(cfg, fil)
+        open(path.join(TESTING_TEMP_DIR, name, 'function.py'), 'w').close()
+
+
+def teardown_module(module):
+    rmtree(TESTING_TEMP_DIR)
+
+
+def test_function_dirs():
+    dirs = batch.function_dirs([path.join(TESTING_TEMP_DIR, 'func*'),
+                                path.join(TESTING_TEMP_DIR, 'func1')])
+    assert [path.basename(d) for d in dirs] == ['func1', 'func2', 'func3']
+
+
+def test_batch_build():
+    args = batch._arg_parser().parse_args(
+        ['--no-upload', '--build-workers', '2',
+         '--virtualenv', path.join(TESTING_TEMP_DIR, 'venv'),
+         path.join(TESTING_TEMP_DIR, 'func*')])
+    assert batch.execute(args)
+    for name in ['func1', 'func2', 'func3']:
+        assert path.isfile(path.join(TESTING_TEMP_DIR, name,
+                                     'lambda_function.zip'))
+
+
+def test_batch_shares_dependency_installs():
+    builds = []
+
+    def build(args, cfg, pth, shared_venv=None, prnt=None, report=None):
+        builds.append((path.basename(pth), shared_venv))
+        pkg = shell.package.Package(pth)
+        pkg._pkg_venv = path.join(pth, 'venv')
+        return pkg
+
+    args = batch._arg_parser().parse_args(
+        ['--no-upload', path.join(TESTING_TEMP_DIR, 'func*')])
+    with patch('lambda_uploader.shell._build', build):
+        assert batch.execute(args)
+
+    builds = dict(builds)
+    assert builds['func1'] is None
+    assert builds['func2'] == path.join(path.abspath(TESTING_TEMP_DIR),
+                                        'func1', 'venv')
+    assert builds['func3'] is None
+
+
+def test_batch_shares_install_after_cache_hit():
+    with open(path.join(EX_CONFIG, 'lambda.json')) as fil:
+        cfg = json.load(fil)
+    cfg['requirements'] = ['Jinja2']
+    for name in ['a', 'b', 'c']:
+        os.makedirs(path.join(TESTING_TEMP_DIR, 'group', name))
+        with open(path.join(TESTING_TEMP_DIR, 'group', name, 'lambda.json'),
+                  'w') as fil:
+            json.dump(cfg, fil)
+    builds = []
+
+    def build(args, cfg, pth, shared_venv=None, prnt=None, report=None):
+        builds.append((path.basename(pth), shared_venv))
+        pkg = shell.package.Package(pth)
+        # a is in the build cache and installs nothing
+        pkg.cache_hit = path.basename(pth) == 'a'
+        if not pkg.cache_hit and shared_venv is None:
+            pkg._pkg_venv = path.join(pth, 'venv')
+        return pkg
+
+    args = batch._arg_parser().parse_args(
+        ['--no-upload', path.join(TESTING_TEMP_DIR, 'group', '*')])
+    with patch('lambda_uploader.shell._build', build):
+        assert batch.execute(args)
+
+    assert builds == [('a', None), ('b', None),
+                      ('c', path.join(path.abspath(TESTING_TEMP_DIR),
+                                      'group', 'b', 'venv'))]
+    rmtree(path.join(TESTING_TEMP_DIR, 'group'))
+
+
+def test_requirements_key_local_requirements():
+    args = batch._arg_parser().parse_args(['--no-upload', TESTING_TEMP_DIR])
+
+    def keys(requirements):
+        keys = []
+        for name in ['func1', 'func2']:
+            fn = batch.Function(path.abspath(path.join(TESTING_TEMP_DIR,
+                                                       name)))
+            fn.cfg = Mock(runtime='python3.12', requirements=requirements)
+            keys.append(batch._requirements_key(args, fn))
+        return keys
+
+    assert len(set(keys(['Jinja2']))) == 1
+    # ./lib is a different directory for every function
+    assert len(set(keys(['Jinja2', '-e ./lib']))) == 2
+
+
+def test_batch_reports_failures():
+    args = batch._arg_parser().parse_args(
+        ['--no-upload', path.join(TESTING_TEMP_DIR, 'func*')])
+    with patch('lambda_uploader.shell._build', side_effect=Exception('boom')):
+        assert not batch.execute(args)
@@ -0,0 +1,160 @@
+import base64
+import json
+import pytest
+import sys
+import zipfile
+
+from mock import Mock, patch
+from lambda_uploader import bench, shell
+
+HANDLER = '''
+import base64
+import sys
+
+# The package is imported in a clean interpreter
+assert not [p for p in sys.path if 'site-packages' in p], sys.path
+SEEN = []
+
+
+def lambda_handler(event, context):
+    print('handling %d records' % len(event['Records']))
+    assert context.get_remaining_time_in_millis() > 0
+    for record in event['Records']:
+        SEEN.append(base64.b64decode(record['kinesis']['data']))
+    if len(SEEN) > 1000000:
+        raise Exception('boom')
+'''
+
+
+def _package(tmpdir, source):
+    zip_file = str(tmpdir.join('lambda_function.zip'))
+    with zipfile.ZipFile(zip_file, 'w') as zf:
+        zf.writestr('function.py', source)
+    return zip_file
+
+
+def test_kinesis_events():
+    events = bench.kinesis_events(3, 5, record_size=10)
+    assert len(events) == 3
+    assert [len(e['Records']) for e in events] == [5, 5, 5]
+    record = events[2]['Records'][4]
+    assert base64.b64decode(record['kinesis']['data']) == b'x' * 10
+    assert record['eventSource'] == 'aws:kinesis'
+    assert len(set(r['eventID'] for e in events for r in e['Records'])) == 15
+    json.dumps(events)
+
+
+def test_run(tmpdir):
+    events = bench.kinesis_events(21, 10)
+    results = bench.run(_package(tmpdir, HANDLER), 'function.lambda_handler',
+                        events, python=sys.executable, warmup=1)
+    assert results['invocations'] == 20
+    assert results['records'] == 200
+    assert results['records_per_second'] > 0
+    assert 0 < results['p50_seconds'] <= results['p99_seconds']
+    assert results['import_seconds'] > 0
+    assert results['peak_rss'] > 0
+
+
+def test_run_handler_failure(tmpdir):
+    source = HANDLER.replace('> 1000000', '>= 0')
+    with pytest.raises(Exception) as exc:
+        bench.run(_package(tmpdir, source), 'function.lambda_handler',
+                  bench.kinesis_events(1, 1), python=sys.executable)
+    assert 'boom' in str(exc.value)
+
+
+def test_run_handler_importing_boto3(tmpdir):
+    source = 'import boto3\n' + HANDLER
+    results = bench.run(_package(tmpdir, source), 'function.lambda_handler',
+                        bench.kinesis_events(2, 1), python=sys.executable)
+    assert results['invocations'] == 1
+
+    # Without the runtime libraries boto3 is missing, as it is from the zip
+    with pytest.raises(Exception) as exc:
+        bench.run(_package(tmpdir, source), 'function.lambda_handler',
+                  bench.kinesis_events(1, 1), python=sys.executable,
+                  runtime_path=[])
+    assert 'boto3' in str(exc.value)
+
+
+def test_percentile():
+    values = [float(v) for v in range(1, 101)]
+    assert bench._percentile(values, 50) == 50
+    assert bench._percentile(values, 99) == 99
+    assert bench._percentile([3.0], 99) == 3.0
+
+
+IMPORTTIME = '''import time: self [us] | cumulative | imported package
+import time:       150 |        150 |     _json
+import time:       900 |       1050 |   json.decoder
+import time:       300 |       1350 | json
+import time:        20 |         20 | small
+import time:       100 |       1470 | function
+'''
+
+
+def test_import_tree():
+    roots = bench._import_tree(IMPORTTIME.splitlines())
+    assert [r.name for r in roots] == ['json', 'small', 'function']
+    json_import = roots[0]
+    assert json_import.cumulative_us == 1350
+    assert [c.name for c in json_import.children] == ['json.decoder']
+    assert json_import.children[0].children[0].name == '_json'
+
+    lines = bench.format_import_tree(roots, 2840, min_share=0.05)
+    assert [line.split()[-1] for line in lines] == \
+        ['function', 'json', 'json.decoder', '_json']
+
+
+def test_import_profile(tmpdir):
+    source = 'import json\nimport mymod\n\n' + HANDLER
+    zip_file = _package(tmpdir, source)
+    with zipfile.ZipFile(zip_file, 'a') as zf:
+        zf.writestr('mymod.py', 'import decimal\n')
+    roots, total_us = bench.import_profile(zip_file,
+                                           'function.lambda_handler',
+                                           python=sys.executable)
+    function = [r for r in roots if r.name == 'function'][0]
+    assert 'mymod' in [c.name for c in function.children]
+    assert total_us >= function.cumulative_us > 0
+
+
+def test_import_profile_includes_boto3(tmpdir):
+    zip_file = _package(tmpdir, 'import boto3\n' + HANDLER)
+    roots, total_us = bench.import_profile(zip_file,
+                                           'function.lambda_handler',
+                                           python=sys.executable)
+    function = [r for r in roots if r.name == 'function'][0]
+    boto3 = [c for c in function.children if c.name == 'boto3'][0]
+    assert boto3.cumulative_us > 0
+
+
+def test_cold_start_budget(tmpdir):
+    pkg = Mock(zip_file=_package(tmpdir, HANDLER), layer_zip_file=None)
+    args = Mock(python=sys.executable, import_profile=True,
+                runtime_path=None)
+    cfg = Mock(handler='function.lambda_handler', cold_start_budget=60000)
+    printed = []
+    shell._profile_imports(args, cfg, pkg, printed.append, shell.Report())
+    assert printed[0].startswith('Handler imports took')
+
+    cfg.cold_start_budget = 0.001
+    with pytest.raises(shell.ColdStartBudgetExceeded) as exc:
+        shell._profile_imports(args, cfg, pkg, printed.append,
+                               shell.Report())
+    assert 'cold start budget' in str(exc.value)
+
+
+@patch('lambda_uploader.shell._execute')
+def test_cold_start_budget_exit(mocked_execute, capsys):
+    mocked_execute.side_effect = shell.ColdStartBudgetExceeded(
+        'Handler imports took 400.0ms, over the cold start budget of 300ms')
+    with pytest.raises(SystemExit) as exc:
+        shell.main(['--no-upload'])
+    assert exc.value.code == 1
+
+    out, err = capsys.readouterr()
+    assert 'over the cold start budget' in out
+    assert 'Traceback' not in err
+    assert 'Unexpected error' not in err
@@ -0,0 +1,114 @@
+'''
+End to end deploys against the in-process fake AWS backend. Each scenario
+runs shell._execute and checks the AWS calls it makes against a budget, so
+changes that add calls or waiters to a deploy fail here. Run with -s to see
+the call counts and wall time of every scenario.
+'''
+import json
+import os
+import time
+
+from os import path
+from shutil import rmtree
+from lambda_uploader import shell
+from fake_aws import FakeAWS
+
+TESTING_TEMP_DIR = '.testing_temp'
+FUNC_DIR = path.join(TESTING_TEMP_DIR, 'func')
+VENV_DIR = path.join(TESTING_TEMP_DIR, 'venv')
+REPORT = path.join(TESTING_TEMP_DIR, 'report.json')
+EX_CONFIG = path.normpath(path.join(path.dirname(__file__),
+                          '../tests/configs'))
+
+
+def setup_function(function):
+    os.makedirs(FUNC_DIR)
+    os.makedirs(VENV_DIR)
+    with open(path.join(EX_CONFIG, 'lambda-with-subscription.json')) as fil:
+        cfg = json.load(fil)
+    with open(path.join(FUNC_DIR, 'lambda.json'), 'w') as fil:
+        json.dump(cfg, fil)
+    _write_handler('ok')
+
+
+def teardown_function(function):
+    rmtree(TESTING_TEMP_DIR)
+
+
+def _write_handler(result):
+    with open(path.join(FUNC_DIR, 'function.py'), 'w') as fil:
+        fil.write('def lambda_handler(event, context):\n'
+                  '    return %r\n' % result)
+
+
+def _deploy(aws, name, *argv):
+    args = shell._arg_parser().parse_args(
+        ['--config', path.join(FUNC_DIR, 'lambda.json'),
+         '--virtualenv', VENV_DIR, '--reproducible',
+         '--report-json', REPORT] + list(argv) + [FUNC_DIR])
+    before = dict(aws.calls)
+    start = time.time()
+    shell._execute(args)
+    seconds = time.time() - start
+
+    calls = dict((op, count - before.get(op, 0))
+                 for op, count in aws.calls.items()
+                 if count != before.get(op, 0))
+    with open(REPORT) as fil:
+        report = json.load(fil)
+    # The report counts exactly the calls the backend saw
+    assert report['api_calls'] == calls
+    print('%-24s %6.3fs %3d calls %s' % (name, seconds, sum(calls.values()),
+                                         json.dumps(calls, sort_keys=True)))
+    return calls
+
+
+def test_benchmark_deploys():
+    with FakeAWS(latency=0.005) as aws:
+        calls = _deploy(aws, 'create')
+        assert calls == {'GetFunctionConfiguration': 1, 'CreateFunction': 1,
+                         'CreateEventSourceMapping': 1}
+
+        calls = _deploy(aws, 'unchanged')
+        assert calls == {'GetFunctionConfiguration': 1,
+                         'CreateEventSourceMapping': 1,
+                         'ListEventSourceMappings': 1,
+                         'UpdateEventSourceMapping': 1}
+
+        _write_handler('changed')
+        calls = _deploy(aws, 'code change')
+        assert calls['UpdateFunctionCode'] == 1
+        assert 'UpdateFunctionConfiguration' not in calls
+        # One waiter poll after the code update
+        assert calls['GetFunctionConfiguration'] == 2
+
+        calls = _deploy(aws, 'config only', '--config-only',
+                        '--variables', '{"STAGE": "prod"}')
+        assert 'UpdateFunctionCode' not in calls
+        assert calls['UpdateFunctionConfiguration'] == 1
+        function = aws.functions['myFunc']['latest']
+        assert function['Environment'] == {'Variables': {'STAGE': 'prod'}}
+
+
+def test_benchmark_s3_publish_alias():
+    with FakeAWS() as aws:
+        _deploy(aws, 's3 create', '-s', 'bucket', '--s3-content-addressed')
+        _write_handler('changed')
+        calls = _deploy(aws, 's3 publish alias', '-s', 'bucket',
+                        '--s3-content-addressed', '--alias', 'live')
+        assert calls['HeadObject'] == 1
+        assert calls['PutObject'] == 1
+        assert calls['PublishVersion'] == 1
+        assert calls['CreateAlias'] == 1
+        assert len(aws.objects) == 2
+
+        # Rolling back redeploys an object that is in S3 already
+        _write_handler('ok')
+        calls = _deploy(aws, 's3 rollback', '-s', 'bucket',
+                        '--s3-content-addressed', '--alias', 'live')
+        assert 'PutObject' not in calls
+        assert calls['UpdateAlias'] == 1
+        assert len(aws.objects) == 2
+
+    function = aws.functions['myFunc']
+    assert function['aliases']['live']['FunctionVersion'] == '2'
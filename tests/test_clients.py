@@ -0,0 +1,40 @@
+from lambda_uploader import clients
+
+
+def setup_function(function):
+    clients.clear()
+
+
+def teardown_function(function):
+    clients.clear()
+
+
+def test_clients_are_shared():
+    settings = {'endpoint_urls': {'lambda': 'http://localhost:4566'}}
+    lambda_client = clients.client('lambda', 'us-east-1', settings=settings)
+    assert clients.client('lambda', 'us-east-1',
+                          settings=dict(settings)) is lambda_client
+    assert clients.client('lambda', 'eu-west-1',
+                          settings=settings) is not lambda_client
+    assert clients.client('lambda', 'us-east-1') is not lambda_client
+    assert lambda_client.meta.endpoint_url == 'http://localhost:4566'
+    assert lambda_client.meta.region_name == 'us-east-1'
+    # Only the services in endpoint_urls leave AWS
+    s3_client = clients.client('s3', 'us-east-1', settings=settings)
+    assert 'localhost' not in s3_client.meta.endpoint_url
+
+
+def test_client_config():
+    cfg = clients.client_config({'max_pool_connections': 20,
+                                 'retry_mode': 'adaptive',
+                                 'max_attempts': 8,
+                                 'connect_timeout': 5,
+                                 'read_timeout': 120})
+    assert cfg.max_pool_connections == 20
+    assert cfg.retries == {'mode': 'adaptive', 'max_attempts': 8}
+    assert cfg.connect_timeout == 5
+    assert cfg.read_timeout == 120
+
+    cfg = clients.client_config({})
+    assert cfg.max_pool_connections == clients.DEFAULT_MAX_POOL_CONNECTIONS
+    assert cfg.retries is None
@@ -1,3 +1,5 @@
+import json
+
 from os import path
 from lambda_uploader import config
 import pytest
@@ -130,3 +132,91 @@ def test_default_runtime():
 
     cfg.set_runtime('java8')
     assert cfg.runtime == 'java8'
+
+
+def test_s3_transfer():
+    cfg = config.Config(EX_CONFIG)
+    assert cfg.s3_transfer == {}
+
+    cfg.set_s3_transfer(multipart_chunksize=8388608, max_concurrency=None)
+    assert cfg.s3_transfer == {'multipart_chunksize': 8388608}
+    # The default settings are not modified
+    assert config.DEFAULT_PARAMS['s3_transfer'] == {}
+
+    with pytest.raises(TypeError):
+        cfg.set_s3_transfer(part_size=8388608)
+    with pytest.raises(TypeError):
+        cfg.set_s3_transfer(max_concurrency=0)
+
+
+def test_regions():
+    cfg = config.Config(EX_CONFIG, EX_CONFIG + '/lambda-with-regions.json')
+    assert cfg.region == 'us-east-1'
+    assert cfg.region_names == ['us-east-1', 'eu-west-1']
+
+    eu = cfg.for_region('eu-west-1')
+    assert eu.region == 'eu-west-1'
+    assert eu.s3_bucket == 'mybucket-eu-west-1'
+    assert eu.vpc['subnets'] == ['subnet-11111111']
+    # The overrides do not leak into the base config
+    assert cfg.s3_bucket == 'mybucket-us-east-1'
+    assert cfg.vpc is None
+
+    us = cfg.for_region('us-east-1')
+    assert us.s3_bucket == 'mybucket-us-east-1'
+
+
+def test_region_overrides_validated_on_load(tmpdir):
+    with open(EX_CONFIG + '/lambda-with-regions.json') as fil:
+        raw = json.load(fil)
+    raw['regions'][1]['vpc'] = {'subnets': 'oops'}
+    config_file = str(tmpdir.join('lambda.json'))
+    with open(config_file, 'w') as fil:
+        json.dump(raw, fil)
+
+    with pytest.raises(TypeError):
+        config.Config(EX_CONFIG, config_file)
+
+
+def test_single_region():
+    cfg = config.Config(EX_CONFIG)
+    assert cfg.region_names == ['us-east-1']
+    assert cfg.for_region('us-east-1').raw == cfg.raw
+
+
+def test_aws_client():
+    cfg = config.Config(EX_CONFIG)
+    assert cfg.aws_client == {}
+
+    cfg.raw['aws_client'] = {'retry_mode': 'adaptive', 'read_timeout': 1.5}
+    cfg._validate_aws_client()
+    cfg.raw['aws_client'] = {'retry_mode': 'eventually'}
+    with pytest.raises(TypeError):
+        cfg._validate_aws_client()
+    cfg.raw['aws_client'] = {'endpoint_urls': {'s3': 'http://localhost'}}
+    cfg._validate_aws_client()
+    cfg.raw['aws_client'] = {'endpoint_urls': {'s3': 4566}}
+    with pytest.raises(TypeError):
+        cfg._validate_aws_client()
+    cfg.raw['aws_client'] = {'pool_size': 10}
+    with pytest.raises(TypeError):
+        cfg._validate_aws_client()
+
+
+def test_subscription_settings():
+    cfg = config.Config(EX_CONFIG, EX_CONFIG + '/lambda-with-subscriptions.json')
+    assert cfg.subscription['sqs']['maximum_concurrency'] == 20
+
+    invalid = [('kinesis', 'parallelization_factor', 11),
+               ('kinesis', 'maximum_record_age_in_seconds', 30),
+               ('kinesis', 'function_response_types', ['Unknown']),
+               ('kinesis', 'maximum_concurrency', 5),
+               ('dynamodb', 'starting_position', 'AT_TIMESTAMP'),
+               ('sqs', 'parallelization_factor', 2),
+               ('sqs', 'maximum_concurrency', 1)]
+    for kind, key, value in invalid:
+        cfg = config.Config(EX_CONFIG,
+                            EX_CONFIG + '/lambda-with-subscriptions.json')
+        cfg.subscription[kind][key] = value
+        with pytest.raises(TypeError):
+            cfg._validate_subscription()
@@ -0,0 +1,57 @@
+import boto3
+import os
+import pytest
+
+from mock import Mock
+from moto import mock_s3
+from lambda_uploader import multipart
+
+BUCKET = 'mybucket'
+
+
+def _s3_client():
+    # Newer botocore sends upload_part bodies aws-chunked with a trailing
+    # checksum, which the moto S3 backend stores verbatim
+    os.environ.setdefault('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required')
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket=BUCKET)
+    return s3
+
+
+@mock_s3
+def test_multipart_upload():
+    s3 = _s3_client()
+    data = os.urandom(multipart.MIN_PART_SIZE * 2 + 1000)
+
+    stream = multipart.MultipartUpload(s3, BUCKET, 'pkg.zip', workers=2)
+    # Writes smaller than a part are buffered until a part is full
+    for i in range(0, len(data), 1024 * 1024):
+        stream.write(data[i:i + 1024 * 1024])
+    stream.close()
+
+    assert stream.size == len(data)
+    assert s3.get_object(Bucket=BUCKET, Key='pkg.zip')['Body'].read() == data
+
+
+@mock_s3
+def test_multipart_upload_empty():
+    s3 = _s3_client()
+
+    multipart.MultipartUpload(s3, BUCKET, 'empty.zip').close()
+
+    assert s3.get_object(Bucket=BUCKET, Key='empty.zip')['Body'].read() == b''
+
+
+def test_multipart_upload_abort():
+    client = Mock()
+    client.create_multipart_upload.return_value = {'UploadId': 'abc'}
+    client.upload_part.side_effect = Exception('network')
+
+    stream = multipart.MultipartUpload(client, BUCKET, 'pkg.zip')
+    stream.write(b'x' * multipart.MIN_PART_SIZE)
+    with pytest.raises(Exception):
+        stream.close()
+
+    client.abort_multipart_upload.assert_called_once_with(
+        Bucket=BUCKET, Key='pkg.zip', UploadId='abc')
+    assert not client.complete_multipart_upload.called
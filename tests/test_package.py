@@ -1,11 +1,14 @@
 import os
 import shutil
 import sys
+import zipfile
 import pytest
 
 from shutil import rmtree
 from os import path
+from mock import patch, Mock
 from lambda_uploader import package
+from lambda_uploader.report import Report
 
 TESTING_TEMP_DIR = '.testing_temp'
 WORKING_TEMP_DIR = path.join(TESTING_TEMP_DIR, '.lambda_uploader_temp')
@@ -184,3 +187,301 @@ def test_package_name():
     pkg = package.Package(TESTING_TEMP_DIR, zipfile_name='test.zip')
     pkg.package()
     assert path.isfile(path.join(TESTING_TEMP_DIR, 'test.zip'))
+
+
+def test_build_key():
+    pkg = package.Package(TESTING_TEMP_DIR)
+    pkg.requirements(['pytest==7.4.0'])
+    key = pkg.build_key()
+    assert key == pkg.build_key()
+
+    py_path = path.join(TESTING_TEMP_DIR, 'changed.py')
+    open(py_path, 'w').close()
+    changed_key = pkg.build_key()
+    assert changed_key != key
+    assert pkg.build_key([r'changed\.py']) == key
+    os.remove(py_path)
+
+    pkg.requirements(['pytest==7.4.0', 'mock==5.1.0'])
+    assert pkg.build_key() != key
+
+
+def test_build_key_requirements():
+    pkg = package.Package(TESTING_TEMP_DIR)
+    # Unpinned requirements could resolve differently on every build
+    pkg.requirements(['pytest==7.4.0', 'requests'])
+    assert pkg.build_key() is None
+    pkg.requirements(['pytest>=7'])
+    assert pkg.build_key() is None
+
+    req_path = path.join(TESTING_TEMP_DIR, 'requirements.txt')
+    nested_path = path.join(TESTING_TEMP_DIR, 'nested.txt')
+    constraints_path = path.join(TESTING_TEMP_DIR, 'constraints.txt')
+    with open(req_path, 'w') as fil:
+        fil.write('--index-url https://pypi.org/simple\n'
+                  '-r nested.txt\n-c constraints.txt\n'
+                  'pytest==7.4.0  # test runner\n')
+    with open(nested_path, 'w') as fil:
+        fil.write('requests\n')
+    with open(constraints_path, 'w') as fil:
+        fil.write('requests==2.31.0\n')
+    try:
+        pkg = package.Package(TESTING_TEMP_DIR)
+        pkg.requirements(req_path)
+        key = pkg.build_key()
+        assert key is not None
+
+        # Changes to included files invalidate the key
+        with open(constraints_path, 'w') as fil:
+            fil.write('requests==2.32.0\n')
+        assert pkg.build_key() not in (None, key)
+        with open(nested_path, 'w') as fil:
+            fil.write('requests\nmock\n')
+        assert pkg.build_key() is None
+    finally:
+        for pth in (req_path, nested_path, constraints_path):
+            os.remove(pth)
+
+
+def test_build_cache():
+    cache_dir = path.join(TESTING_TEMP_DIR, '.cache')
+    pkg = package.Package(TESTING_TEMP_DIR, cache_dir=cache_dir)
+    pkg.virtualenv(False)
+    pkg.build([r'^\.cache/.*'])
+    assert not pkg.cache_hit
+    assert path.isfile(path.join(cache_dir, pkg.build_key([r'^\.cache/.*'])
+                                 + '.zip'))
+
+    pkg.clean_workspace()
+    pkg = package.Package(TESTING_TEMP_DIR, cache_dir=cache_dir)
+    pkg.virtualenv(False)
+    pkg.build([r'^\.cache/.*'])
+    assert pkg.cache_hit
+    assert path.isfile(pkg.zip_file)
+    assert not path.isdir(path.join(TESTING_TEMP_DIR,
+                                    package.TEMP_WORKSPACE_NAME))
+    shutil.rmtree(cache_dir)
+
+
+def test_build_cache_inside_function_dir():
+    # Nothing ignores the cache, the package must leave it out by itself
+    cache_dir = path.join(TESTING_TEMP_DIR, '.lucache')
+    for _ in range(3):
+        pkg = package.Package(TESTING_TEMP_DIR, cache_dir=cache_dir)
+        pkg.virtualenv(False)
+        pkg.build()
+        pkg.clean_workspace()
+    assert pkg.cache_hit
+    assert len(os.listdir(cache_dir)) == 1
+    names = zipfile.ZipFile(pkg.zip_file).namelist()
+    assert not [n for n in names if n.startswith('.lucache')]
+    pkg.clean_zipfile()
+    shutil.rmtree(cache_dir)
+
+
+def test_package_with_wheelhouse_inside_function_dir():
+    wheelhouse = path.join(TESTING_TEMP_DIR, 'wheelhouse')
+    wheel_cache = path.join(TESTING_TEMP_DIR, 'wheels')
+    for directory in (wheelhouse, wheel_cache):
+        os.mkdir(directory)
+        with open(path.join(directory, 'mypkg-1.0-py3-none-any.whl'),
+                  'w') as fil:
+            fil.write('wheel')
+    pkg = package.Package(TESTING_TEMP_DIR, wheelhouse=wheelhouse,
+                          wheel_cache=wheel_cache)
+    pkg.virtualenv(False)
+    pkg.build()
+    names = zipfile.ZipFile(pkg.zip_file).namelist()
+    assert not [n for n in names if n.endswith('.whl')]
+    pkg.clean_workspace()
+    pkg.clean_zipfile()
+    shutil.rmtree(wheelhouse)
+    shutil.rmtree(wheel_cache)
+
+
+def test_package_direct():
+    pkg = package.Package(TESTING_TEMP_DIR, zipfile_name='staged.zip')
+    pkg.extra_file(path.join('tests', 'extra'))
+    pkg.extra_file(path.join('tests', 'dummyfile'))
+    pkg.package([DOTFILE_REGEX])
+    staged = zipfile.ZipFile(path.join(TESTING_TEMP_DIR, 'staged.zip'))
+
+    pkg = package.Package(TESTING_TEMP_DIR, zipfile_name='direct.zip',
+                          direct=True)
+    pkg.extra_file(path.join('tests', 'extra'))
+    pkg.extra_file(path.join('tests', 'dummyfile'))
+    pkg.package([DOTFILE_REGEX, r'staged\.zip'])
+    direct = zipfile.ZipFile(path.join(TESTING_TEMP_DIR, 'direct.zip'))
+
+    assert 'extra/foo/__init__.py' in direct.namelist()
+    assert 'dummyfile' in direct.namelist()
+    assert sorted(direct.namelist()) == sorted(staged.namelist())
+    assert direct.testzip() is None
+
+
+def test_package_report():
+    report = Report()
+    pkg = package.Package(TESTING_TEMP_DIR, zipfile_name='report.zip',
+                          report=report)
+    pkg.package([DOTFILE_REGEX])
+
+    phases = dict((p['name'], p) for p in report.phases)
+    assert sorted(phases) == ['copy site packages', 'copy source', 'zip']
+    assert phases['copy source']['files'] > 0
+    assert phases['zip']['files'] >= phases['copy source']['files']
+    assert phases['zip']['bytes'] == \
+        path.getsize(path.join(TESTING_TEMP_DIR, 'report.zip'))
+
+
+def test_package_zip_stream():
+    written = []
+    stream = Mock(bucket='mybucket', key='myFunc.zip')
+    stream.write.side_effect = written.append
+    pkg = package.Package(TESTING_TEMP_DIR, zipfile_name='stream.zip',
+                          zip_stream=stream)
+    pkg.package([DOTFILE_REGEX])
+
+    with open(path.join(TESTING_TEMP_DIR, 'stream.zip'), 'rb') as fil:
+        assert fil.read() == b''.join(written)
+    assert stream.close.called
+    assert pkg.s3_object == ('mybucket', 'myFunc.zip')
+
+
+def _mock_popen(*returncodes):
+    procs = []
+    for returncode in returncodes:
+        proc = Mock()
+        proc.communicate.return_value = ('', '')
+        proc.returncode = returncode
+        procs.append(proc)
+    return Mock(side_effect=procs)
+
+
+def test_install_requirements_wheelhouse():
+    pkg = package.Package(TESTING_TEMP_DIR, wheelhouse='/wheels')
+    pkg.requirements(['pytest'])
+    pkg._pkg_venv = 'venv'
+    pkg._venv_pip = 'bin/pip'
+    with patch('lambda_uploader.package.Popen', _mock_popen(0)) as popen:
+        pkg._install_requirements()
+
+    cmd = popen.call_args_list[0][0][0]
+    assert cmd[1:] == ['install', '--no-index', '--find-links', '/wheels',
+                       'pytest']
+
+
+def test_install_requirements_wheel_cache():
+    wheel_cache = path.join(TESTING_TEMP_DIR, 'wheels')
+    pkg = package.Package(TESTING_TEMP_DIR, pyexec='python3',
+                          wheel_cache=wheel_cache)
+    pkg.requirements(['pytest'])
+    pkg._pkg_venv = 'venv'
+    pkg._venv_pip = 'bin/pip'
+
+    # A cache miss builds the wheels then installs offline
+    with patch('lambda_uploader.package.Popen',
+               _mock_popen(1, 0, 0)) as popen:
+        pkg._install_requirements()
+    cmds = [call[0][0] for call in popen.call_args_list]
+    wheel_dir = cmds[0][4]
+    assert wheel_dir.startswith(path.join(wheel_cache, 'python3-'))
+    assert path.isdir(wheel_dir)
+    assert cmds[0][1:4] == ['install', '--no-index', '--find-links']
+    assert cmds[1][1:3] == ['wheel', '--wheel-dir']
+    assert cmds[2] == cmds[0]
+
+    # A cache hit only installs from local wheels
+    with patch('lambda_uploader.package.Popen', _mock_popen(0)) as popen:
+        pkg._install_requirements()
+    assert popen.call_count == 1
+
+
+def _fake_venv():
+    site_packages = path.join(TESTING_TEMP_DIR, 'fakevenv', 'lib',
+                              'python3.9', 'site-packages')
+    for fil in ['mypkg/__init__.py', 'mypkg/__init__.pyi',
+                'mypkg/__pycache__/__init__.cpython-39.pyc',
+                'mypkg/tests/test_mypkg.py', 'mypkg/include/mypkg.h',
+                'mypkg-1.0.dist-info/METADATA', 'boto3/__init__.py',
+                'mypkg/extra.txt']:
+        fil = path.join(site_packages, fil)
+        if not path.isdir(path.dirname(fil)):
+            os.makedirs(path.dirname(fil))
+        with open(fil, 'w') as tfile:
+            tfile.write(fil)
+    return path.join(TESTING_TEMP_DIR, 'fakevenv')
+
+
+@pytest.mark.parametrize('direct', [False, True])
+def test_package_slim(direct):
+    pkg = package.Package(TESTING_TEMP_DIR, zipfile_name='slim.zip',
+                          direct=direct, slim=True,
+                          slim_ignore=[r'\.txt$'])
+    pkg._pkg_venv = _fake_venv()
+    pkg.package([r'^fakevenv/'])
+
+    names = zipfile.ZipFile(path.join(TESTING_TEMP_DIR, 'slim.zip')).namelist()
+    assert 'mypkg/__init__.py' in names
+    for name in names:
+        assert not name.startswith(('boto3/', 'mypkg-1.0.dist-info/',
+                                    'mypkg/tests/', 'mypkg/__pycache__/'))
+        assert not name.endswith(('.pyi', '.h', '.txt'))
+
+    assert pkg.slim_report['removed'] == 7
+    assert pkg.slim_report['after'] < pkg.slim_report['before']
+    shutil.rmtree(path.join(TESTING_TEMP_DIR, 'fakevenv'))
+
+
+def test_package_layer():
+    cache_dir = path.join(TESTING_TEMP_DIR, '.cache')
+    pkg = package.Package(TESTING_TEMP_DIR, cache_dir=cache_dir, layer=True)
+    pkg.requirements(['pytest==7.4.0'])
+    venv = _fake_venv()
+
+    def install_dependencies():
+        pkg._pkg_venv = venv
+    pkg.install_dependencies = Mock(side_effect=install_dependencies)
+    pkg.build([r'^fakevenv/', r'^\.cache/'])
+
+    layer = zipfile.ZipFile(pkg.layer_zip_file).namelist()
+    assert 'python/mypkg/__init__.py' in layer
+    assert path.isfile(path.join(cache_dir,
+                                 'layer-%s.zip' % pkg.requirements_key()))
+    function = zipfile.ZipFile(pkg.zip_file).namelist()
+    assert 'mypkg/__init__.py' not in function
+    assert package.LAYER_ZIPFILE_NAME not in function
+
+    # Unchanged requirements reuse the cached layer without a virtualenv
+    pkg = package.Package(TESTING_TEMP_DIR, cache_dir=cache_dir, layer=True)
+    pkg.requirements(['pytest==7.4.0'])
+    pkg.install_dependencies = Mock()
+    pkg.build([r'^fakevenv/', r'^\.cache/'])
+    assert not pkg.install_dependencies.called
+    assert pkg.cache_hit
+    assert path.isfile(pkg.layer_zip_file)
+
+    pkg.clean_zipfile()
+    assert not path.isfile(pkg.layer_zip_file)
+    shutil.rmtree(cache_dir)
+
+    # Unpinned requirements are never looked up, so nothing is stored
+    pkg = package.Package(TESTING_TEMP_DIR, cache_dir=cache_dir, layer=True)
+    pkg.requirements(['pytest'])
+    pkg.install_dependencies = Mock(side_effect=install_dependencies)
+    pkg.build([r'^fakevenv/', r'^\.cache/'])
+    assert pkg.layer_hash is not None
+    assert not path.isdir(cache_dir) or not os.listdir(cache_dir)
+    pkg.clean_zipfile()
+    shutil.rmtree(path.join(TESTING_TEMP_DIR, 'fakevenv'))
+    if path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+
+
+def test_package_layer_without_site_packages():
+    pkg = package.Package(TESTING_TEMP_DIR, layer=True)
+    pkg.virtualenv(False)
+    pkg.build()
+    assert pkg.layer_zip_file is None
+    assert not path.isfile(path.join(TESTING_TEMP_DIR,
+                                     package.LAYER_ZIPFILE_NAME))
+    assert path.isfile(pkg.zip_file)
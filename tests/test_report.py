@@ -0,0 +1,93 @@
+import json
+import os
+import shutil
+
+from mock import Mock
+from lambda_uploader.report import Report
+
+TESTING_TEMP_DIR = '.testing_temp'
+
+
+def _call(report, name):
+    model = Mock()
+    model.name = name
+    report._api_call(model=model, params={})
+
+
+def test_phases():
+    report = Report()
+    with report.phase('zip'):
+        report.add(files=2, bytes=100)
+        _call(report, 'GetFunction')
+    with report.phase('upload'):
+        with report.phase('wait'):
+            _call(report, 'GetFunction')
+        _call(report, 'UpdateFunctionCode')
+    report.add(files=1)
+
+    phases = dict((p['name'], p) for p in report.as_dict()['phases'])
+    assert [p['name'] for p in report.phases] == ['zip', 'upload', 'wait']
+    assert phases['zip']['files'] == 2
+    assert phases['zip']['bytes'] == 100
+    assert phases['zip']['api_calls'] == 1
+    assert phases['upload']['api_calls'] == 1
+    assert phases['wait']['api_calls'] == 1
+    assert report.api_calls == {'GetFunction': 2, 'UpdateFunctionCode': 1}
+
+
+def test_failed_phase_is_timed():
+    report = Report()
+    try:
+        with report.phase('build'):
+            raise Exception('failed')
+    except Exception:
+        pass
+    assert report.phases[0]['seconds'] >= 0
+    assert not report._active
+
+
+def test_write():
+    os.makedirs(TESTING_TEMP_DIR)
+    try:
+        pth = os.path.join(TESTING_TEMP_DIR, 'report.json')
+        report = Report()
+        with report.phase('zip'):
+            pass
+        report.write(pth)
+        with open(pth) as fil:
+            data = json.load(fil)
+        assert data['phases'][0]['name'] == 'zip'
+        assert 'seconds' in data
+    finally:
+        shutil.rmtree(TESTING_TEMP_DIR)
+
+
+def test_child_reports():
+    report = Report()
+    with report.child('eu-west-1').phase('upload'):
+        _call(report.child('eu-west-1'), 'UpdateFunctionCode')
+
+    data = report.as_dict()
+    assert data['phases'] == []
+    assert data['children']['eu-west-1']['api_calls'] == {
+        'UpdateFunctionCode': 1}
+
+
+def test_shared_client():
+    client = Mock()
+    first = Report()
+    second = Report()
+    first.watch(client)
+    second.watch(client)
+    _, handler = client.meta.events.register.call_args[0]
+    assert client.meta.events.register.call_count == 1
+
+    model = Mock()
+    model.name = 'GetFunction'
+    with first.phase('get'):
+        handler(model=model)
+    # Outside any phase the report that watched the client last counts it
+    handler(model=model)
+
+    assert first.api_calls == {'GetFunction': 1}
+    assert second.api_calls == {'GetFunction': 1}
@@ -0,0 +1,124 @@
+import pytest
+
+from botocore.exceptions import ClientError
+from mock import patch, Mock
+from os import path
+from lambda_uploader import clients, config, retry, uploader
+from fake_aws import FakeAWS
+
+
+def _error(code, operation='UpdateFunctionCode'):
+    return ClientError({'Error': {'Code': code, 'Message': ''}}, operation)
+
+
+def test_classify():
+    assert retry.classify(_error('TooManyRequestsException')) == 'throttled'
+    assert retry.classify(_error('ServiceException')) == 'transient'
+    assert retry.classify(_error('ResourceConflictException'),
+                          'update_function_code') == 'transient'
+    # On create the conflict means the resource exists
+    assert retry.classify(_error('ResourceConflictException'),
+                          'create_function') is None
+    assert retry.classify(_error('ResourceNotFoundException')) is None
+    assert retry.classify(ValueError('boom')) is None
+
+
+@patch('lambda_uploader.retry.time.sleep')
+def test_call_retries_throttling(sleep):
+    method = Mock(side_effect=[_error('TooManyRequestsException'),
+                               _error('TooManyRequestsException'), 'ok'])
+    limiter = retry.Limiter(maximum=8)
+    assert retry.call(method, operation='update_function_code',
+                      limiter=limiter, FunctionName='f') == 'ok'
+    assert method.call_count == 3
+    method.assert_called_with(FunctionName='f')
+    assert sleep.call_count == 2
+    assert 2 <= limiter.limit < 3
+    assert limiter.active == 0
+
+
+@patch('lambda_uploader.retry.time.sleep')
+def test_call_raises_fatal_and_exhausted_errors(sleep):
+    method = Mock(side_effect=_error('InvalidParameterValueException'))
+    with pytest.raises(ClientError):
+        retry.call(method, operation='update_function_code')
+    assert method.call_count == 1
+
+    method = Mock(side_effect=_error('ThrottlingException'))
+    with pytest.raises(ClientError):
+        retry.call(method, operation='get_function', attempts=3)
+    assert method.call_count == 3
+
+
+def test_limiter_increases_additively():
+    limiter = retry.Limiter(maximum=4)
+    limiter.throttled()
+    limiter.throttled()
+    assert limiter.limit == 1
+    limiter.success()
+    assert limiter.limit == 2
+    limiter.success()
+    assert limiter.limit == 2.5
+    limiter.success()
+    limiter.success()
+    assert int(limiter.limit) == 3
+    for _ in range(10):
+        limiter.success()
+    assert limiter.limit == 4
+
+
+def test_retrying_client():
+    client = Mock()
+    client.get_function.return_value = {'Configuration': {}}
+    wrapped = retry.RetryingClient(client, retry.Limiter())
+    assert wrapped.get_function(FunctionName='f') == {'Configuration': {}}
+    client.get_function.assert_called_with(FunctionName='f')
+    assert wrapped.meta is client.meta
+
+
+@patch('lambda_uploader.retry.time.sleep')
+def test_retrying_client_pages_and_waits(sleep):
+    conf = config.Config(path.dirname(__file__), config_file=path.join(
+        path.dirname(__file__), 'configs', 'lambda.json'))
+    with FakeAWS() as aws:
+        client = clients.client('lambda', 'us-east-1')
+        client.create_function(FunctionName=conf.name, Role=conf.role,
+                               Handler='function.lambda_handler',
+                               Code={'ZipFile': b'code'})
+        client.create_alias(FunctionName=conf.name, Name='live',
+                            FunctionVersion='$LATEST')
+        aws.throttles['ListAliases'] = 2
+        aws.throttles['GetFunctionConfiguration'] = 2
+
+        limiter = retry.Limiter(maximum=8)
+        wrapped = retry.RetryingClient(
+            clients.client('lambda', 'us-east-1', retries=False), limiter)
+        pages = wrapped.get_paginator('list_aliases').paginate(
+            FunctionName=conf.name)
+        assert [a['Name'] for p in pages for a in p['Aliases']] == ['live']
+        wrapped.get_waiter('function_updated').wait(FunctionName=conf.name)
+        assert aws.calls['ListAliases'] == 3
+        assert aws.calls['GetFunctionConfiguration'] == 3
+        assert limiter.limit < 8
+
+
+def test_botocore_retries_off():
+    cfg = clients.client_config({'retry_mode': 'adaptive',
+                                 'max_attempts': 10}, retries=False)
+    assert cfg.retries == {'mode': 'standard', 'max_attempts': 0}
+    lambda_client = clients.client('lambda', 'us-east-1', retries=False)
+    assert lambda_client is not clients.client('lambda', 'us-east-1')
+
+
+@patch('lambda_uploader.clients.client')
+def test_upload_does_not_create_on_other_errors(mocked_client):
+    client = Mock()
+    client.get_function_configuration.side_effect = \
+        _error('AccessDeniedException')
+    mocked_client.return_value = client
+    conf = config.Config(path.dirname(__file__), config_file=path.join(
+        path.dirname(__file__), 'configs', 'lambda.json'))
+
+    with pytest.raises(ClientError):
+        uploader.PackageUploader(conf, None).upload(Mock())
+    assert not client.create_function.called
@@ -0,0 +1,117 @@
+import json
+import os
+import pytest
+import subprocess
+import sys
+
+from os import path
+from shutil import rmtree
+from mock import patch
+from lambda_uploader import config, shell
+
+EX_CONFIG = path.normpath(path.join(path.dirname(__file__),
+                          '../tests/configs'))
+TESTING_TEMP_DIR = '.testing_temp'
+# Runs the CLI in a fresh interpreter and reports the time it took and the
+# AWS modules it imported
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.time()
+from lambda_uploader import shell
+try:
+    shell.main(sys.argv[1:])
+except SystemExit:
+    pass
+print(json.dumps({'seconds': time.time() - start,
+                  'modules': sorted(m for m in ('boto3', 'botocore')
+                                    if m in sys.modules)}))
+'''
+
+
+def _startup(*argv):
+    out = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT] +
+                                  list(argv))
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def test_startup_does_not_import_boto3():
+    for argv in [['--version'], ['--help']]:
+        startup = _startup(*argv)
+        assert startup['modules'] == [], \
+            '%s imported %s in %.3fs' % (argv, startup['modules'],
+                                         startup['seconds'])
+
+
+def test_build_only_does_not_import_boto3():
+    func_dir = path.join(TESTING_TEMP_DIR, 'func')
+    os.makedirs(path.join(TESTING_TEMP_DIR, 'venv'))
+    os.makedirs(func_dir)
+    try:
+        with open(path.join(EX_CONFIG, 'lambda.json')) as src:
+            with open(path.join(func_dir, 'lambda.json'), 'w') as dst:
+                dst.write(src.read())
+        startup = _startup('--no-upload',
+                           '--config', path.join(func_dir, 'lambda.json'),
+                           '--virtualenv', path.join(TESTING_TEMP_DIR, 'venv'),
+                           func_dir)
+        assert path.isfile(path.join(func_dir, 'lambda_function.zip'))
+        assert startup['modules'] == [], \
+            'build imported %s in %.3fs' % (startup['modules'],
+                                            startup['seconds'])
+    finally:
+        rmtree(TESTING_TEMP_DIR)
+
+
+@patch('lambda_uploader.uploader.PackageUploader')
+def test_upload_regions(mocked_uploader):
+    regions = []
+
+    def create(cfg, profile, report=None):
+        regions.append((cfg.region, cfg.s3_bucket))
+        return mocked_uploader.return_value
+
+    mocked_uploader.side_effect = create
+    mocked_uploader.return_value.s3_uploads = []
+    cfg = config.Config(EX_CONFIG, EX_CONFIG + '/lambda-with-regions.json')
+    args = shell._parser('test').parse_args([])
+    shell._upload(args, cfg, _Package())
+
+    assert sorted(regions) == [('eu-west-1', 'mybucket-eu-west-1'),
+                               ('us-east-1', 'mybucket-us-east-1')]
+
+
+@patch('lambda_uploader.uploader.PackageUploader')
+def test_upload_regions_failure(mocked_uploader):
+    def create(cfg, profile, report=None):
+        if cfg.region == 'eu-west-1':
+            raise Exception('AccessDenied')
+        return mocked_uploader.return_value
+
+    mocked_uploader.side_effect = create
+    mocked_uploader.return_value.s3_uploads = []
+    cfg = config.Config(EX_CONFIG, EX_CONFIG + '/lambda-with-regions.json')
+    args = shell._parser('test').parse_args([])
+    pkg = _Package()
+    with pytest.raises(Exception) as excinfo:
+        shell._upload(args, cfg, pkg)
+
+    assert 'eu-west-1: AccessDenied' in str(excinfo.value)
+    assert 'us-east-1' not in str(excinfo.value)
+    assert mocked_uploader.return_value.upload.called
+
+
+def test_print_from_threads(capsys):
+    from multiprocessing.pool import ThreadPool
+    lines = ['[region-%d] %s' % (i, 'x' * 200) for i in range(200)]
+    pool = ThreadPool(8)
+    pool.map(shell._print, lines)
+    pool.close()
+
+    printed = capsys.readouterr().out.splitlines()
+    assert sorted(line.split(' ', 1)[-1] for line in printed) == \
+        sorted(lines)
+
+
+class _Package(object):
+    def clean_zipfile(self):
+        pass
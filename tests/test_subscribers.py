@@ -2,8 +2,10 @@ from os import path
 from mock import patch, Mock
 import nose.tools as nt
 import botocore
+import pytest
 
-from lambda_uploader import subscribers, config
+from lambda_uploader import clients, subscribers, config
+from fake_aws import FakeAWS
 
 
 EX_CONFIG = path.normpath(path.join(path.dirname(__file__),
@@ -11,20 +13,17 @@ EX_CONFIG = path.normpath(path.join(path.dirname(__file__),
 
 class TestKinesisSubscriber(object):
 
-    @patch('lambda_uploader.subscribers.boto3.session.Session')
-    def test_successfully_adds_kinesis_subscription(self, mocked_session):
+    @patch('lambda_uploader.clients.client')
+    def test_successfully_adds_kinesis_subscription(self, mocked_client):
         _mocked_lambda = Mock()
-        _mocked_session = Mock()
-        _mocked_session.client = Mock()
-        _mocked_session.client.return_value = _mocked_lambda
-        mocked_session.return_value = _mocked_session
+        mocked_client.return_value = _mocked_lambda
         conf = config.Config(path.dirname(__file__),
                              config_file=path.join(EX_CONFIG, 'lambda-with-subscription.json'))
         subscribers.create_subscriptions(conf, None)
         nt.assert_equals(True, _mocked_lambda.create_event_source_mapping.called)
 
-    @patch('lambda_uploader.subscribers.boto3.session.Session')
-    def test_successfully_updates_kinesis_subscription(self, mocked_session):
+    @patch('lambda_uploader.clients.client')
+    def test_successfully_updates_kinesis_subscription(self, mocked_client):
         resonse = {"Error": {"Code": "ResourceConflictException", "Message": ""}}
         err = botocore.exceptions.ClientError(resonse, "create_event_source_mapping")
         _mocked_lambda = Mock()
@@ -32,11 +31,99 @@ class TestKinesisSubscriber(object):
         _mocked_lambda.list_event_source_mappings.return_value = {
             'EventSourceMappings': [{'UUID': 'myuuid'}]
         }
-        _mocked_session = Mock()
-        _mocked_session.client = Mock()
-        _mocked_session.client.return_value = _mocked_lambda
-        mocked_session.return_value = _mocked_session
+        mocked_client.return_value = _mocked_lambda
         conf = config.Config(path.dirname(__file__),
                              config_file=path.join(EX_CONFIG, 'lambda-with-subscription.json'))
         subscribers.create_subscriptions(conf, None)
         nt.assert_equals(True, _mocked_lambda.update_event_source_mapping.called)
+
+
+class TestEventSourceSubscribers(object):
+
+    def test_creates_and_updates_with_settings(self):
+        conf = config.Config(path.dirname(__file__),
+                             config_file=path.join(EX_CONFIG, 'lambda-with-subscriptions.json'))
+        with FakeAWS() as aws:
+            clients.client('lambda', 'us-east-1').create_function(
+                FunctionName=conf.name, Role=conf.role, Handler=conf.handler,
+                Code={'ZipFile': b'code'})
+            subscribers.create_subscriptions(conf, None)
+            mappings = dict((m['EventSourceArn'].split(':')[2], m)
+                            for m in aws.mappings.values())
+            nt.assert_equals(['dynamodb', 'kinesis', 'sqs'], sorted(mappings))
+            nt.assert_equals(4, mappings['kinesis']['ParallelizationFactor'])
+            nt.assert_equals('LATEST', mappings['kinesis']['StartingPosition'])
+            nt.assert_equals(['ReportBatchItemFailures'],
+                             mappings['kinesis']['FunctionResponseTypes'])
+            nt.assert_equals('TRIM_HORIZON',
+                             mappings['dynamodb']['StartingPosition'])
+            nt.assert_equals({'MaximumConcurrency': 20},
+                             mappings['sqs']['ScalingConfig'])
+
+            conf.subscription['sqs']['maximum_concurrency'] = 50
+            conf.subscription['kinesis']['parallelization_factor'] = 8
+            subscribers.create_subscriptions(conf, None)
+            nt.assert_equals(3, len(aws.mappings))
+            nt.assert_equals(3, aws.calls['UpdateEventSourceMapping'])
+            mappings = dict((m['EventSourceArn'].split(':')[2], m)
+                            for m in aws.mappings.values())
+            nt.assert_equals(8, mappings['kinesis']['ParallelizationFactor'])
+            nt.assert_equals({'MaximumConcurrency': 50},
+                             mappings['sqs']['ScalingConfig'])
+
+
+class TestReconcileSubscriptions(object):
+
+    def test_reconciles_all_mappings(self):
+        conf = config.Config(path.dirname(__file__),
+                             config_file=path.join(EX_CONFIG, 'lambda-with-subscriptions-list.json'))
+        stream = 'arn:aws:kinesis:us-east-1:000000000000:stream/%s'
+        with FakeAWS() as aws:
+            client = clients.client('lambda', 'us-east-1')
+            client.create_function(
+                FunctionName=conf.name, Role=conf.role, Handler=conf.handler,
+                Code={'ZipFile': b'code'})
+            # More stale mappings than fit on one page
+            for i in range(55):
+                client.create_event_source_mapping(
+                    FunctionName=conf.name, EventSourceArn=stream % i,
+                    BatchSize=100, StartingPosition='LATEST')
+            client.create_event_source_mapping(
+                FunctionName=conf.name, EventSourceArn=stream % 'clicks',
+                BatchSize=100, StartingPosition='LATEST')
+            # Sources the subscriptions list can not manage are kept
+            function_arn = aws.functions[conf.name]['latest']['FunctionArn']
+            aws.mappings['kafka'] = {
+                'UUID': 'kafka', 'FunctionArn': function_arn,
+                'State': 'Enabled', 'SelfManagedEventSource': {
+                    'Endpoints': {'KAFKA_BOOTSTRAP_SERVERS': ['b:9092']}}}
+            aws.mappings['mq'] = {
+                'UUID': 'mq', 'FunctionArn': function_arn, 'State': 'Enabled',
+                'EventSourceArn': 'arn:aws:mq:us-east-1:000000000000:'
+                                  'broker:b:b-1'}
+
+            changes = subscribers.reconcile_subscriptions(conf, None)
+            nt.assert_equals([stream % 'views', conf.subscriptions[2]['queue']],
+                             changes['created'])
+            nt.assert_equals([stream % 'clicks'], changes['updated'])
+            nt.assert_equals(55, len(changes['deleted']))
+            nt.assert_true('kafka' in aws.mappings and 'mq' in aws.mappings)
+            mappings = dict((m['EventSourceArn'], m)
+                            for m in aws.mappings.values()
+                            if m['UUID'] not in ('kafka', 'mq'))
+            nt.assert_equals(3, len(mappings))
+            nt.assert_equals(4, mappings[stream % 'clicks']['ParallelizationFactor'])
+            nt.assert_equals('Disabled',
+                             mappings[conf.subscriptions[2]['queue']]['State'])
+
+            before = aws.total_calls
+            changes = subscribers.reconcile_subscriptions(conf, None)
+            nt.assert_equals(3, len(changes['unchanged']))
+            nt.assert_equals(1, aws.total_calls - before)
+
+    def test_rejects_duplicate_sources(self):
+        conf = config.Config(path.dirname(__file__),
+                             config_file=path.join(EX_CONFIG, 'lambda-with-subscriptions-list.json'))
+        conf.subscriptions.append(dict(conf.subscriptions[0]))
+        with pytest.raises(TypeError):
+            conf._validate_subscriptions()
@@ -1,14 +1,24 @@
 import boto3
 
 from os import path
-from lambda_uploader import uploader, config
+from mock import patch, Mock
+from lambda_uploader import clients, config, uploader
 from moto import mock_s3
 from platform import python_version
+from fake_aws import FakeAWS
 
 EX_CONFIG = path.normpath(path.join(path.dirname(__file__),
                           '../tests/configs'))
 
 
+def _lambda_mock():
+    client = Mock()
+    # The RetryingClient polls through the client method of the waiter
+    client.get_waiter.return_value.config.operation = \
+        'GetFunctionConfiguration'
+    return client
+
+
 @mock_s3
 def test_s3_upload():
     mock_bucket = 'mybucket'
@@ -32,3 +42,251 @@ def test_s3_upload():
         assert found_contents == 'dummy data'
     else:
         assert found_contents == "b'dummy data\\n'"
+
+
+@patch('lambda_uploader.clients.client')
+def test_upload_skips_unchanged_code(mocked_client):
+    _mocked_lambda = _lambda_mock()
+    mocked_client.return_value = _mocked_lambda
+    pkg = Mock()
+    pkg.zip_file = path.join(path.dirname(__file__), 'dummyfile')
+    _mocked_lambda.get_function_configuration.return_value = {
+        'CodeSha256': uploader._code_sha256(pkg.zip_file)}
+
+    conf = config.Config(path.dirname(__file__),
+                         config_file=path.join(EX_CONFIG, 'lambda.json'))
+    upldr = uploader.PackageUploader(conf, None)
+    upldr.upload(pkg)
+
+    assert not upldr.code_updated
+    assert not _mocked_lambda.update_function_code.called
+    assert _mocked_lambda.update_function_configuration.called
+
+
+@patch('lambda_uploader.clients.client')
+def test_upload_changed_code(mocked_client):
+    _mocked_lambda = _lambda_mock()
+    mocked_client.return_value = _mocked_lambda
+    _mocked_lambda.get_function_configuration.return_value = {
+        'CodeSha256': 'c29tZXRoaW5nIGVsc2U='}
+    pkg = Mock()
+    pkg.zip_file = path.join(path.dirname(__file__), 'dummyfile')
+
+    conf = config.Config(path.dirname(__file__),
+                         config_file=path.join(EX_CONFIG, 'lambda.json'))
+    upldr = uploader.PackageUploader(conf, None)
+    upldr.upload(pkg)
+
+    assert upldr.code_updated
+    assert _mocked_lambda.update_function_code.called
+
+
+@patch('lambda_uploader.clients.client')
+def test_upload_without_layer_zip(mocked_client):
+    _mocked_lambda = _lambda_mock()
+    mocked_client.return_value = _mocked_lambda
+    _mocked_lambda.get_function_configuration.return_value = {
+        'CodeSha256': 'c29tZXRoaW5nIGVsc2U='}
+    pkg = Mock()
+    pkg.zip_file = path.join(path.dirname(__file__), 'dummyfile')
+    # No site packages, so no layer was built
+    pkg.layer_zip_file = None
+
+    conf = config.Config(path.dirname(__file__),
+                         config_file=path.join(EX_CONFIG, 'lambda.json'))
+    conf.set_layer()
+    upldr = uploader.PackageUploader(conf, None)
+    upldr.upload(pkg)
+
+    assert not _mocked_lambda.publish_layer_version.called
+    assert not upldr.layer_published
+    _, kwargs = _mocked_lambda.update_function_configuration.call_args
+    assert 'Layers' not in kwargs
+
+
+@patch('lambda_uploader.clients.client')
+def test_publish_layer(mocked_client):
+    _mocked_lambda = _lambda_mock()
+    mocked_client.return_value = _mocked_lambda
+    paginator = _mocked_lambda.get_paginator.return_value
+    pkg = Mock()
+    pkg.layer_hash = 'abc'
+    pkg.zip_file = path.join(path.dirname(__file__), 'dummyfile')
+    pkg.layer_zip_file = pkg.zip_file
+    _mocked_lambda.get_function_configuration.return_value = {}
+
+    conf = config.Config(path.dirname(__file__),
+                         config_file=path.join(EX_CONFIG, 'lambda.json'))
+    conf.set_layer()
+    assert conf.layer_name == 'myFunc-dependencies'
+    upldr = uploader.PackageUploader(conf, None)
+
+    # An existing version built from the same requirements is reused
+    paginator.paginate.return_value = [{'LayerVersions': [
+        {'Description': uploader.LAYER_DESCRIPTION % 'abc',
+         'LayerVersionArn': 'arn:layer:1'}]}]
+    assert upldr.publish_layer(pkg) == 'arn:layer:1'
+    assert not _mocked_lambda.publish_layer_version.called
+
+    paginator.paginate.return_value = [{'LayerVersions': []}]
+    _mocked_lambda.publish_layer_version.return_value = {
+        'LayerVersionArn': 'arn:layer:2'}
+    upldr.upload(pkg)
+    assert upldr.layer_published
+    _, kwargs = _mocked_lambda.update_function_configuration.call_args
+    assert kwargs['Layers'] == ['arn:layer:2']
+
+
+@patch('lambda_uploader.uploader._read_file')
+@patch('lambda_uploader.clients.client')
+def test_s3_upload_does_not_read_package(mocked_client, read_file):
+    _mocked_lambda = _lambda_mock()
+    mocked_client.return_value = _mocked_lambda
+    _mocked_lambda.get_function_configuration.return_value = {}
+    pkg = Mock()
+    pkg.zip_file = path.join(path.dirname(__file__), 'dummyfile')
+
+    conf = config.Config(path.dirname(__file__),
+                         config_file=path.join(EX_CONFIG, 'lambda.json'))
+    conf.set_s3('mybucket')
+    upldr = uploader.PackageUploader(conf, None)
+    with patch.object(upldr, '_upload_s3') as upload_s3:
+        upldr.upload(pkg)
+
+    upload_s3.assert_called_once_with(pkg.zip_file, 'myFunc.zip')
+    assert not read_file.called
+    _, kwargs = _mocked_lambda.update_function_code.call_args
+    assert 'ZipFile' not in kwargs
+
+
+@patch('lambda_uploader.uploader.boto3.s3.transfer.S3Transfer')
+@patch('lambda_uploader.clients.client')
+def test_s3_transfer_config(mocked_client, mocked_transfer):
+    conf = config.Config(path.dirname(__file__),
+                         config_file=path.join(EX_CONFIG, 'lambda.json'))
+    conf.set_s3('mybucket')
+    conf.set_s3_transfer(max_concurrency=4)
+    upldr = uploader.PackageUploader(conf, None)
+
+    zip_file = path.join(path.dirname(__file__), 'dummyfile')
+    upldr._upload_s3(zip_file)
+    upldr._upload_s3(zip_file, 'other.zip')
+
+    # One transfer is configured and reused for every upload
+    assert mocked_transfer.call_count == 1
+    transfer_config = mocked_transfer.call_args[0][1]
+    assert transfer_config.max_concurrency == 4
+    assert transfer_config.multipart_chunksize == \
+        uploader.DEFAULT_S3_TRANSFER['multipart_chunksize']
+    assert [key for key, _, _ in upldr.s3_uploads] == ['myFunc.zip',
+                                                       'other.zip']
+
+
+def _live_configuration(conf):
+    return {
+        'FunctionName': conf.name,
+        'Version': '$LATEST',
+        'Handler': conf.handler,
+        'Role': conf.role,
+        'Description': conf.description,
+        'Timeout': conf.timeout,
+        'MemorySize': conf.memory,
+        'Runtime': conf.runtime,
+        'VpcConfig': {'SubnetIds': conf.vpc['subnets'],
+                      'SecurityGroupIds': conf.vpc['security_groups'],
+                      'VpcId': 'vpc-00000000'},
+        'TracingConfig': {'Mode': 'PassThrough'},
+    }
+
+
+@patch('lambda_uploader.clients.client')
+def test_upload_configuration_diff(mocked_client):
+    _mocked_lambda = _lambda_mock()
+    mocked_client.return_value = _mocked_lambda
+    conf = config.Config(path.dirname(__file__),
+                         config_file=path.join(EX_CONFIG, 'lambda.json'))
+    conf.set_publish()
+    live = _live_configuration(conf)
+    _mocked_lambda.get_function_configuration.return_value = live
+
+    # Nothing changed: neither the update nor its waiter run
+    upldr = uploader.PackageUploader(conf, None)
+    upldr.upload_configuration()
+    assert not upldr.config_updated
+    assert not upldr.code_updated
+    assert not _mocked_lambda.update_function_configuration.called
+    assert not _mocked_lambda.update_function_code.called
+    assert not _mocked_lambda.get_waiter.called
+    assert _mocked_lambda.publish_version.called
+
+    # Only the changed fields are sent
+    live['MemorySize'] = 128
+    live['Environment'] = {'Variables': {'STALE': '1'}}
+    upldr = uploader.PackageUploader(conf, None)
+    upldr.upload_configuration()
+    assert upldr.config_updated
+    _, kwargs = _mocked_lambda.update_function_configuration.call_args
+    assert kwargs == {'FunctionName': conf.name,
+                      'MemorySize': conf.memory,
+                      'Environment': {'Variables': {}}}
+    assert _mocked_lambda.get_waiter.called
+
+
+@mock_s3
+def test_s3_content_addressed_upload():
+    mock_bucket = 'mybucket'
+    conn = boto3.resource('s3')
+    conn.create_bucket(Bucket=mock_bucket)
+
+    conf = config.Config(path.dirname(__file__),
+                         config_file=path.join(EX_CONFIG, 'lambda.json'))
+    conf.set_s3(mock_bucket)
+    conf.set_s3_content_addressed('artifacts/')
+    pkg = Mock()
+    pkg.zip_file = path.join(path.dirname(__file__), 'dummyfile')
+    key = 'artifacts/%s.zip' % uploader._file_sha256(
+        pkg.zip_file).hexdigest()
+
+    upldr = uploader.PackageUploader(conf, None)
+    assert upldr._upload_package_s3(pkg) == key
+    assert [k for k, _, _ in upldr.s3_uploads] == [key]
+    assert upldr.s3_reused == []
+
+    # The same content is not uploaded again
+    upldr = uploader.PackageUploader(conf, None)
+    assert upldr._upload_package_s3(pkg) == key
+    assert upldr.s3_uploads == []
+    assert upldr.s3_reused == [key]
+
+
+def test_prune_versions():
+    conf = config.Config(path.dirname(__file__),
+                         config_file=path.join(EX_CONFIG, 'lambda.json'))
+    with FakeAWS() as aws:
+        client = clients.client('lambda', 'us-east-1')
+        client.create_function(FunctionName=conf.name, Role=conf.role,
+                               Handler='function.lambda_handler',
+                               Code={'ZipFile': b'code'})
+        # More versions than fit on one page
+        for i in range(60):
+            client.update_function_configuration(FunctionName=conf.name,
+                                                 Description=str(i))
+            client.publish_version(FunctionName=conf.name)
+        client.create_alias(FunctionName=conf.name, Name='live',
+                            FunctionVersion='3', RoutingConfig={
+                                'AdditionalVersionWeights': {'7': 0.1}})
+        aws.throttles['DeleteFunction'] = 2
+
+        upldr = uploader.PackageUploader(conf, None)
+        pruned = upldr.prune_versions(5, dry_run=True)
+        assert len(pruned) == 53
+        assert '3' not in pruned and '7' not in pruned
+        assert '55' in pruned and '56' not in pruned
+        assert 'DeleteFunction' not in aws.calls
+
+        assert sorted(upldr.prune_versions(5), key=int) == \
+            sorted(pruned, key=int)
+        versions = aws.functions[conf.name]['versions']
+        assert [v['Version'] for v in versions] == \
+            ['3', '7', '56', '57', '58', '59', '60']
+        assert aws.calls['DeleteFunction'] == 55
@@ -2,6 +2,7 @@ import os
 
 from os import path
 from shutil import rmtree
+from mock import patch
 from lambda_uploader import utils
 
 TESTING_TEMP_DIR = '.testing_temp'
@@ -95,3 +96,46 @@ def test_ignore_pyc():
     ignored = utils._ignore_file('bar/foo.pyc', IGNORE_TEMP)
     assert ignored
 
+
+
+def test_ignore_matcher():
+    matcher = utils.IgnoreMatcher(TEST_IGNORE + IGNORE_TEMP)
+    assert matcher.match('ignore/foo.py')
+    assert matcher.match('bar/foo.pyc')
+    assert not matcher.match('bar/foo.py')
+
+    assert matcher.match_dir('ignore')
+    assert matcher.match_dir('.git')
+    assert not matcher.match_dir('bar')
+
+    # An anchored pattern could stop matching below the directory
+    matcher = utils.IgnoreMatcher([r'\.git$', r'foo(?!/bar)'])
+    assert not matcher.match_dir('.git')
+    assert not matcher.match_dir('foo')
+
+
+def test_walk_tree_prunes_ignored_dirs():
+    os.mkdir(TESTING_TEMP_DIR)
+    for fil in TEST_TREE:
+        dir = path.dirname(fil)
+        test_pth = path.join(TESTING_TEMP_DIR, dir)
+        if dir is not None and not path.isdir(test_pth):
+            os.makedirs(test_pth)
+        with open(path.join(TESTING_TEMP_DIR, fil), 'w') as tfile:
+            tfile.write(fil)
+
+    walked = []
+    real_walk = os.walk
+
+    def walk(src):
+        for root, dirs, files in real_walk(src):
+            walked.append(path.relpath(root, TESTING_TEMP_DIR))
+            yield root, dirs, files
+
+    with patch('lambda_uploader.utils.os.walk', walk):
+        found = [rel for _, rel in utils.walk_tree(TESTING_TEMP_DIR,
+                                                   TEST_IGNORE, sort=True)]
+    rmtree(TESTING_TEMP_DIR)
+
+    assert found == ['foo.py', 'bar/foo.py', 'bar/bar/foo.py']
+    assert 'ignore' not in walked